@@ -0,0 +1,186 @@
+# activity_writer.py
+# 操作ログと使用回数の書き込みをバックグラウンドでまとめて行う
+# リクエスト処理中はメモリに積むだけにして、一定間隔・一定件数ごとにまとめて DB に書く
+
+import atexit
+import csv
+import io
+import os
+import threading
+from collections import Counter
+from datetime import datetime
+import perf_trace
+from db_connection import connection
+
+DB_PATH = "phrases.db"
+TABLE = "phrases"
+LOG_TABLE = "activity_log"
+LOG_CSV = "activity_log.csv"        # 旧形式のログ（取り込み済みのミラーとして追記を続ける）
+LOG_COLUMNS = ["timestamp", "user", "action", "details"]
+
+FLUSH_INTERVAL = 2.0                # 秒
+FLUSH_SIZE = 200                    # これだけ溜まったら間隔を待たずに書く
+LOG_CSV_MAX_BYTES = 5 * 1024 * 1024 # CSV がこのサイズを超えたらローテーション
+LOG_CSV_BACKUPS = 3                 # activity_log.csv.1 〜 .3 を残す
+EXPORT_FETCH_SIZE = 5000
+
+def init_log_table(conn, log_csv=LOG_CSV):
+    """activity_log テーブルを作成。初回は既存の CSV ログを取り込む"""
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (LOG_TABLE,)).fetchone()
+    conn.executescript(f"""
+    CREATE TABLE IF NOT EXISTS {LOG_TABLE} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        timestamp TEXT NOT NULL,
+        user TEXT,
+        action TEXT,
+        details TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_{LOG_TABLE}_timestamp ON {LOG_TABLE}(timestamp);
+    CREATE INDEX IF NOT EXISTS idx_{LOG_TABLE}_user ON {LOG_TABLE}(user, timestamp);
+    CREATE INDEX IF NOT EXISTS idx_{LOG_TABLE}_action ON {LOG_TABLE}(action, timestamp);
+    """)
+    if not exists and log_csv and os.path.exists(log_csv):
+        with open(log_csv, newline="", encoding="utf-8") as f:
+            rows = [tuple(r.get(c, "") for c in LOG_COLUMNS) for r in csv.DictReader(f)]
+        with conn:
+            conn.executemany(
+                f"INSERT INTO {LOG_TABLE}(timestamp, user, action, details) VALUES (?,?,?,?)", rows)
+    conn.commit()
+
+def rotate_csv(path, max_bytes=LOG_CSV_MAX_BYTES, backups=LOG_CSV_BACKUPS):
+    """サイズを超えていたら path → path.1 → path.2 ... とずらす"""
+    if not os.path.exists(path) or os.path.getsize(path) < max_bytes:
+        return
+    for i in range(backups - 1, 0, -1):
+        if os.path.exists(f"{path}.{i}"):
+            os.replace(f"{path}.{i}", f"{path}.{i + 1}")
+    os.replace(path, f"{path}.1")
+
+class ActivityWriter:
+    """操作ログと使用回数の増分を溜めて、バックグラウンドスレッドでまとめて書く
+
+    使用回数は id ごとに合算してから UPDATE するので、同じ訳の連続採用は1文になる。
+    """
+
+    def __init__(self, db_path=DB_PATH, log_csv=LOG_CSV,
+                 flush_interval=FLUSH_INTERVAL, flush_size=FLUSH_SIZE):
+        self.db_path = db_path
+        self.log_csv = log_csv
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._events = []
+        self._usage = Counter()
+        with connection(db_path) as conn:
+            init_log_table(conn, log_csv)
+        self._thread = threading.Thread(target=self._run, name="activity-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def log(self, user, action, details=""):
+        with self._lock:
+            self._events.append((datetime.utcnow().isoformat(), user, action, details))
+            pending = len(self._events) + len(self._usage)
+        if pending >= self.flush_size:
+            self._wake.set()
+
+    def add_usage(self, pid, delta=1):
+        with self._lock:
+            self._usage[pid] += delta
+            pending = len(self._events) + len(self._usage)
+        if pending >= self.flush_size:
+            self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if not self._events and not self._usage:
+                continue
+            # 書き込みにかかった時間も記録する（ロック待ちの確認用。管理 > パフォーマンス・負荷試験で見られる）
+            trace = perf_trace.start("activity.flush")
+            try:
+                self.flush()
+            except Exception as e:
+                trace.error = f"{type(e).__name__}: {e}"
+                print(f"[ERROR] 操作ログの書き込みに失敗: {e}")
+            finally:
+                perf_trace.finish(trace)
+
+    def flush(self):
+        """溜まっている分をすぐに書く。書き込みに失敗した分はバッファに戻す"""
+        with self._flush_lock:
+            with self._lock:
+                events, self._events = self._events, []
+                usage, self._usage = self._usage, Counter()
+            if not events and not usage:
+                return
+            try:
+                with connection(self.db_path) as conn:
+                    with conn:
+                        conn.execute("BEGIN IMMEDIATE")
+                        conn.executemany(
+                            f"INSERT INTO {LOG_TABLE}(timestamp, user, action, details) VALUES (?,?,?,?)",
+                            events)
+                        conn.executemany(
+                            f"UPDATE {TABLE} SET usage_count = usage_count + ? WHERE id = ?",
+                            [(delta, pid) for pid, delta in usage.items()])
+            except Exception:
+                with self._lock:
+                    self._events[:0] = events
+                    self._usage.update(usage)
+                raise
+            if self.log_csv and events:
+                self._append_csv(events)
+
+    def _append_csv(self, events):
+        rotate_csv(self.log_csv)
+        header = not os.path.exists(self.log_csv)
+        with open(self.log_csv, "a", newline="", encoding="utf-8") as f:
+            w = csv.writer(f)
+            if header:
+                w.writerow(LOG_COLUMNS)
+            w.writerows(events)
+
+# プロセス内で共有する書き込みスレッド
+_writers = {}
+_writers_lock = threading.Lock()
+
+def get_writer(db_path=DB_PATH, log_csv=LOG_CSV):
+    """db_path ごとに1つの ActivityWriter を返す（log_csv は最初に作るときだけ使う）"""
+    key = os.path.abspath(db_path)
+    with _writers_lock:
+        writer = _writers.get(key)
+        if writer is None:
+            writer = _writers[key] = ActivityWriter(db_path, log_csv)
+    return writer
+
+def append_log(user, action, details="", db_path=DB_PATH):
+    """操作ログを記録（書き込みはバックグラウンドでまとめて行う）"""
+    get_writer(db_path).log(user, action, details)
+
+def queue_usage(pid, db_path=DB_PATH):
+    """使用回数 +1 を記録（id ごとに合算してバックグラウンドで書く）"""
+    get_writer(db_path).add_usage(pid)
+
+def write_log_csv(f, db_path=DB_PATH):
+    """activity_log テーブルを CSV としてバイナリファイル f に少しずつ書き出す。行数を返す"""
+    get_writer(db_path).flush()
+    rows = 0
+    with connection(db_path) as conn:
+        cur = conn.execute(f"SELECT {', '.join(LOG_COLUMNS)} FROM {LOG_TABLE} ORDER BY id")
+        f.write(_csv_bytes([LOG_COLUMNS]))
+        while True:
+            batch = cur.fetchmany(EXPORT_FETCH_SIZE)
+            if not batch:
+                break
+            f.write(_csv_bytes(batch))
+            rows += len(batch)
+    return rows
+
+def _csv_bytes(rows):
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    return buf.getvalue().encode("utf-8")
@@ -1,71 +1,66 @@
 # app.py
 import streamlit as st
 import pandas as pd
-import sqlite3
-from rapidfuzz import process, fuzz
-from datetime import datetime
 import os
 import io
-
-# ---------- 設定 ----------
-DB_PATH = "phrases.db"
-TABLE = "phrases"
-LOG_CSV = "activity_log.csv"  # 操作ログ
+import tempfile
+import phrase_db
+import perf_trace
+import delta_sync
+import import_jobs
+from perf_trace import span
+from phrase_db import DB_PATH, TABLE, init_db
+from search_index import get_index, tag_counts
+from phrase_spotter import frame_from_matches
+from create_dictionary import parse_subs
+from batch_lookup import frame_from_subs, frame_from_csv, lookup_frame, SCORE_CUTOFF
+from activity_writer import append_log, queue_usage, write_log_csv, LOG_CSV
 
 # ---------- ユーティリティ ----------
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute(f"""
-    CREATE TABLE IF NOT EXISTS {TABLE} (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        source TEXT NOT NULL,
-        target TEXT NOT NULL,
-        context TEXT,
-        tags TEXT,
-        created_at TEXT,
-        usage_count INTEGER DEFAULT 0
-    )
-    """)
-    conn.commit()
-    conn.close()
-
-def load_all_phrases():
-    conn = sqlite3.connect(DB_PATH)
-    df = pd.read_sql_query(f"SELECT * FROM {TABLE} ORDER BY usage_count DESC, created_at DESC", conn)
-    conn.close()
-    return df
-
 def upsert_phrase(source, target, context="", tags=""):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    now = datetime.utcnow().isoformat()
-    # 簡易：同一 source があれば更新、なければ挿入
-    cur.execute(f"SELECT id FROM {TABLE} WHERE source = ?", (source,))
-    row = cur.fetchone()
-    if row:
-        pid = row[0]
-        cur.execute(f"UPDATE {TABLE} SET target=?, context=?, tags=? WHERE id=?", (target, context, tags, pid))
-    else:
-        cur.execute(f"INSERT INTO {TABLE}(source,target,context,tags,created_at) VALUES (?,?,?,?,?)",
-                    (source, target, context, tags, now))
-    conn.commit()
-    conn.close()
+    pid, created_at = phrase_db.upsert_phrase(source, target, context, tags, DB_PATH)
+    # 検索インデックスは差分だけ更新
+    get_index(DB_PATH, TABLE).apply_upsert(pid, source, target, context, tags, created_at)
+    return pid
 
 def increment_usage(pid):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute(f"UPDATE {TABLE} SET usage_count = usage_count + 1 WHERE id = ?", (pid,))
-    conn.commit()
-    conn.close()
-
-def append_log(user, action, details=""):
-    """シンプルなCSVログ。後でダウンロードできるようにする。"""
-    row = {"timestamp": datetime.utcnow().isoformat(), "user": user, "action": action, "details": details}
-    df = pd.DataFrame([row])
-    header = not os.path.exists(LOG_CSV)
-    df.to_csv(LOG_CSV, mode="a", header=header, index=False, encoding="utf-8")
-    
+    # DB への書き込みはバックグラウンドで id ごとにまとめて行う
+    queue_usage(pid, DB_PATH)
+    get_index(DB_PATH, TABLE).apply_usage(pid)
+
+@st.fragment(run_every=1.0)
+def show_import_job(job_id):
+    """取り込み中のジョブの進み具合（この部分だけ1秒ごとに再実行する。終わったら画面全体を再実行して止める）"""
+    runner = import_jobs.get_runner(DB_PATH)
+    job = runner.job(job_id)
+    if job is None:
+        return
+    if job["status"] not in import_jobs.ACTIVE:
+        st.rerun()
+    total = max(job["total_rows"] or 0, job["done_rows"], 1)
+    eta = import_jobs.eta_seconds(job)
+    text = f"{job['filename']}: {job['done_rows']} / {total}行"
+    if job["status"] == "queued":
+        text += "（順番待ち）"
+    elif eta is not None:
+        text += f"・残り約{eta:.0f}秒"
+    st.progress(job["done_rows"] / total, text=text)
+    if st.button("取り込みを中止", key=f"cancel_import_{job_id}"):
+        runner.cancel(job_id)
+        append_log(st.session_state.user, "cancel_import", f"job={job_id}")
+
+def show_import_result(job):
+    """終わったジョブの結果（1秒ごとの再実行はしない）"""
+    count = job["inserted"] + job["updated"]
+    detail = (f"{count}件：新規 {job['inserted']}件・更新 {job['updated']}件・"
+              f"スキップ {job['skipped']}件")
+    if job["status"] == "done":
+        st.success(f"{job['filename']} を DB に取り込みました（{detail}）。")
+    elif job["status"] == "cancelled":
+        st.warning(f"{job['filename']} の取り込みを中止しました（中止までに {detail}）。")
+    else:
+        st.error(f"CSV 読み込みエラー: {job['error']}")
+
 # ---------- 認証 ----------
 def load_users_from_secrets():
     """Streamlit Cloud の Secrets に "USERS" キーを入れておくこと
@@ -116,133 +111,303 @@ def authenticate():
 # ---------- 初期化 ----------
 init_db()
 st.set_page_config(page_title="翻訳フレーズ辞書", layout="wide")
+# 再実行ごとの処理時間を記録（管理 > パフォーマンス で確認できる）
+trace = perf_trace.start("rerun", profile=st.session_state.get("perf_profile", False))
+# 前回の再実行の内訳はトレースそのものを session_state に置いて次の再実行で読む
+# （st.stop() / st.rerun() の後の finally で session_state に書いたものは保存されないため）
+last_trace = st.session_state.get("perf_last_trace")
+st.session_state.perf_last_trace = trace
+if last_trace is not None and last_trace.profile:
+    st.session_state.perf_profile_text = last_trace.profile
+# st.stop() / st.rerun() で途中で終わった再実行も記録する
+try:
+    # 認証チェック
+    if not authenticate():
+        st.stop()
+
+    # ログアウトボタン
+    st.sidebar.markdown("---")
+    st.sidebar.write(f"ログイン中: **{st.session_state.user}**")
+    if st.sidebar.button("ログアウト"):
+        append_log(st.session_state.user, "logout", "")
+        st.session_state.logged_in = False
+        st.session_state.user = None
+        st.rerun()
+
+    # メインUI
+    st.title("翻訳フレーズ辞書（共有版）")
+    st.write("英語フレーズを保存・検索して、訳をワンクリックで採用できます。")
 
-# 認証チェック
-if not authenticate():
-    st.stop()
-
-# ログアウトボタン
-st.sidebar.markdown("---")
-st.sidebar.write(f"ログイン中: **{st.session_state.user}**")
-if st.sidebar.button("ログアウト"):
-    append_log(st.session_state.user, "logout", "")
-    st.session_state.logged_in = False
-    st.session_state.user = None
-    st.rerun()
-
-# メインUI
-st.title("翻訳フレーズ辞書（共有版）")
-st.write("英語フレーズを保存・検索して、訳をワンクリックで採用できます。")
-
-# 左カラム：インポート / 新規登録
-left, right = st.columns([1,2])
-
-with left:
-    st.header("データ準備")
-    uploaded = st.file_uploader("既存の翻訳CSVをアップロード（source,target,context,tags）", type=["csv"])
-    if uploaded:
-        try:
-            df = pd.read_csv(uploaded, encoding='utf-8-sig')
-            # 簡易バリデーション
-            if "source" in df.columns and "target" in df.columns:
-                count = 0
-                for _, r in df.iterrows():
-                    target = str(r["target"]).strip()
-                    # [要確認]はスキップ
-                    if target and target != "[要確認]":
-                        upsert_phrase(str(r["source"]).strip(), target,
-                                      str(r.get("context","")), str(r.get("tags","")))
-                        count += 1
-                st.success(f"CSV を DB に取り込みました（{count}件）。")
-                append_log(st.session_state.user, "upload_csv", f"rows={count}")
+    # 左カラム：インポート / 新規登録
+    left, right = st.columns([1,2])
+
+    with left:
+        st.header("データ準備")
+        uploaded = st.file_uploader("既存の翻訳CSVをアップロード（source,target,context,tags）", type=["csv"],
+                                    key="upload_csv")
+        # 取り込みはバックグラウンドのジョブで行う（チャンクごとにコミット、[要確認]・空の訳はスキップ）。
+        # アップロードしたファイルは再実行しても残るので、同じアップロードからは1回だけジョブを作る。
+        if uploaded and st.session_state.get("import_file_id") != uploaded.file_id:
+            st.session_state.import_file_id = uploaded.file_id
+            with span("upload.submit"):
+                job_id, created = import_jobs.get_runner(DB_PATH).submit(
+                    uploaded.getvalue(), uploaded.name, st.session_state.user)
+            st.session_state.import_job = job_id
+            st.session_state.import_duplicate = not created
+            if created:
+                append_log(st.session_state.user, "upload_csv", f"job={job_id},file={uploaded.name}")
+        if st.session_state.get("import_job"):
+            job_id = st.session_state.import_job
+            if st.session_state.get("import_duplicate"):
+                st.info(f"同じ内容のファイルは取り込み済み（または取り込み中）です（ジョブ {job_id}）。")
+            # 1秒ごとに再実行する部分は、ジョブが終わるまでだけ表示する
+            job = import_jobs.get_runner(DB_PATH).job(job_id)
+            if job is not None and job["status"] in import_jobs.ACTIVE:
+                show_import_job(job_id)
+            elif job is not None:
+                show_import_result(job)
+        st.markdown("---")
+        st.header("フレーズ登録（手動）")
+        s_src = st.text_input("英語（原文）", key="src_input")
+        s_tgt = st.text_input("日本語（訳）", key="tgt_input")
+        s_ctx = st.text_input("コンテキスト（例：キャラ名）", key="ctx_input")
+        s_tags = st.text_input("タグ（カンマ区切り）", key="tags_input")
+        if st.button("登録／更新"):
+            if s_src.strip() and s_tgt.strip():
+                upsert_phrase(s_src.strip(), s_tgt.strip(), s_ctx.strip(), s_tags.strip())
+                st.success("登録しました。検索から確認できます。")
+                append_log(st.session_state.user, "manual_upsert", f"{s_src} -> {s_tgt}")
             else:
-                st.error("CSVに source と target 列が必要です。")
-        except Exception as e:
-            st.error(f"CSV 読み込みエラー: {str(e)}")
+                st.error("原文と訳は必須です。")
 
-    st.markdown("---")
-    st.header("フレーズ登録（手動）")
-    s_src = st.text_input("英語（原文）", key="src_input")
-    s_tgt = st.text_input("日本語（訳）", key="tgt_input")
-    s_ctx = st.text_input("コンテキスト（例：キャラ名）", key="ctx_input")
-    s_tags = st.text_input("タグ（カンマ区切り）", key="tags_input")
-    if st.button("登録／更新"):
-        if s_src.strip() and s_tgt.strip():
-            upsert_phrase(s_src.strip(), s_tgt.strip(), s_ctx.strip(), s_tags.strip())
-            st.success("登録しました。検索から確認できます。")
-            append_log(st.session_state.user, "manual_upsert", f"{s_src} -> {s_tgt}")
+        st.markdown("---")
+        st.header("一括検索（SRT / CSV）")
+        batch_file = st.file_uploader("英語SRT、または source 列を持つCSVをアップロード", type=["srt", "csv"], key="batch_file")
+        batch_cutoff = st.slider("最低スコア", 0, 100, SCORE_CUTOFF, key="batch_cutoff")
+        if batch_file and st.button("一括検索を実行"):
+            try:
+                if batch_file.name.lower().endswith(".srt"):
+                    subs, _ = parse_subs(batch_file.getvalue(), batch_file.name)
+                    df_batch = frame_from_subs(subs)
+                else:
+                    df_batch = frame_from_csv(batch_file)
+                with span("batch_lookup", f"rows={len(df_batch)}"):
+                    out = lookup_frame(df_batch, get_index(DB_PATH, TABLE), batch_cutoff)
+                matched = int((out["score"] > 0).sum())
+                st.success(f"{len(out)}行中 {matched}行 に候補が見つかりました。")
+                b = out.to_csv(index=False).encode("utf-8-sig")
+                out_name = os.path.splitext(batch_file.name)[0] + "_prefilled.csv"
+                st.download_button("結果CSVをダウンロード", data=b, file_name=out_name, mime="text/csv")
+                append_log(st.session_state.user, "batch_lookup", f"rows={len(out)},matched={matched}")
+            except Exception as e:
+                st.error(f"一括検索エラー: {str(e)}")
+
+        st.markdown("---")
+        ec1, ec2, ec3 = st.columns(3)
+        export_fmt = ec1.selectbox("形式", phrase_db.EXPORT_FORMATS, key="export_fmt",
+                                   format_func=lambda f: {"csv": "CSV（Excel対応）", "parquet": "Parquet"}[f])
+        export_tags = ec2.text_input("タグで絞り込み（カンマ区切り・すべてを含むもの）", key="export_tags")
+        export_since = ec3.text_input("この日以降に登録", placeholder="例: 2025-01-01", key="export_since")
+        if st.button("辞書をエクスポート"):
+            # DB からチャンクごとに一時ファイルへ書き出す（大きい場合はディスクに退避）
+            try:
+                with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as f, span("export"):
+                    rows = phrase_db.export_phrases(f, export_fmt, export_tags.strip(),
+                                                    export_since.strip(), DB_PATH)
+                    f.seek(0)
+                    data = f.read()
+                mime = "text/csv" if export_fmt == "csv" else "application/octet-stream"
+                st.download_button(f"{export_fmt.upper()}をダウンロード", data=data,
+                                   file_name=f"phrases_export.{export_fmt}", mime=mime)
+                append_log(st.session_state.user, f"export_{export_fmt}", f"rows={rows}")
+            except Exception as e:
+                st.error(f"エクスポートエラー: {str(e)}")
+
+    # 右カラム：検索・候補表示
+    with right:
+        st.header("検索と候補提示")
+        # 日本語 → 英語：既存の訳の表記ゆれを確認する用（訳の文字 n-gram で引く）
+        # 文中のフレーズ：長い文や台本全体に含まれる辞書のフレーズ（名前・決めゼリフなど）をすべて探す
+        direction = st.radio("検索の向き", ["英語 → 日本語", "日本語 → 英語", "文中のフレーズ"], horizontal=True,
+                             key="search_dir")
+        reverse = direction == "日本語 → 英語"
+        spotting = direction == "文中のフレーズ"
+        if spotting:
+            query = ""
+            spot_text = st.text_area("英語の文・台本を貼り付け", height=200, key="spot_text",
+                                     placeholder="例: Lorena said break it kids before the show.")
+            sp1, sp2 = st.columns(2)
+            spot_min_words = sp1.number_input("最小単語数", min_value=1, max_value=10, value=1, step=1,
+                                              key="spot_min_words")
+            spot_all = sp2.checkbox("長いフレーズに含まれる短いフレーズも表示", key="spot_all")
+            if spot_text.strip():
+                index = get_index(DB_PATH, TABLE)
+                with span("search"):
+                    matches = index.spot(spot_text, min_words=int(spot_min_words), longest_only=not spot_all)
+                if matches:
+                    st.write(f"含まれるフレーズ: {len(matches)}件（line は貼り付けた文の行番号）")
+                    with span("render.dataframe"):
+                        st.dataframe(frame_from_matches(matches), hide_index=True)
+                else:
+                    st.info("辞書のフレーズは見つかりませんでした。")
+        elif reverse:
+            query = st.text_input("訳（日本語）を入力", placeholder="例: ようこそ", key="query")
         else:
-            st.error("原文と訳は必須です。")
+            query = st.text_input("検索／候補を出したい英語フレーズを入力", placeholder="例: Let's go!", key="query")
+        if not spotting:
+            limit = st.slider("候補上限数", 1, 10, 5)
+            # 番組・キャラクター・エピソードのタグ、コンテキストで絞り込んでからスコアリングする（SQL で絞り込み）
+            tc1, tc2 = st.columns(2)
+            with span("search.tags"):
+                tag_options = dict(tag_counts(DB_PATH))
+            search_tags = tc1.multiselect("タグで絞り込み（すべてを含むもの）", list(tag_options), key="search_tags",
+                                          format_func=lambda t: f"{t}（{tag_options.get(t, 0)}件）")
+            search_context = tc2.text_input("コンテキストで絞り込み", key="search_context")
+        if query:
+            # プロセス共有のインデックスを使う（再実行ごとの全件読み込みはしない）
+            index = get_index(DB_PATH, TABLE)
+            with span("search.refresh"):
+                index.refresh()
+            if len(index) == 0:
+                st.info("辞書が空です。左でCSVをアップロードするか手で登録してください。")
+            else:
+                with span("search"):
+                    if reverse:
+                        results = index.reverse_search(query, limit=limit, tags=search_tags,
+                                                       context=search_context.strip())
+                    else:
+                        results = index.search(query, limit=limit, tags=search_tags, context=search_context.strip())
+                # results: [(row, score), ...]
+                st.write("候補（上からスコア順）:")
+                with span("render.results"):
+                    for row, score in results:
+                        col1, col2, col3 = st.columns([4,4,1])
+                        with col1:
+                            st.markdown(f"**原文**: `{row['source']}`")
+                            st.markdown(f"**訳**: {row['target']}")
+                            st.markdown(f"**context**: {row.get('context','')}")
+                        with col2:
+                            st.markdown(f"スコア: {score}")
+                        with col3:
+                            if st.button("採用", key=f"adopt_{int(row['id'])}"):
+                                # 採用した訳をエディタ用に反映（session_state）
+                                st.session_state["selected_target"] = row['target']
+                                increment_usage(int(row['id']))
+                                append_log(st.session_state.user, "adopt", f"src={row['source'][:50]},id={row['id']}")
+                                st.success("採用しました（編集欄に反映されます）。")
+                st.markdown("---")
+                # 逆引きのときは入力が日本語なので、原文としては保存しない
+                if not reverse:
+                    st.write("訳を編集して新規保存することもできます。")
+                    tgt_edit = st.text_area("編集（最終的に使う訳）", value=st.session_state.get("selected_target",""), height=120)
+                    new_ctx = st.text_input("（任意）この訳のコンテキスト")
+                    if st.button("この訳を辞書に保存"):
+                        src_norm = query.strip()
+                        if src_norm and tgt_edit.strip():
+                            upsert_phrase(src_norm, tgt_edit.strip(), new_ctx.strip(), "")
+                            append_log(st.session_state.user, "save_translation", f"{src_norm[:50]} -> {tgt_edit.strip()[:50]}")
+                            st.success("辞書に保存しました。")
+                        else:
+                            st.error("原文と訳が必要です。")
+
+        st.markdown("## 辞書一覧（確認）")
+        # 表示中のページだけを SQL で取得する（絞り込み・並び順も SQL 側で処理）
+        fc1, fc2, fc3 = st.columns(3)
+        f_src = fc1.text_input("原文で絞り込み", key="list_source")
+        f_tgt = fc2.text_input("訳で絞り込み", key="list_target")
+        f_tags = fc3.text_input("タグで絞り込み（カンマ区切り・すべてを含むもの）", key="list_tags")
+        sc1, sc2, sc3 = st.columns([2, 1, 1])
+        sort = sc1.selectbox("並び順", phrase_db.PAGE_SORTS, key="list_sort",
+                             format_func=lambda c: {"usage_count": "使用回数が多い順", "created_at": "登録が新しい順"}[c])
+        page_size = sc2.selectbox("表示件数", [25, 50, 100, 200], index=1, key="list_page_size")
+        if sc3.button("一覧更新"):
+            pass
+        # 条件が変わったら1ページ目に戻す（list_cursors[i] は i ページ目の開始位置）
+        list_key = (f_src.strip(), f_tgt.strip(), f_tags.strip(), sort, page_size)
+        if st.session_state.get("list_key") != list_key:
+            st.session_state.list_key = list_key
+            st.session_state.list_cursors = [None]
+        cursors = st.session_state.list_cursors
+        with span("list.fetch"):
+            df_show, next_cursor = phrase_db.fetch_page(sort, page_size, cursors[-1],
+                                                        f_src.strip(), f_tgt.strip(), f_tags.strip(), DB_PATH)
+        with span("render.dataframe"):
+            st.dataframe(df_show)
+        pc1, pc2, pc3 = st.columns([1, 1, 4])
+        pc1.button("前へ", disabled=len(cursors) == 1, on_click=lambda: cursors.pop())
+        pc2.button("次へ", disabled=next_cursor is None, on_click=lambda: cursors.append(next_cursor))
+        pc3.write(f"{len(cursors)} ページ目")
 
     st.markdown("---")
-    if st.button("辞書をCSVでエクスポート"):
-        df_all = load_all_phrases()
-        csv = df_all.to_csv(index=False, encoding="utf-8-sig")
-        b = csv.encode("utf-8-sig")
-        st.download_button("CSVをダウンロード", data=b, file_name="phrases_export.csv", mime="text/csv")
-        append_log(st.session_state.user, "export_csv", f"rows={len(df_all)}")
-
-# 右カラム：検索・候補表示
-with right:
-    st.header("検索と候補提示")
-    query = st.text_input("検索／候補を出したい英語フレーズを入力", placeholder="例: Let's go!", key="query")
-    limit = st.slider("候補上限数", 1, 10, 5)
-    if query:
-        df_all = load_all_phrases()
-        choices = df_all["source"].tolist()
-        if len(choices) == 0:
-            st.info("辞書が空です。左でCSVをアップロードするか手で登録してください。")
-        else:
-            results = process.extract(query, choices, scorer=fuzz.token_sort_ratio, limit=limit)
-            # results: [(match, score, idx), ...]
-            st.write("候補（上からスコア順）:")
-            for match, score, _ in results:
-                row = df_all[df_all["source"] == match].iloc[0]
-                col1, col2, col3 = st.columns([4,4,1])
-                with col1:
-                    st.markdown(f"**原文**: `{row['source']}`")
-                    st.markdown(f"**訳**: {row['target']}")
-                    st.markdown(f"**context**: {row.get('context','')}")
-                with col2:
-                    st.markdown(f"スコア: {score}")
-                with col3:
-                    if st.button("採用", key=f"adopt_{int(row['id'])}"):
-                        # 採用した訳をエディタ用に反映（session_state）
-                        st.session_state["selected_target"] = row['target']
-                        increment_usage(int(row['id']))
-                        append_log(st.session_state.user, "adopt", f"src={row['source'][:50]},id={row['id']}")
-                        st.success("採用しました（編集欄に反映されます）。")
-            st.markdown("---")
-            st.write("訳を編集して新規保存することもできます。")
-            tgt_edit = st.text_area("編集（最終的に使う訳）", value=st.session_state.get("selected_target",""), height=120)
-            new_ctx = st.text_input("（任意）この訳のコンテキスト")
-            if st.button("この訳を辞書に保存"):
-                src_norm = query.strip()
-                if src_norm and tgt_edit.strip():
-                    upsert_phrase(src_norm, tgt_edit.strip(), new_ctx.strip(), "")
-                    append_log(st.session_state.user, "save_translation", f"{src_norm[:50]} -> {tgt_edit.strip()[:50]}")
-                    st.success("辞書に保存しました。")
-                else:
-                    st.error("原文と訳が必要です。")
-
-    st.markdown("## 辞書一覧（確認）")
-    if st.button("一覧更新"):
-        pass
-    df_show = load_all_phrases()
-    st.dataframe(df_show)
-
-st.markdown("---")
-st.caption("使い方: 左でCSVを読み込む／手で登録 → 右で原文を入力して候補を見つける → 採用ボタンで訳を反映 → 必要に応じて編集して辞書へ保存")
-
-# ログのダウンロード（管理者向け）
-st.sidebar.markdown("---")
-st.sidebar.header("管理")
-if st.sidebar.button("操作ログをダウンロード（CSV）"):
-    if os.path.exists(LOG_CSV):
-        with open(LOG_CSV, "rb") as f:
+    st.caption("使い方: 左でCSVを読み込む／手で登録 → 右で原文を入力して候補を見つける → 採用ボタンで訳を反映 → 必要に応じて編集して辞書へ保存")
+
+    # ログのダウンロード（管理者向け）
+    st.sidebar.markdown("---")
+    st.sidebar.header("管理")
+    if st.sidebar.button("操作ログをダウンロード（CSV）"):
+        # activity_log テーブルから少しずつ書き出す（大きい場合はディスクに退避）
+        with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as f:
+            rows = write_log_csv(f, DB_PATH)
+            f.seek(0)
             data = f.read()
-        st.sidebar.download_button("ログをダウンロード", data=data, file_name=LOG_CSV, mime="text/csv")
-        append_log(st.session_state.user, "download_log", "")
-    else:
-        st.sidebar.info("まだログがありません。")
+        if rows > 0:
+            st.sidebar.download_button("ログをダウンロード", data=data, file_name=LOG_CSV, mime="text/csv")
+            append_log(st.session_state.user, "download_log", "")
+        else:
+            st.sidebar.info("まだログがありません。")
+
+    # 取り込みジョブ（アプリからアップロードされた CSV。全ユーザー分）
+    with st.sidebar.expander("取り込みジョブ"):
+        jobs = import_jobs.get_runner(DB_PATH).recent()
+        if jobs:
+            st.dataframe(pd.DataFrame(jobs)[["id", "filename", "user", "status", "done_rows", "total_rows",
+                                             "inserted", "updated", "created_at"]], hide_index=True)
+        else:
+            st.caption("まだ取り込みジョブはありません。")
+
+    # 差分同期（ローカルの phrases.db などとの間で、前回以降の変更だけをやり取りする）
+    with st.sidebar.expander("差分同期"):
+        instance, seq, peers = delta_sync.status(DB_PATH)
+        st.caption(f"このDB: {instance}（最新の変更番号: {seq}）")
+        for peer, done, applied_at in peers:
+            st.caption(f"取り込み済み: {peer} の {done} 番まで")
+        since = st.number_input("この番号より後の変更を書き出す", min_value=0, value=0, step=1, key="delta_since")
+        if st.button("差分を作成"):
+            buf = io.BytesIO()
+            header = delta_sync.export_delta(buf, int(since), DB_PATH)
+            st.download_button(f"差分をダウンロード（{header['changes']}件）", data=buf.getvalue(),
+                               file_name=f"phrases_delta_{header['from_seq']}_{header['to_seq']}.jsonl.gz",
+                               mime="application/gzip")
+            append_log(st.session_state.user, "export_delta", f"since={since},changes={header['changes']}")
+        delta_file = st.file_uploader("差分ファイルを取り込む", type=["gz"], key="delta_file")
+        if delta_file and st.button("差分を取り込む"):
+            # 送り元ごとに取り込み済みの番号を覚えているので、同じファイルを再度取り込んでも変わらない
+            try:
+                counts = delta_sync.apply_delta(delta_file, DB_PATH)
+                st.success(f"{counts['to_seq']} 番までの差分を取り込みました（追加・更新 {counts['upserted']}件・"
+                           f"使用回数 {counts['usage']}件・削除 {counts['deleted']}件・"
+                           f"取り込み済み {counts['skipped']}件）。")
+                append_log(st.session_state.user, "apply_delta", f"peer={counts['peer']},to_seq={counts['to_seq']}")
+            except Exception as e:
+                st.error(f"差分の取り込みエラー: {str(e)}")
 
+    # 処理時間（管理者向け）：全セッションの直近の再実行の百分位と、このセッションの前回の内訳
+    with st.sidebar.expander("パフォーマンス"):
+        st.checkbox("cProfile でも記録する（重くなります）", key="perf_profile")
+        stats = perf_trace.percentiles(perf_trace.recent("rerun"))
+        if stats:
+            st.caption(f"直近 {stats[0]['回数']} 回の再実行（ms）")
+            st.dataframe(pd.DataFrame(stats), hide_index=True)
+        last = last_trace.totals() if last_trace is not None else None
+        if last:
+            st.caption("このセッションの前回の再実行（ms）")
+            st.dataframe(pd.DataFrame({"区間": list(last), "ms": [round(v * 1000, 2) for v in last.values()]}),
+                         hide_index=True)
+        if st.button("トレースを作成（JSON）"):
+            st.download_button("トレースをダウンロード", data=perf_trace.chrome_trace(),
+                               file_name="perf_trace.json", mime="application/json")
+        if st.session_state.get("perf_profile_text"):
+            st.download_button("cProfile の結果をダウンロード", data=st.session_state.perf_profile_text,
+                               file_name="profile.txt", mime="text/plain")
+finally:
+    perf_trace.finish(trace)
@@ -0,0 +1,93 @@
+# batch_lookup.py
+# 英語SRT（またはCSV）の全行を辞書とまとめて突合し、訳を埋めたCSVを作成
+# 使い方: python batch_lookup.py <英語SRT または CSV> [出力CSV] [最低スコア]
+
+import pandas as pd
+import sys
+import os
+import time
+from create_dictionary import load_subs, normalize_text
+from search_index import get_index
+from phrase_db import DB_PATH, TABLE, init_db
+
+SCORE_CUTOFF = 60  # これ未満のスコアは「マッチなし」
+
+def frame_from_subs(subs):
+    """字幕セグメントを source / context の DataFrame に変換"""
+    return pd.DataFrame({
+        "source": [normalize_text(s.content) for s in subs],
+        "context": [f"Time: {s.start}" for s in subs],
+    })
+
+def frame_from_csv(path_or_buffer):
+    """source 列を持つCSVを読み込む"""
+    df = pd.read_csv(path_or_buffer, encoding='utf-8-sig')
+    if "source" not in df.columns:
+        raise ValueError("CSVに source 列が必要です")
+    out = pd.DataFrame({"source": df["source"].fillna("").astype(str).str.strip()})
+    out["context"] = df["context"].fillna("").astype(str) if "context" in df.columns else ""
+    return out
+
+def lookup_frame(df, index, score_cutoff=SCORE_CUTOFF):
+    """全行をまとめて検索し、target / match / score / id を埋めた DataFrame を返す
+
+    マッチしなかった行の target は [要確認]（create_dictionary.py と同じ扱い）。
+    """
+    results = index.batch_search(df["source"].tolist(), score_cutoff=score_cutoff)
+    out = df.copy()
+    out["target"] = [row["target"] if row else "[要確認]" for row, _ in results]
+    out["match"] = [row["source"] if row else "" for row, _ in results]
+    out["score"] = [round(score, 1) if row else 0 for row, score in results]
+    out["id"] = [row["id"] if row else None for row, _ in results]
+    out["id"] = out["id"].astype("Int64")
+    return out[["source", "target", "match", "score", "id", "context"]]
+
+def main():
+    if len(sys.argv) < 2:
+        print("使い方: python batch_lookup.py <英語SRT または CSV> [出力CSV] [最低スコア]")
+        print("例: python batch_lookup.py english.srt prefilled.csv 70")
+        sys.exit(1)
+
+    in_path = sys.argv[1]
+    out_csv = sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(os.path.basename(in_path))[0] + "_prefilled.csv"
+    score_cutoff = float(sys.argv[3]) if len(sys.argv) > 3 else SCORE_CUTOFF
+
+    print("=" * 60)
+    print("一括検索ツール（辞書から訳を自動入力）")
+    print("=" * 60)
+
+    if in_path.lower().endswith(".srt"):
+        df = frame_from_subs(load_subs(in_path))
+    else:
+        try:
+            df = frame_from_csv(in_path)
+        except Exception as e:
+            print(f"[ERROR] {in_path} の読み込みに失敗: {e}")
+            sys.exit(1)
+        print(f"[OK] {in_path} を読み込みました（{len(df)}行）")
+
+    if not os.path.exists(DB_PATH):
+        print(f"[ERROR] データベースが見つかりません: {DB_PATH}")
+        sys.exit(1)
+
+    init_db(DB_PATH)
+    start = time.perf_counter()
+    out = lookup_frame(df, get_index(DB_PATH, TABLE), score_cutoff)
+    elapsed = time.perf_counter() - start
+    out.to_csv(out_csv, index=False, encoding="utf-8-sig")  # Excel対応のためBOM付き
+
+    total = len(out)
+    matched = int((out["score"] > 0).sum())
+    match_rate = (matched / total * 100) if total > 0 else 0
+
+    print("\n" + "=" * 60)
+    print("[完成しました！]")
+    print("=" * 60)
+    print(f"出力ファイル: {out_csv}")
+    print(f"総行数: {total}")
+    print(f"マッチ成功: {matched} ({match_rate:.1f}%)  最低スコア: {score_cutoff}")
+    print(f"処理時間: {elapsed:.2f}秒")
+    print("=" * 60)
+
+if __name__ == "__main__":
+    main()
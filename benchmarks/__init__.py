@@ -0,0 +1,4 @@
+# benchmarks
+# 主要な処理（検索・取り込み・字幕の突合・統合・エクスポート）の速度を測るベンチマーク
+# 使い方: python -m benchmarks run [--scales 10k,100k,1m] [--out 結果.json]
+#         python -m benchmarks compare <基準.json> <今回.json> [--threshold 0.2]
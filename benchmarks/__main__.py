@@ -0,0 +1,442 @@
+# benchmarks/__main__.py
+# 使い方:
+#   python -m benchmarks run [--scales 10k,100k] [--cases 名前,...] [--repeat 3] [--seed 0]
+#                            [--queries 200] [--workdir 作業フォルダ] [--out 結果.json]
+#   python -m benchmarks compare <基準.json> <今回.json> [--threshold 0.2]
+#   python -m benchmarks load [--db phrases.db | --scales 10k] [--sessions 1,4,16] [--duration 20]
+#                             [--think 0.5] [--mix search=60,reverse=10,adopt=17,upsert=10,upload=3]
+#                             [--lock-wait-ms 1] [--seed 0] [--workdir 作業フォルダ] [--out 結果.json]
+#
+# run は規模ごとに合成データを作り、各処理を repeat 回ずつ測って JSON に書き出す。
+# compare は2つの結果を比べ、threshold（0.2 = 20%）を超えて遅くなった処理があれば終了コード1で終わる。
+# load は複数人が同時に使ったときのスループット・処理時間・ロック待ち・エラーを測る（benchmarks/load.py）。
+#   --db を渡すとその DB の複製を、渡さなければ --scales の規模の合成データを使う。
+
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from benchmarks.synth import REPO_ROOT, SampleShape, generate_dictionary, make_queries, \
+    make_target_queries, parse_scale, write_srt_pair
+
+sys.path.insert(0, REPO_ROOT)
+
+import pandas as pd
+import phrase_db
+import import_to_db
+import merge_dictionaries
+from rapidfuzz import process, fuzz
+from create_dictionary import load_subs, align_subs
+from db_connection import close_pool
+from search_index import PhraseIndex, write_index_snapshot
+from snapshot import remove_old_snapshots
+
+DEFAULT_SCALES = "10k,100k"
+DEFAULT_REPEAT = 3
+DEFAULT_QUERIES = 200
+FULL_SCAN_QUERIES = 20     # 全件走査は遅いのでクエリ数を絞る
+DEFAULT_THRESHOLD = 0.2
+
+@contextlib.contextmanager
+def quiet():
+    """測定中は各ツールの print を捨てる"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+class Workload:
+    """1つの規模の合成データ（作業フォルダに置き、同じ seed なら使い回す）"""
+
+    def __init__(self, root, n, seed, shape, n_queries):
+        self.dir = os.path.join(root, f"n{n}_seed{seed}")
+        os.makedirs(self.dir, exist_ok=True)
+        self.csv = os.path.join(self.dir, "dictionary.csv")
+        self.eng_srt = os.path.join(self.dir, "english.srt")
+        self.jpn_srt = os.path.join(self.dir, "japanese.srt")
+        self.parts = [os.path.join(self.dir, f"part{i}.csv") for i in range(3)]
+        self.db = os.path.join(self.dir, phrase_db.DB_PATH)
+        if not os.path.exists(self.csv):
+            df = generate_dictionary(n, seed, shape)
+            df.to_csv(self.csv, index=False, encoding="utf-8-sig")
+            write_srt_pair(df, self.eng_srt, self.jpn_srt, seed)
+            # 統合用：3分割して隣どうしを1割ずつ重ねる
+            step = len(df) // 3
+            for i, part in enumerate(self.parts):
+                df.iloc[i * step:(i + 1) * step + step // 10].to_csv(part, index=False, encoding="utf-8-sig")
+        else:
+            df = pd.read_csv(self.csv, encoding="utf-8-sig", dtype=str).fillna("")
+        self.queries = make_queries(df, n_queries, seed)
+        self.target_queries = make_target_queries(df, n_queries, seed)
+
+    def reset_db(self):
+        close_pool(self.db)
+        remove_old_snapshots(self.db)
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(self.db + suffix):
+                os.remove(self.db + suffix)
+
+    def ensure_db(self):
+        if not os.path.exists(self.db):
+            phrase_db.init_db(self.db)
+            phrase_db.import_csv(self.csv, self.db)
+
+# ---------- 測定する処理 ----------
+# 各関数は1回分の測定値（秒）を返す。準備は測定に含めない。
+
+def case_import_csv(w):
+    w.reset_db()
+    with quiet():
+        import_to_db.init_db(w.db)
+        start = time.perf_counter()
+        ok = import_to_db.import_csv(w.csv, db_path=w.db)
+        elapsed = time.perf_counter() - start
+    if not ok:
+        raise RuntimeError("import_csv に失敗しました")
+    return elapsed
+
+def case_load_all_phrases(w):
+    w.ensure_db()
+    start = time.perf_counter()
+    phrase_db.load_all_phrases(w.db)
+    return time.perf_counter() - start
+
+def case_extract_full_scan(w):
+    """以前の app.py の検索（全件を読んで process.extract）。1クエリあたり"""
+    w.ensure_db()
+    choices = phrase_db.load_all_phrases(w.db)["source"].tolist()
+    queries = w.queries[:FULL_SCAN_QUERIES]
+    start = time.perf_counter()
+    for q in queries:
+        process.extract(q, choices, scorer=fuzz.token_sort_ratio, limit=5)
+    return (time.perf_counter() - start) / len(queries)
+
+def case_index_rebuild(w):
+    """DB からの読み込み（スナップショットなし）"""
+    w.ensure_db()
+    index = PhraseIndex(w.db, use_snapshot=False)
+    start = time.perf_counter()
+    index.rebuild()
+    return time.perf_counter() - start
+
+def case_index_cold_start(w):
+    """起動直後の最初の検索まで（スナップショットの mmap + 1回目の検索）"""
+    w.ensure_db()
+    write_index_snapshot(w.db)
+    index = PhraseIndex(w.db)
+    start = time.perf_counter()
+    index.rebuild()
+    index.search(w.queries[0], limit=5)
+    return time.perf_counter() - start
+
+def case_index_search(w):
+    """今の app.py の検索（PhraseIndex.search）。1クエリあたり"""
+    w.ensure_db()
+    index = PhraseIndex(w.db, use_snapshot=False)
+    index.rebuild()
+    start = time.perf_counter()
+    for q in w.queries:
+        index.search(q, limit=5)
+    return (time.perf_counter() - start) / len(w.queries)
+
+def _fuzzy_search(w, fts_min_rows):
+    w.ensure_db()
+    index = PhraseIndex(w.db, use_snapshot=False)
+    index.rebuild()
+    start = time.perf_counter()
+    for q in w.queries:
+        index.search(q, limit=5, exact=False, fts_min_rows=fts_min_rows)
+    return (time.perf_counter() - start) / len(w.queries)
+
+def case_index_search_fts(w):
+    """あいまい検索（完全一致の近道なし）を、行数によらず FTS5 で絞り込んでから。1クエリあたり"""
+    return _fuzzy_search(w, 0)
+
+def case_index_search_full_scan(w):
+    """あいまい検索（完全一致の近道なし）を、FTS5 を使わず全件で。1クエリあたり
+
+    index_search_fts と比べて、search_index.FTS_MIN_ROWS（絞り込みを使い始める行数）を決める。
+    """
+    return _fuzzy_search(w, float("inf"))
+
+def case_index_reverse_search(w):
+    """日本語 → 英語の逆引き（PhraseIndex.reverse_search）。1クエリあたり"""
+    w.ensure_db()
+    index = PhraseIndex(w.db, use_snapshot=False)
+    index.rebuild()
+    index.reverse_search(w.target_queries[0])    # n-gram インデックスの作成は測定に含めない
+    start = time.perf_counter()
+    for q in w.target_queries:
+        index.reverse_search(q, limit=5)
+    return (time.perf_counter() - start) / len(w.target_queries)
+
+def case_load_subs(w):
+    with quiet():
+        start = time.perf_counter()
+        load_subs(w.eng_srt)
+        load_subs(w.jpn_srt)
+        return time.perf_counter() - start
+
+def case_align_subs(w):
+    with quiet():
+        eng, jpn = load_subs(w.eng_srt), load_subs(w.jpn_srt)
+    start = time.perf_counter()
+    align_subs(eng, jpn, verbose=False)
+    return time.perf_counter() - start
+
+def case_merge_csv_files(w):
+    out = os.path.join(w.dir, "merged.csv")
+    with quiet():
+        start = time.perf_counter()
+        ok = merge_dictionaries.merge_csv_files(w.parts, out)
+        elapsed = time.perf_counter() - start
+    if not ok:
+        raise RuntimeError("merge_csv_files に失敗しました")
+    return elapsed
+
+def case_export_csv(w):
+    w.ensure_db()
+    with tempfile.TemporaryFile() as f:
+        start = time.perf_counter()
+        phrase_db.export_phrases(f, "csv", db_path=w.db)
+        return time.perf_counter() - start
+
+CASES = {
+    "import_csv": (case_import_csv, "s"),
+    "load_all_phrases": (case_load_all_phrases, "s"),
+    "extract_full_scan": (case_extract_full_scan, "s/query"),
+    "index_rebuild": (case_index_rebuild, "s"),
+    "index_cold_start": (case_index_cold_start, "s"),
+    "index_search": (case_index_search, "s/query"),
+    "index_search_fts": (case_index_search_fts, "s/query"),
+    "index_search_full_scan": (case_index_search_full_scan, "s/query"),
+    "index_reverse_search": (case_index_reverse_search, "s/query"),
+    "load_subs": (case_load_subs, "s"),
+    "align_subs": (case_align_subs, "s"),
+    "merge_csv_files": (case_merge_csv_files, "s"),
+    "export_csv": (case_export_csv, "s"),
+}
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return ""
+
+def run(scales, cases, repeat=DEFAULT_REPEAT, seed=0, n_queries=DEFAULT_QUERIES, workdir=None):
+    """ベンチマークを実行して結果の dict を返す"""
+    keep = workdir is not None
+    workdir = os.path.abspath(workdir or tempfile.mkdtemp(prefix="phrase_bench_"))
+    os.makedirs(workdir, exist_ok=True)
+    shape = SampleShape()
+    results = {}
+    try:
+        for scale in scales:
+            n = parse_scale(scale)
+            print(f"\n--- {scale}（{n}行） ---")
+            start = time.perf_counter()
+            w = Workload(workdir, n, seed, shape, n_queries)
+            print(f"データ準備: {time.perf_counter() - start:.1f}秒（{w.dir}）")
+            results[scale] = {}
+            for name in cases:
+                func, unit = CASES[name]
+                runs = [func(w) for _ in range(repeat)]
+                results[scale][name] = {"unit": unit, "runs": runs,
+                                        "min": min(runs), "median": statistics.median(runs)}
+                print(f"  {name:<20} 最小 {min(runs):.6f} {unit}  中央値 {statistics.median(runs):.6f} {unit}")
+            w.reset_db()
+    finally:
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "seed": seed,
+            "repeat": repeat,
+            "queries": n_queries,
+        },
+        "results": results,
+    }
+
+def compare(base, current, threshold=DEFAULT_THRESHOLD):
+    """2つの結果を比べて表示する。threshold を超えて遅くなった (規模, 処理) のリストを返す
+
+    ぶれを抑えるため、各処理の最小値どうしを比べる。
+    """
+    regressions = []
+    print(f"{'規模':<6} {'処理':<20} {'基準':>12} {'今回':>12} {'比':>7}")
+    for scale, cases in current["results"].items():
+        for name, cur in cases.items():
+            ref = base["results"].get(scale, {}).get(name)
+            if ref is None:
+                print(f"{scale:<6} {name:<20} {'-':>12} {cur['min']:>12.6f} {'(新規)':>7}")
+                continue
+            ratio = cur["min"] / ref["min"] if ref["min"] > 0 else float("inf")
+            mark = ""
+            if ratio > 1 + threshold:
+                regressions.append((scale, name))
+                mark = "  [遅くなった]"
+            elif ratio < 1 - threshold:
+                mark = "  [速くなった]"
+            print(f"{scale:<6} {name:<20} {ref['min']:>12.6f} {cur['min']:>12.6f} {ratio:>6.2f}x{mark}")
+    return regressions
+
+def parse_options(args, names):
+    """--name value 形式のオプションと、それ以外の引数に分ける"""
+    options, rest = {}, []
+    i = 0
+    while i < len(args):
+        if args[i].startswith("--") and args[i][2:] in names and i + 1 < len(args):
+            options[args[i][2:]] = args[i + 1]
+            i += 2
+        else:
+            rest.append(args[i])
+            i += 1
+    return options, rest
+
+def usage():
+    print("使い方: python -m benchmarks run [--scales 10k,100k,1m] [--cases 名前,...] [--repeat 3]")
+    print("                                [--seed 0] [--queries 200] [--workdir 作業フォルダ] [--out 結果.json]")
+    print("        python -m benchmarks compare <基準.json> <今回.json> [--threshold 0.2]")
+    print("        python -m benchmarks load [--db phrases.db | --scales 10k] [--sessions 1,4,16] [--duration 20]")
+    print("                                 [--think 0.5] [--mix search=60,...] [--lock-wait-ms 1] [--seed 0]")
+    print("                                 [--workdir 作業フォルダ] [--out 結果.json]")
+    print(f"処理: {', '.join(CASES)}")
+    sys.exit(1)
+
+def main(args):
+    if not args or args[0] not in ("run", "compare", "load"):
+        usage()
+
+    if args[0] == "load":
+        load_main(args[1:])
+        return
+
+    if args[0] == "compare":
+        options, rest = parse_options(args[1:], ["threshold"])
+        if len(rest) != 2:
+            usage()
+        with open(rest[0], encoding="utf-8") as f:
+            base = json.load(f)
+        with open(rest[1], encoding="utf-8") as f:
+            current = json.load(f)
+        threshold = float(options.get("threshold", DEFAULT_THRESHOLD))
+        regressions = compare(base, current, threshold)
+        print()
+        if regressions:
+            print(f"[ERROR] {len(regressions)}件の処理が {threshold:.0%} を超えて遅くなりました")
+            sys.exit(1)
+        print(f"[OK] {threshold:.0%} を超えて遅くなった処理はありません")
+        return
+
+    options, rest = parse_options(args[1:], ["scales", "cases", "repeat", "seed", "queries", "workdir", "out"])
+    if rest:
+        usage()
+    scales = options.get("scales", DEFAULT_SCALES).split(",")
+    cases = options["cases"].split(",") if "cases" in options else list(CASES)
+    unknown = [c for c in cases if c not in CASES]
+    if unknown:
+        print(f"[ERROR] 不明な処理です: {', '.join(unknown)}")
+        usage()
+    out = options.get("out", f"bench_{datetime.now():%Y%m%d_%H%M%S}.json")
+
+    print("=" * 60)
+    print("ベンチマーク")
+    print("=" * 60)
+    result = run(scales, cases, int(options.get("repeat", DEFAULT_REPEAT)), int(options.get("seed", 0)),
+                 int(options.get("queries", DEFAULT_QUERIES)), options.get("workdir"))
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    print("\n" + "=" * 60)
+    print("[完了しました！]")
+    print("=" * 60)
+    print(f"結果: {out}")
+    print("=" * 60)
+
+def load_main(args):
+    from benchmarks import load
+
+    options, rest = parse_options(args, ["db", "scales", "sessions", "duration", "think", "mix",
+                                         "lock-wait-ms", "seed", "workdir", "out"])
+    if rest:
+        usage()
+    try:
+        mix = load.parse_mix(options.get("mix", load.DEFAULT_MIX))
+    except ValueError as e:
+        print(f"[ERROR] {e}")
+        usage()
+    seed = int(options.get("seed", 0))
+    sessions = [int(n) for n in options.get("sessions", load.DEFAULT_SESSIONS).split(",")]
+    workdir = options.get("workdir")
+    out = options.get("out", f"load_{datetime.now():%Y%m%d_%H%M%S}.json")
+
+    print("=" * 60)
+    print("負荷試験（同時に使う人数ごとのスループット・ロック待ち）")
+    print("=" * 60)
+    if "db" in options:
+        base_db = os.path.abspath(options["db"])
+        if not os.path.exists(base_db):
+            print(f"[ERROR] データベースが見つかりません: {base_db}")
+            sys.exit(1)
+    else:
+        # 合成データの DB（--workdir があれば使い回す）
+        scale = options.get("scales", "10k").split(",")[0]
+        data_dir = os.path.abspath(workdir or tempfile.mkdtemp(prefix="phrase_bench_"))
+        w = Workload(data_dir, parse_scale(scale), seed, SampleShape(), 0)
+        with quiet():
+            w.ensure_db()
+        close_pool(w.db)
+        base_db = w.db
+    print(f"元の DB: {base_db}")
+    print(f"操作の割合: {', '.join(f'{k}={v:g}' for k, v in mix.items())}・平均の待ち {options.get('think', load.DEFAULT_THINK)}秒")
+
+    results = load.run(base_db, sessions, float(options.get("duration", load.DEFAULT_DURATION)), mix,
+                       float(options.get("think", load.DEFAULT_THINK)), seed,
+                       os.path.join(workdir, "load") if workdir else None,
+                       float(options.get("lock-wait-ms", load.DEFAULT_LOCK_WAIT_MS)))
+    result = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "db": base_db,
+            "seed": seed,
+            "mix": mix,
+            "think": float(options.get("think", load.DEFAULT_THINK)),
+        },
+        "results": results,
+    }
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    print("\n" + "=" * 60)
+    print("[完了しました！]")
+    print("=" * 60)
+    print(f"{'セッション':<10} {'操作/秒':>8} {'search p95 ms':>14} {'ロック待ち':>10} {'エラー':>6}")
+    for n, r in results.items():
+        ops = r["operations"]
+        done = sum(o["ok"] for name, o in ops.items() if name not in load.BACKGROUND)
+        p95 = ops.get("search", {}).get("p95_ms")
+        print(f"{n:<10} {done / r['elapsed']:>8.2f} {p95 if p95 is not None else '-':>14} "
+              f"{sum(sum(o['lock_waits'].values()) for o in ops.values()):>10} "
+              f"{sum(o['errors'] for o in ops.values()):>6}")
+    print(f"結果: {out}")
+    print("=" * 60)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
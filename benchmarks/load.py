@@ -0,0 +1,315 @@
+# benchmarks/load.py
+# 同時に使う人数を増やしたときの負荷試験（phrases.db のコピーに、app.py と同じ関数で読み書きする）
+# 使い方: python -m benchmarks load [--db phrases.db] [--sessions 1,4,16] [--duration 20] ...
+#
+# セッション（翻訳者1人）ごとにスレッドを1つ立て、検索・逆引き・採用・手動登録・CSV アップロードを
+# 重み付きの乱数で選んで繰り返す（操作の間は平均 think 秒の指数分布で待つ）。Streamlit と同じく
+# 1プロセスの中で、接続プール・検索インデックス・バックグラウンドの書き込み（ActivityWriter の flush と
+# 取り込みジョブ）を共有する。
+#
+# 操作ごとに perf_trace で区間を記録し（バックグラウンドの書き込みは本体が記録するものを
+# perf_trace.add_listener で受け取る）、次を集計する:
+#   - 件数・スループット・処理時間の p50 / p95 / p99 / 最大
+#   - ロック待ち: lock_wait_ms 以上待った回数を、SQLite の書き込みロック（BEGIN IMMEDIATE）・
+#     接続プールの空き（pool.wait）・検索インデックスのロック（index.wait）に分けて数える
+#   - エラー（database is locked など）の件数と割合
+# 最後に、採用した回数だけ usage_count が増えているか（書き込みの取りこぼしがないか）を確かめる。
+
+import csv
+import io
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import closing
+
+import perf_trace
+import phrase_db
+import import_jobs
+from phrase_db import TABLE, init_db
+from search_index import get_index, tag_counts
+from activity_writer import LOG_CSV, append_log, get_writer, queue_usage
+from db_connection import close_pool, connection
+from benchmarks.synth import make_queries, make_target_queries
+
+DEFAULT_SESSIONS = "1,4,16"
+DEFAULT_DURATION = 20.0     # 各セッション数で操作を続ける秒数
+DEFAULT_THINK = 0.5         # 操作の間の平均の待ち（秒）。0 なら待たずに続ける
+DEFAULT_MIX = "search=60,reverse=10,adopt=17,upsert=10,upload=3"
+DEFAULT_LOCK_WAIT_MS = 1.0  # これ以上待ったものをロック待ちと数える
+UPLOAD_ROWS = 500           # 1回のアップロードの行数（半分は既存の原文の更新）
+JOB_TIMEOUT = 600           # 終了後に取り込みジョブの完了を待つ上限（秒）
+N_QUERIES = 1000
+BACKGROUND = ["activity.flush", "import_job"]     # ActivityWriter・ImportJobRunner が記録する名前
+
+def parse_mix(text):
+    """'search=60,adopt=20' を {操作: 重み} にする"""
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in Session.OPERATIONS:
+            raise ValueError(f"不明な操作です: {name}（{', '.join(Session.OPERATIONS)}）")
+        mix[name] = float(weight or 1)
+    return mix
+
+def copy_db(src, dst):
+    """src を dst に複製する（WAL の内容も含めて、SQLite のバックアップで写す）"""
+    close_pool(dst)
+    for suffix in ["", "-wal", "-shm"]:
+        if os.path.exists(dst + suffix):
+            os.remove(dst + suffix)
+    with closing(sqlite3.connect(src)) as s, closing(sqlite3.connect(dst)) as d:
+        s.backup(d)
+
+class Workset:
+    """セッションが使う原文・訳・id（元の DB から1回だけ読む）"""
+
+    def __init__(self, db_path, seed=0):
+        df = phrase_db.load_all_phrases(db_path)
+        if df.empty:
+            raise ValueError(f"辞書が空です: {db_path}")
+        self.ids = df["id"].astype(int).tolist()
+        self.sources = df["source"].tolist()
+        self.targets = df["target"].tolist()
+        self.queries = make_queries(df, N_QUERIES, seed)
+        self.target_queries = make_target_queries(df, N_QUERIES, seed)
+
+class LoadRecords:
+    """終わった記録（perf_trace の Trace）のうち、セッションの操作とバックグラウンドの書き込みを集める
+
+    perf_trace.add_listener に渡して使う（直近の分だけを残す perf_trace の記録とは別に、すべて残す）。
+    """
+
+    NAMES = set()     # Session.OPERATIONS + BACKGROUND（Session の定義の後で設定する）
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.items = []
+
+    def __call__(self, trace):
+        if trace.name in self.NAMES:
+            with self._lock:
+                self.items.append(trace)
+
+    @staticmethod
+    def record(name, fn):
+        """fn() を計測しながら実行する（例外は trace.error に残してから投げ直す）"""
+        trace = perf_trace.start(name)
+        try:
+            return fn()
+        except Exception as e:
+            trace.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            perf_trace.finish(trace)
+
+class Session:
+    """翻訳者1人分の操作。app.py の再実行で呼ばれるのと同じ関数を同じ順に呼ぶ"""
+
+    OPERATIONS = ["search", "reverse", "adopt", "upsert", "upload"]
+
+    def __init__(self, n, db_path, work, rng):
+        self.n = n
+        self.user = f"load{n}"
+        self.db_path = db_path
+        self.work = work
+        self.rng = rng
+        self.index = get_index(db_path, TABLE)
+        self.last = []          # 直前の検索結果（採用はこの中から選ぶ）
+        self.adopted = 0
+        self.uploads = 0
+
+    def _rerun(self, query, reverse=False):
+        # 検索欄のタグの選択肢 → インデックスの読み直し → 検索 → 辞書一覧の1ページ目
+        tag_counts(self.db_path)
+        self.index.refresh()
+        if reverse:
+            results = self.index.reverse_search(query, limit=5)
+        else:
+            results = self.index.search(query, limit=5)
+        phrase_db.fetch_page("usage_count", 50, None, db_path=self.db_path)
+        return results
+
+    def search(self):
+        self.last = self._rerun(self.rng.choice(self.work.queries))
+
+    def reverse(self):
+        self.last = self._rerun(self.rng.choice(self.work.target_queries), reverse=True)
+
+    def adopt(self):
+        # app.py の increment_usage と同じ（DB への書き込みはバックグラウンド）
+        pid = int(self.rng.choice(self.last)[0]["id"]) if self.last else self.rng.choice(self.work.ids)
+        queue_usage(pid, self.db_path)
+        self.index.apply_usage(pid)
+        append_log(self.user, "adopt", f"id={pid}", self.db_path)
+        self.adopted += 1
+
+    def upsert(self):
+        # 半分は既存の原文の訳を直し、半分は新しい原文を登録する（app.py の upsert_phrase と同じ）
+        source = self.rng.choice(self.work.sources)
+        if self.rng.random() < 0.5:
+            source = f"{source} ({self.user}-{self.rng.randrange(1_000_000)})"
+        target = self.rng.choice(self.work.targets)
+        pid, created_at = phrase_db.upsert_phrase(source, target, self.user, "", self.db_path)
+        self.index.apply_upsert(pid, source, target, self.user, "", created_at)
+        append_log(self.user, "manual_upsert", f"{source[:50]} -> {target[:50]}", self.db_path)
+
+    def upload(self):
+        self.uploads += 1
+        name = f"{self.user}_{self.uploads}.csv"
+        buf = io.StringIO()
+        w = csv.writer(buf)
+        w.writerow(["source", "target", "context", "tags"])
+        for i in range(UPLOAD_ROWS):
+            source = self.rng.choice(self.work.sources)
+            if i % 2:
+                source = f"{source} ({name}-{i})"
+            w.writerow([source, self.rng.choice(self.work.targets), name, self.user])
+        job_id, created = import_jobs.get_runner(self.db_path).submit(
+            buf.getvalue().encode("utf-8"), name, self.user)
+        if created:
+            append_log(self.user, "upload_csv", f"job={job_id},file={name}", self.db_path)
+
+    def run(self, mix, think, deadline):
+        names, weights = list(mix), list(mix.values())
+        while time.perf_counter() < deadline:
+            name = self.rng.choices(names, weights)[0]
+            try:
+                LoadRecords.record(name, getattr(self, name))
+            except Exception:
+                pass            # 記録済み。止めずに次の操作へ
+            if think > 0:
+                time.sleep(min(self.rng.expovariate(1 / think), max(0.0, deadline - time.perf_counter())))
+
+LoadRecords.NAMES = set(Session.OPERATIONS + BACKGROUND)
+
+def _usage_total(db_path):
+    with connection(db_path) as conn:
+        return conn.execute(f"SELECT COALESCE(SUM(usage_count), 0) FROM {TABLE}").fetchone()[0]
+
+def _wait_for_jobs(runner, timeout=JOB_TIMEOUT):
+    """キューにある取り込みジョブがすべて終わるまで待つ。終わらなかった件数を返す"""
+    end = time.perf_counter() + timeout
+    while True:
+        active = [j for j in runner.recent(limit=1_000_000) if j["status"] in import_jobs.ACTIVE]
+        if not active or time.perf_counter() > end:
+            return len(active)
+        time.sleep(0.2)
+
+LOCK_KINDS = {"pool.wait": "pool", "index.wait": "index"}
+
+def lock_kind(span_, threshold_ms):
+    """ロック待ちの区間なら種類（db / pool / index）を、そうでなければ None を返す"""
+    name, _, elapsed, detail = span_
+    if elapsed * 1000 < threshold_ms:
+        return None
+    if name == "sql":
+        return "db" if detail.upper().startswith("BEGIN IMMEDIATE") else None
+    return LOCK_KINDS.get(name)
+
+def summarize(items, elapsed, lock_wait_ms):
+    """操作ごとの集計 {操作: {...}} とエラーの内訳を返す"""
+    operations, errors = {}, Counter()
+    order = Session.OPERATIONS + BACKGROUND
+    for name in sorted({t.name for t in items}, key=lambda n: order.index(n) if n in order else len(order)):
+        traces = [t for t in items if t.name == name]
+        ok = [t for t in traces if t.error is None]
+        failed = [t.error for t in traces if t.error is not None]
+        waits = Counter()
+        wait_seconds = 0.0
+        for t in traces:
+            for s in t.spans:
+                kind = lock_kind(s, lock_wait_ms)
+                if kind:
+                    waits[kind] += 1
+                    wait_seconds += s[2]
+        row = {"count": len(traces), "ok": len(ok), "errors": len(failed),
+               "error_rate": len(failed) / len(traces), "throughput": len(ok) / elapsed,
+               "lock_waits": {k: waits[k] for k in ["db", "pool", "index"]},
+               "lock_wait_ms": round(wait_seconds * 1000, 2)}
+        total = next((r for r in perf_trace.percentiles(ok) if r["区間"] == perf_trace.TOTAL), None)
+        for p in perf_trace.PERCENTILES:
+            row[f"p{p}_ms"] = total[f"p{p} (ms)"] if total else None
+        row["max_ms"] = round(max(t.duration for t in ok) * 1000, 2) if ok else None
+        operations[name] = row
+        errors.update(f"{name}: {e}" for e in failed)
+    return operations, dict(errors.most_common())
+
+def run_level(base_db, work, sessions, duration, mix, think, seed, level_dir, lock_wait_ms):
+    """sessions 人で duration 秒操作した結果の dict を返す"""
+    os.makedirs(level_dir, exist_ok=True)
+    db_path = os.path.join(level_dir, phrase_db.DB_PATH)
+    copy_db(base_db, db_path)
+    init_db(db_path)
+    get_index(db_path, TABLE).refresh()      # アプリが起動済みの状態から始める
+    # 操作ログの CSV もこの回のフォルダに書く（セッションの append_log も同じ writer を使う）
+    writer = get_writer(db_path, os.path.join(level_dir, LOG_CSV))
+    runner = import_jobs.get_runner(db_path)
+    usage_before = _usage_total(db_path)
+    records = LoadRecords()
+    perf_trace.add_listener(records)
+    try:
+        people = [Session(n, db_path, work, random.Random(seed * 10_007 + n)) for n in range(sessions)]
+        start = time.perf_counter()
+        threads = [threading.Thread(target=s.run, args=(mix, think, start + duration),
+                                    name=f"load-session-{s.n}") for s in people]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        unfinished = _wait_for_jobs(runner)
+        writer.flush()
+
+        adopted = sum(s.adopted for s in people)
+        usage_added = _usage_total(db_path) - usage_before
+    finally:
+        perf_trace.remove_listener(records)
+    operations, errors = summarize(records.items, elapsed, lock_wait_ms)
+    return {"sessions": sessions, "elapsed": elapsed, "operations": operations, "errors": errors,
+            "adopted": adopted, "usage_added": usage_added, "unfinished_jobs": unfinished}
+
+def print_level(result):
+    print(f"\n--- {result['sessions']}セッション（{result['elapsed']:.1f}秒） ---")
+    print(f"{'操作':<14} {'件数':>6} {'/秒':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'最大 ms':>8} "
+          f"{'待ち DB':>7} {'プール':>6} {'索引':>6} {'待ち ms':>8} {'エラー':>6} {'率':>6}")
+    fmt = lambda v: f"{v:>8.1f}" if v is not None else f"{'-':>8}"
+    for name, r in result["operations"].items():
+        print(f"{name:<14} {r['count']:>6} {r['throughput']:>7.2f} {fmt(r['p50_ms'])} {fmt(r['p95_ms'])} "
+              f"{fmt(r['p99_ms'])} {fmt(r['max_ms'])} {r['lock_waits']['db']:>7} {r['lock_waits']['pool']:>6} "
+              f"{r['lock_waits']['index']:>6} {r['lock_wait_ms']:>8.0f} "
+              f"{r['errors']:>6} {r['error_rate']:>6.1%}")
+    for message, count in result["errors"].items():
+        print(f"  [WARN] {count}回: {message[:120]}")
+    if result["usage_added"] != result["adopted"]:
+        print(f"  [ERROR] 採用 {result['adopted']}回に対して usage_count の増加が {result['usage_added']}です")
+    if result["unfinished_jobs"]:
+        print(f"  [WARN] 終わらなかった取り込みジョブ: {result['unfinished_jobs']}件")
+
+def run(base_db, sessions_list, duration=DEFAULT_DURATION, mix=None, think=DEFAULT_THINK, seed=0,
+        workdir=None, lock_wait_ms=DEFAULT_LOCK_WAIT_MS):
+    """セッション数ごとに負荷をかけて、結果の dict（セッション数 → 結果）を返す
+
+    セッション数ごとに base_db を複製し直すので、前の回の書き込みは次の回に影響しない。
+    """
+    mix = mix or parse_mix(DEFAULT_MIX)
+    keep = workdir is not None
+    workdir = os.path.abspath(workdir or tempfile.mkdtemp(prefix="phrase_load_"))
+    work = Workset(base_db, seed)
+    results = {}
+    try:
+        for sessions in sessions_list:
+            result = run_level(base_db, work, sessions, duration, mix, think, seed,
+                               os.path.join(workdir, f"sessions{sessions}"), lock_wait_ms)
+            print_level(result)
+            results[str(sessions)] = result
+            close_pool(os.path.join(workdir, f"sessions{sessions}", phrase_db.DB_PATH))
+    finally:
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
@@ -0,0 +1,105 @@
+# benchmarks/synth.py
+# complete_dictionary.csv の形（単語・文字・長さの分布）をまねた合成データを作る
+# 同じ seed なら同じデータになる
+
+import os
+import re
+import numpy as np
+import pandas as pd
+import srt
+from datetime import timedelta
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_CSV = os.path.join(REPO_ROOT, "complete_dictionary.csv")
+SHOW_TAGS = ["BiKenS6E6", "BiKen5_3_Mech", "BiKenS1E4_Beach", "Lorena", "Phillip", ""]
+
+def parse_scale(text):
+    """'10k' / '100k' / '1m' / '5000' を行数にする"""
+    text = text.strip().lower()
+    unit = {"k": 1_000, "m": 1_000_000}.get(text[-1:], 1)
+    return int(float(text.rstrip("km")) * unit)
+
+class SampleShape:
+    """見本の辞書から語彙と長さの分布を取り出したもの"""
+
+    def __init__(self, sample_csv=SAMPLE_CSV):
+        df = pd.read_csv(sample_csv, encoding="utf-8-sig", dtype=str).fillna("")
+        sources = [s.split() for s in df["source"] if s.strip()]
+        self.words = np.array(sorted({w for s in sources for w in s}))
+        self.word_counts = np.array([len(s) for s in sources])
+        targets = [re.sub(r"\s+", "", t) for t in df["target"] if t.strip()]
+        self.chars = np.array(sorted({c for t in targets for c in t}))
+        self.char_counts = np.array([len(t) for t in targets])
+
+def generate_dictionary(n, seed=0, shape=None):
+    """source / target / context / tags の DataFrame を n 行作る（source は重複なし）"""
+    shape = shape or SampleShape()
+    rng = np.random.default_rng(seed)
+    sources, seen = [], set()
+    while len(sources) < n:
+        need = n - len(sources)
+        lengths = rng.choice(shape.word_counts, size=need)
+        words = rng.choice(shape.words, size=int(lengths.sum()))
+        pos = 0
+        for k in lengths:
+            s = " ".join(words[pos:pos + k])
+            pos += k
+            if s not in seen:
+                seen.add(s)
+                sources.append(s)
+    lengths = rng.choice(shape.char_counts, size=n)
+    chars = rng.choice(shape.chars, size=int(lengths.sum()))
+    bounds = np.concatenate([[0], np.cumsum(lengths)])
+    targets = ["".join(chars[bounds[i]:bounds[i + 1]]) for i in range(n)]
+    seconds = rng.uniform(0, 1800, size=n)
+    contexts = [f"Time: {timedelta(seconds=float(s))}" for s in seconds]
+    tags = rng.choice(SHOW_TAGS, size=n)
+    return pd.DataFrame({"source": sources, "target": targets, "context": contexts, "tags": tags})
+
+def make_queries(df, n, seed=0):
+    """検索用のクエリ。半分は既存の source そのまま、半分は一部の単語を落としたもの"""
+    rng = np.random.default_rng(seed + 1)
+    picked = rng.choice(df["source"].to_numpy(), size=n)
+    queries = []
+    for i, s in enumerate(picked):
+        words = s.split()
+        if i % 2 and len(words) > 2:
+            words.pop(int(rng.integers(len(words))))
+        queries.append(" ".join(words))
+    return queries
+
+def make_target_queries(df, n, seed=0):
+    """逆引き用のクエリ（既存の訳の先頭 2/3）"""
+    rng = np.random.default_rng(seed + 3)
+    return [t[:max(2, len(t) * 2 // 3)] for t in rng.choice(df["target"].to_numpy(), size=n)]
+
+def write_srt_pair(df, eng_path, jpn_path, seed=0):
+    """辞書の行を英語・日本語の SRT の組にする
+
+    日本語は少しずらし、ときどき2行に分けたり欠けたりさせて実際の字幕に近づける。
+    """
+    rng = np.random.default_rng(seed + 2)
+    n = len(df)
+    durations = rng.integers(800, 4000, size=n)
+    gaps = rng.integers(50, 1500, size=n)
+    starts = np.cumsum(gaps + durations) - durations
+    shifts = rng.integers(-200, 200, size=n)
+    kinds = rng.choice(3, size=n, p=[0.85, 0.1, 0.05])   # 0: 1対1, 1: 2行に分割, 2: 欠落
+    eng, jpn = [], []
+    for i, (source, target) in enumerate(zip(df["source"], df["target"])):
+        start, end = int(starts[i]), int(starts[i] + durations[i])
+        eng.append(srt.Subtitle(len(eng) + 1, timedelta(milliseconds=start),
+                                timedelta(milliseconds=end), source))
+        js, je = start + int(shifts[i]), end + int(shifts[i])
+        if kinds[i] == 0:
+            jpn.append((js, je, target))
+        elif kinds[i] == 1 and len(target) > 1:
+            mid = (js + je) // 2
+            jpn.append((js, mid, target[:len(target) // 2]))
+            jpn.append((mid, je, target[len(target) // 2:]))
+    jpn = [srt.Subtitle(k + 1, timedelta(milliseconds=max(0, s)), timedelta(milliseconds=max(1, e)), t)
+           for k, (s, e, t) in enumerate(jpn)]
+    with open(eng_path, "w", encoding="utf-8") as f:
+        f.write(srt.compose(eng, reindex=False))
+    with open(jpn_path, "w", encoding="utf-8") as f:
+        f.write(srt.compose(jpn, reindex=False))
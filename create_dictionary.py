@@ -1,14 +1,114 @@
 # create_dictionary.py
 # HeyGenのSRTファイルから翻訳辞書CSVを自動生成
-# 使い方: python create_dictionary.py <英語SRT> <日本語SRT> [出力CSV]
+# 使い方: python create_dictionary.py <英語SRT> <日本語SRT> [出力CSV] [--tag タグ]
+#         python create_dictionary.py --batch <フォルダ> [出力フォルダ | --db] [--workers N]
+# 一括モードでは各行の tags にエピソード名が入る（--tag を付けると単体モードでも tags を付けられる）
 
 import srt
+import codecs
+from array import array
+import io
+import mmap
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import timedelta
+import numpy as np
 import pandas as pd
+import re
 import sys
 import os
+import time
 
 MIN_OVERLAP = timedelta(milliseconds=100)  # 重なりとみなす最小時間
+MAX_GAP = timedelta(seconds=2)             # 日本語の開始が英語の終了からこれ以上離れたら探索を打ち切る
+MIN_OVERLAP_MS = MIN_OVERLAP // timedelta(milliseconds=1)
+MAX_GAP_MS = MAX_GAP // timedelta(milliseconds=1)
+
+# 一括モードで英語・日本語のSRTを見分けるファイル名の規則（大文字小文字は区別しない）
+#   <名前>_en.srt / <名前>_ja.srt（.en.srt、_eng、_english、_jp、_jpn、_japanese も可）
+#   フォルダごとに english.srt / japanese.srt（名前はフォルダ名）
+ENG_SUFFIX = re.compile(r"[._-](?:en|eng|english)$", re.IGNORECASE)
+JPN_SUFFIX = re.compile(r"[._-](?:ja|jp|jpn|japanese)$", re.IGNORECASE)
+
+DETECT_SAMPLE = 64 * 1024             # 文字コード判定に使う先頭部分のサイズ
+MMAP_THRESHOLD = 16 * 1024 * 1024     # これより大きいファイルは mmap で読む
+
+class SubtitleParseError(ValueError):
+    """SRTの読み取りエラー（ファイル名と行番号付き）"""
+
+def detect_encoding(sample):
+    """BOM、または先頭部分を試しにデコードして文字コードを判定"""
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    # UTF-8 で読めなければ CP932（Shift-JIS の上位互換）
+    for encoding in ['utf-8', 'cp932']:
+        try:
+            # 末尾で文字が途切れていてもエラーにしない
+            codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    raise SubtitleParseError("文字コードを判定できません（UTF-8 / Shift-JIS 以外）")
+
+def _parse_block(block, lineno, name):
+    try:
+        subs = list(srt.parse("".join(block)))
+    except srt.SRTParseError:
+        subs = []
+    if len(subs) != 1:
+        raise SubtitleParseError(f"{name}:{lineno}: 字幕ブロックを解析できません: {block[0].strip()[:40]!r}")
+    return subs[0]
+
+def parse_lines(lines, encoding, name="<srt>"):
+    """バイト列の行を順にデコード・パースして字幕セグメントを1つずつ返す（ジェネレータ）
+
+    空行で区切られたブロックごとに srt.parse するので、ファイル全体を文字列にしない。
+    UTF-8 / CP932 では改行コードが多バイト文字の途中に現れないので、バイトのまま行に分けられる。
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    block, block_line = [], 0
+    for lineno, raw in enumerate(lines, 1):
+        try:
+            line = decoder.decode(raw)
+        except UnicodeDecodeError as e:
+            raise SubtitleParseError(f"{name}:{lineno}: {encoding} として読めません（{e.reason}）")
+        if line.strip():
+            if not block:
+                block_line = lineno
+            block.append(line)
+        elif block:
+            yield _parse_block(block, block_line, name)
+            block = []
+    if block:
+        yield _parse_block(block, block_line, name)
+
+def _iter_file_lines(path):
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                yield from iter(mm.readline, b"")
+        else:
+            yield from f
+
+def open_subs(path):
+    """SRTファイルを開く。(文字コード, 字幕セグメントのジェネレータ) を返す
+
+    ファイルは1回だけ先頭から読む（大きいファイルは mmap）。
+    読み取りエラーは SubtitleParseError（行番号付き）として、読み進めた時点で発生する。
+    """
+    with open(path, "rb") as f:
+        sample = f.read(DETECT_SAMPLE)
+    encoding = detect_encoding(sample)
+    return encoding, parse_lines(_iter_file_lines(path), encoding, path)
+
+def iter_subs(path):
+    """SRTファイルの字幕セグメントを1つずつ返す（ジェネレータ）"""
+    return open_subs(path)[1]
+
+def parse_subs(data, name="<srt>"):
+    """SRTのバイト列をパースする（アップロードされたファイル用）。(セグメントのリスト, 文字コード) を返す"""
+    encoding = detect_encoding(data[:DETECT_SAMPLE])
+    return list(parse_lines(io.BytesIO(data), encoding, name)), encoding
 
 def load_subs(path):
     """SRTファイルを読み込む"""
@@ -16,21 +116,14 @@ def load_subs(path):
         print(f"[ERROR] ファイルが見つかりません: {path}")
         sys.exit(1)
     
-    # BOM付きUTF-8、UTF-8、Shift-JIS、CP932を試す
-    encodings = ['utf-8-sig', 'utf-8', 'shift_jis', 'cp932']
-    
-    for encoding in encodings:
-        try:
-            with open(path, "r", encoding=encoding) as f:
-                txt = f.read()
-            subs = list(srt.parse(txt))
-            print(f"[OK] {path} を読み込みました（{len(subs)}セグメント, {encoding}）")
-            return subs
-        except (UnicodeDecodeError, Exception):
-            continue
-    
-    print(f"[ERROR] {path} の読み取りに失敗しました")
-    sys.exit(1)
+    try:
+        encoding, segments = open_subs(path)
+        subs = list(segments)
+    except SubtitleParseError as e:
+        print(f"[ERROR] {path} の読み取りに失敗しました: {e}")
+        sys.exit(1)
+    print(f"[OK] {path} を読み込みました（{len(subs)}セグメント, {encoding}）")
+    return subs
 
 def overlap(a_start, a_end, b_start, b_end):
     """2つの時間範囲が重なっているかチェック"""
@@ -42,74 +135,304 @@ def normalize_text(t: str) -> str:
     """テキストを正規化（改行をスペースに、前後の空白を削除）"""
     return " ".join(t.replace("\r","").split())
 
-def align_subs(eng_subs, jpn_subs):
-    """英語と日本語の字幕を時間で突合"""
-    pairs = []
+def collect_segments(subs):
+    """字幕セグメント（リストまたはジェネレータ）を1回だけ読み、
+    開始・終了時刻（ミリ秒の整数配列）と正規化済みテキストのリストにする"""
+    one = timedelta(milliseconds=1)
+    starts, ends, texts = array("q"), array("q"), []
+    for s in subs:
+        starts.append(s.start // one)
+        ends.append(s.end // one)
+        texts.append(normalize_text(s.content))
+    return np.frombuffer(starts, dtype=np.int64), np.frombuffer(ends, dtype=np.int64), texts
+
+def ms_to_str(ms):
+    """ミリ秒を str(timedelta) と同じ表記にする（例: 0:00:01.500000）"""
+    return str(timedelta(milliseconds=ms))
+
+def overlap_edges(es, ee, js, je):
+    """英語 i と日本語 k が MIN_OVERLAP 以上重なる組 (i, k) をすべて求める（js は開始時刻順）
+
+    各英語について、重なりうる日本語の範囲を searchsorted でまとめて求め、
+    その範囲の候補だけを一度に比較する。i の昇順・同じ i では k の昇順で返す。
+    """
+    if len(es) == 0 or len(js) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    # 終了時刻の累積最大値（単調増加）：これが英語の開始 + MIN_OVERLAP 未満の日本語は重ならない
+    je_max = np.maximum.accumulate(je)
+    lo = np.searchsorted(je_max, es + MIN_OVERLAP_MS, "left")
+    hi = np.searchsorted(js, ee - MIN_OVERLAP_MS, "right")
+    counts = np.clip(hi - lo, 0, None)
+    i = np.repeat(np.arange(len(es)), counts)
+    offsets = np.cumsum(counts) - counts
+    k = lo[i] + np.arange(len(i)) - offsets[i]
+    ov = np.minimum(ee[i], je[k]) - np.maximum(es[i], js[k])
+    keep = ov >= MIN_OVERLAP_MS
+    return i[keep], k[keep]
+
+def _split_by_eng(n, i, k):
+    """(i, k) の組を英語ごとの日本語 index のリストに分ける"""
+    bounds = np.searchsorted(i, np.arange(n + 1))
+    k = k.tolist()
+    return [k[bounds[x]:bounds[x + 1]] for x in range(n)]
+
+def match_segments(es, ee, js, je):
+    """英語の各セグメントに重なる日本語の index のリストを返す
+
+    従来どおり、一度使った日本語より前には戻らない（カーソル方式）。
+    カーソルは「それまでの英語に重なった日本語の最大 index + 1」なので、
+    重なりをまとめて求めたあと累積最大値で一度に絞り込める。
+    """
+    n = len(es)
+    if len(js) < 2 or bool(np.all(js[1:] >= js[:-1])):
+        i, k = overlap_edges(es, ee, js, je)
+        k_max = np.full(n, -1, dtype=np.int64)
+        np.maximum.at(k_max, i, k)
+        cursor = np.concatenate([[0], np.maximum.accumulate(k_max)[:-1] + 1]) if n else k_max
+        keep = k >= cursor[i]
+        return _split_by_eng(n, i[keep], k[keep])
+
+    # 開始時刻順に並んでいない場合は従来と同じ順に走査する
+    matches = []
     j_idx = 0
+    for x in range(n):
+        found = []
+        for y in range(j_idx, len(js)):
+            if min(ee[x], je[y]) - max(es[x], js[y]) >= MIN_OVERLAP_MS:
+                found.append(y)
+            if js[y] > ee[x] + MAX_GAP_MS:
+                break
+        matches.append(found)
+        if found:
+            j_idx = found[-1] + 1
+    return matches
+
+def group_segments(es, ee, js, je):
+    """多対多の突合：同じ日本語に重なる連続した英語をまとめる
+
+    [(英語 index のリスト, 日本語 index のリスト), ...] を返す（日本語は開始時刻順）。
+    """
+    order = np.argsort(js, kind="stable")
+    matches = _split_by_eng(len(es), *overlap_edges(es, ee, js[order], je[order]))
+    groups = []
+    for x, found in enumerate(matches):
+        if found and groups and groups[-1][1] and found[0] <= groups[-1][1][-1]:
+            e_idx, j_set = groups[-1]
+            e_idx.append(x)
+            groups[-1] = (e_idx, sorted(set(j_set).union(found)))
+        else:
+            groups.append(([x], found))
+    return [(e_idx, order[j_set].tolist()) for e_idx, j_set in groups]
+
+def overlap_ratio(e_start, e_end, j_starts, j_ends):
+    """英語の区間と日本語の区間がどれだけ重なっているか（0〜1）"""
+    if not j_starts:
+        return 0.0
+    inter = sum(max(0, min(e_end, b) - max(e_start, a)) for a, b in zip(j_starts, j_ends))
+    union = max(e_end, max(j_ends)) - min(e_start, min(j_starts))
+    return round(min(inter / union, 1.0), 3) if union > 0 else 0.0
+
+def align_subs(eng_subs, jpn_subs, group=False, scores=False, verbose=True, tags=""):
+    """英語と日本語の字幕を時間で突合
+
+    字幕はリストでも iter_subs のジェネレータでもよい（それぞれ1回だけ読む）。
+    時刻はミリ秒の整数配列にしてから比較する。
+    group=True で同じ日本語に重なる英語の行をまとめ（多対多）、
+    scores=True で各行に overlap_ratio（重なりの割合）を追加する。
+    tags を渡すと各行の tags に入れる（エピソード名・ファイル名など。カンマ区切りで複数可）。
+    """
+    es, ee, e_text = collect_segments(eng_subs)
+    js, je, j_text = collect_segments(jpn_subs)
+    if group:
+        groups = group_segments(es, ee, js, je)
+    else:
+        groups = list(zip(([i] for i in range(len(es))), match_segments(es, ee, js, je)))
+    es, ee, js, je = es.tolist(), ee.tolist(), js.tolist(), je.tolist()
+
+    pairs = []
     matched_count = 0
+    step = max(1, len(groups) // 10)
     
-    for i, e in enumerate(eng_subs):
-        matched_texts = []
-        matched_j_indices = []
-        
-        # 日本語字幕を探す
-        for k in range(j_idx, len(jpn_subs)):
-            j = jpn_subs[k]
-            if overlap(e.start, e.end, j.start, j.end):
-                matched_texts.append(normalize_text(j.content))
-                matched_j_indices.append(k)
-            # 日本語の開始時間が英語の終了時間より大きく離れていたらスキップ
-            if j.start > e.end + timedelta(seconds=2):
-                break
-        
-        source_text = normalize_text(e.content)
+    for n, (e_idx, j_idx) in enumerate(groups):
+        first, last = e_idx[0], e_idx[-1]
+        if len(e_idx) == 1:
+            source_text = e_text[first]
+        else:
+            source_text = " ".join(e_text[i] for i in e_idx)
+        eng_start = ms_to_str(es[first])
         
-        if matched_texts:
-            target_text = " ".join(matched_texts)
-            pairs.append({
+        if j_idx:
+            target_text = " ".join(j_text[k] for k in j_idx)
+            row = {
                 "source": source_text,
                 "target": target_text,
-                "context": f"Time: {e.start}",
-                "tags": "",
-                "eng_start": str(e.start),
-                "eng_end": str(e.end),
-                "jpn_start": str(jpn_subs[matched_j_indices[0]].start) if matched_j_indices else "",
-                "jpn_end": str(jpn_subs[matched_j_indices[-1]].end) if matched_j_indices else ""
-            })
+                "context": f"Time: {eng_start}",
+                "tags": tags,
+                "eng_start": eng_start,
+                "eng_end": ms_to_str(ee[last]),
+                "jpn_start": ms_to_str(js[j_idx[0]]),
+                "jpn_end": ms_to_str(je[j_idx[-1]])
+            }
             matched_count += 1
-            # 次は最後に使った日本語の次から
-            if matched_j_indices:
-                j_idx = matched_j_indices[-1] + 1
         else:
             # マッチしなかった場合も記録（後で手動確認用）
-            pairs.append({
+            row = {
                 "source": source_text,
                 "target": "[要確認]",
-                "context": f"Time: {e.start} (マッチなし)",
-                "tags": "unmatched",
-                "eng_start": str(e.start),
-                "eng_end": str(e.end),
+                "context": f"Time: {eng_start} (マッチなし)",
+                "tags": ",".join(t for t in [tags, "unmatched"] if t),
+                "eng_start": eng_start,
+                "eng_end": ms_to_str(ee[last]),
                 "jpn_start": "",
                 "jpn_end": ""
-            })
+            }
+        if scores:
+            row["overlap_ratio"] = overlap_ratio(es[first], ee[last],
+                                                 [js[k] for k in j_idx], [je[k] for k in j_idx])
+        pairs.append(row)
         
         # 進捗表示（10%ごと）
-        if (i + 1) % max(1, len(eng_subs) // 10) == 0:
-            progress = (i + 1) / len(eng_subs) * 100
+        if verbose and (n + 1) % step == 0:
+            progress = (n + 1) / len(groups) * 100
             print(f"処理中... {progress:.0f}%")
     
     return pairs, matched_count
 
+def find_srt_pairs(root):
+    """フォルダ以下から英語・日本語のSRTの組を探す。[(名前, 英語パス, 日本語パス), ...] を返す"""
+    pairs = []
+    for dirpath, _, filenames in os.walk(root):
+        eng, jpn = {}, {}
+        for fn in filenames:
+            stem, ext = os.path.splitext(fn)
+            if ext.lower() != ".srt":
+                continue
+            if stem.lower() == "english":
+                eng[os.path.basename(dirpath)] = fn
+            elif stem.lower() == "japanese":
+                jpn[os.path.basename(dirpath)] = fn
+            elif ENG_SUFFIX.search(stem):
+                eng[ENG_SUFFIX.sub("", stem)] = fn
+            elif JPN_SUFFIX.search(stem):
+                jpn[JPN_SUFFIX.sub("", stem)] = fn
+        for name in sorted(eng.keys() & jpn.keys()):
+            pairs.append((name, os.path.join(dirpath, eng[name]), os.path.join(dirpath, jpn[name])))
+    return pairs
+
+def process_pair(name, eng_path, jpn_path):
+    """1エピソード分を読み込んで突合する（ProcessPoolExecutor のワーカーで実行）"""
+    # ワーカー内で sys.exit しないよう、load_subs ではなく iter_subs を使う（エラーは例外）
+    pairs, matched_count = align_subs(iter_subs(eng_path), iter_subs(jpn_path), verbose=False, tags=name)
+    return name, pairs, matched_count
+
+def run_batch(root, out_dir=None, to_db=False, workers=None):
+    """フォルダ内のSRTの組を並列に突合し、エピソードごとのCSVまたはDBに書き込む"""
+    import phrase_db
+    from db_connection import connection
+
+    found = find_srt_pairs(root)
+    if not found:
+        print(f"[ERROR] {root} に英語・日本語のSRTの組が見つかりません")
+        sys.exit(1)
+    print(f"[OK] {len(found)}組のSRTが見つかりました")
+    if to_db:
+        phrase_db.init_db(phrase_db.DB_PATH)
+    elif out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    results, failed = [], []
+    db_counts = {"inserted": 0, "updated": 0, "skipped": 0}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(process_pair, *args): args[0] for args in found}
+        for n, future in enumerate(as_completed(futures), 1):
+            name = futures[future]
+            # 書き込みの失敗もそのエピソードだけの失敗として数え、残りの処理は続ける
+            try:
+                _, pairs, matched_count = future.result()
+                df = pd.DataFrame(pairs)
+                if to_db:
+                    # 書き込みは親プロセスだけで行う（SQLite の書き込みは1つずつ）
+                    # フレーズが1件もないエピソード（空の SRT など）は書き込むものがない
+                    if pairs:
+                        clean, skipped = phrase_db.clean_chunk(df)
+                        with connection(phrase_db.DB_PATH) as conn:
+                            inserted, updated = phrase_db.bulk_upsert(conn, clean)
+                        db_counts["inserted"] += inserted
+                        db_counts["updated"] += updated
+                        db_counts["skipped"] += skipped
+                else:
+                    out_csv = os.path.join(out_dir or root, f"{name}_dictionary.csv")
+                    df.to_csv(out_csv, index=False, encoding="utf-8-sig")  # Excel対応のためBOM付き
+            except Exception as e:
+                failed.append(name)
+                print(f"[{n}/{len(found)}] [ERROR] {name}: {e}")
+                continue
+            rate = (matched_count / len(pairs) * 100) if pairs else 0
+            results.append((name, len(pairs), matched_count))
+            print(f"[{n}/{len(found)}] {name}: {matched_count}/{len(pairs)} マッチ ({rate:.1f}%)")
+    elapsed = time.perf_counter() - start
+
+    total = sum(r[1] for r in results)
+    matched = sum(r[2] for r in results)
+    match_rate = (matched / total * 100) if total > 0 else 0
+    print("\n" + "=" * 60)
+    print("[完成しました！]")
+    print("=" * 60)
+    print(f"処理したエピソード: {len(results)}件（失敗: {len(failed)}件）")
+    print(f"総フレーズ数: {total}")
+    print(f"マッチ成功: {matched} ({match_rate:.1f}%)")
+    low = sorted(results, key=lambda r: r[2] / r[1] if r[1] else 0)[:5]
+    if low:
+        print("マッチ率の低いエピソード:")
+        for name, n_pairs, n_matched in low:
+            print(f"   {name}: {(n_matched / n_pairs * 100) if n_pairs else 0:.1f}%")
+    if to_db:
+        print(f"DB 新規追加: {db_counts['inserted']}件 / 更新: {db_counts['updated']}件 / "
+              f"スキップ: {db_counts['skipped']}件")
+    print(f"処理時間: {elapsed:.1f}秒")
+    print("=" * 60)
+
+def batch_main(args):
+    """--batch <フォルダ> [出力フォルダ | --db] [--workers N]"""
+    workers = None
+    if "--workers" in args:
+        i = args.index("--workers")
+        workers = int(args[i + 1])
+        args = args[:i] + args[i + 2:]
+    to_db = "--db" in args
+    args = [a for a in args if a != "--db"]
+    if not args:
+        print("使い方: python create_dictionary.py --batch <フォルダ> [出力フォルダ | --db] [--workers N]")
+        sys.exit(1)
+
+    print("=" * 60)
+    print("HeyGen SRT -> 翻訳辞書 変換ツール（一括モード）")
+    print("=" * 60)
+    run_batch(args[0], args[1] if len(args) > 1 else None, to_db, workers)
+
 def main():
     # コマンドライン引数を取得
-    if len(sys.argv) < 3:
-        print("使い方: python create_dictionary.py <英語SRT> <日本語SRT> [出力CSV]")
+    if len(sys.argv) > 1 and sys.argv[1] == "--batch":
+        batch_main(sys.argv[2:])
+        return
+    args = sys.argv[1:]
+    tags = ""
+    if "--tag" in args:
+        i = args.index("--tag")
+        tags = args[i + 1]
+        args = args[:i] + args[i + 2:]
+    if len(args) < 2:
+        print("使い方: python create_dictionary.py <英語SRT> <日本語SRT> [出力CSV] [--tag タグ]")
+        print("       python create_dictionary.py --batch <フォルダ> [出力フォルダ | --db] [--workers N]")
         print("例: python create_dictionary.py english.srt japanese.srt pairs.csv")
+        print("例: python create_dictionary.py english.srt japanese.srt pairs.csv --tag BiKenS6E6")
+        print("例: python create_dictionary.py --batch episodes --db")
         sys.exit(1)
     
-    eng_path = sys.argv[1]
-    jpn_path = sys.argv[2]
-    out_csv = sys.argv[3] if len(sys.argv) > 3 else "pairs.csv"
+    eng_path = args[0]
+    jpn_path = args[1]
+    out_csv = args[2] if len(args) > 2 else "pairs.csv"
     
     print("=" * 60)
     print("HeyGen SRT -> 翻訳辞書 変換ツール")
@@ -120,7 +443,7 @@ def main():
     jpn_subs = load_subs(jpn_path)
     
     print(f"\n字幕を突合しています...")
-    pairs, matched_count = align_subs(eng_subs, jpn_subs)
+    pairs, matched_count = align_subs(eng_subs, jpn_subs, tags=tags)
     
     # DataFrameを作成してCSVに保存
     df = pd.DataFrame(pairs)
@@ -0,0 +1,113 @@
+# db_connection.py
+# SQLite 接続の共通設定とプロセス内の接続プール
+# Streamlit の再実行・セッション間で接続を使い回し、WAL で読み込みが書き込みを待たないようにする
+
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from perf_trace import TracedLock, sql_span
+
+POOL_SIZE = 8                    # 1つのDBに対して同時に使う接続の上限
+BUSY_TIMEOUT_MS = 5000           # ロック中に待つ時間
+MMAP_SIZE = 256 * 1024 * 1024    # 読み込みに使うメモリマップのサイズ
+CACHED_STATEMENTS = 256          # 接続ごとのプリペアドステートメントのキャッシュ数
+
+class TracedCursor(sqlite3.Cursor):
+    """実行した SQL 文の時間を perf_trace に記録するカーソル（pd.read_sql_query もこれを使う）"""
+
+    def execute(self, sql, parameters=()):
+        with sql_span(sql):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        with sql_span(sql):
+            return super().executemany(sql, seq_of_parameters)
+
+class TracedConnection(sqlite3.Connection):
+    """conn.execute() などで実行した SQL 文の時間も記録する接続"""
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        with sql_span(sql):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        with sql_span(sql):
+            return super().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        with sql_span(sql_script):
+            return super().executescript(sql_script)
+
+def connect(db_path):
+    """PRAGMA を設定した新しい接続を返す（プールを使わない場合用）"""
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_MS / 1000, factory=TracedConnection,
+                           check_same_thread=False, cached_statements=CACHED_STATEMENTS)
+    # WAL：読み込みは書き込み中でもブロックされない（設定はDBファイルに保存される）
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+class ConnectionPool:
+    """スレッドセーフな接続プール
+
+    with pool.connection() as conn: で借りて、ブロックを抜けると返却される。
+    未コミットのまま返却されたトランザクションはロールバックする。
+    """
+
+    def __init__(self, db_path, size=POOL_SIZE):
+        self.db_path = db_path
+        self._idle = queue.LifoQueue()
+        # 空きを待たされた時間は pool.wait として記録する（同時に使う人が増えたときの確認用）
+        self._slots = TracedLock(threading.BoundedSemaphore(size), "pool.wait")
+
+    @contextmanager
+    def connection(self):
+        with self._slots:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = connect(self.db_path)
+            try:
+                yield conn
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+                self._idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(db_path):
+    """db_path ごとに1つの ConnectionPool を返す"""
+    key = os.path.abspath(db_path)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(db_path)
+    return pool
+
+def close_pool(db_path):
+    """db_path のプールを閉じて破棄する（DBファイルを削除・置き換える前に呼ぶ）"""
+    with _pools_lock:
+        pool = _pools.pop(os.path.abspath(db_path), None)
+    if pool is not None:
+        pool.close()
+
+def connection(db_path):
+    """プールから接続を借りる: with connection(DB_PATH) as conn: ..."""
+    return get_pool(db_path).connection()
@@ -0,0 +1,287 @@
+# dedupe.py
+# ほぼ同じ原文（句読点・大文字小文字・つなぎ言葉だけが違うもの）をまとめる
+# 使い方: python dedupe.py [--threshold 90] [--report 候補CSV] [--apply]
+#         python dedupe.py --confirm 候補CSV
+#
+# 例: "Let's go!" / "let's go" / "Let's go." → 使用回数の多い1件に統合し、残りは別表記（phrase_aliases）にする
+# --apply を付けなければ統合の候補を表示・出力するだけ。
+#
+# 自動で統合する（--apply・import_csv の dedupe_threshold）のは、まとめ方のキーが完全に同じものだけ。
+# しきい値を下げて見つかるあいまいな候補（"Is he here?" / "Is she here?" のように意味が違うものも入る）は
+# 候補として出力するだけにして、--report の CSV を確認・不要な行を削除してから --confirm で統合する。
+
+import csv
+import json
+import os
+import sys
+from collections import Counter, defaultdict
+from datetime import datetime
+import numpy as np
+from rapidfuzz import process, fuzz
+from rapidfuzz.utils import default_process
+from db_connection import connection
+
+DB_PATH = "phrases.db"
+TABLE = "phrases"
+ALIAS_TABLE = "phrase_aliases"
+DEFAULT_THRESHOLD = 100      # まとめ方のキー同士の fuzz.ratio がこれ以上なら候補にする（100 = キーが同じものだけ）
+BLOCK_WORDS = 2              # 各行を、珍しい単語の上位いくつのブロックに入れるか
+MAX_CELLS = 20_000_000       # process.cdist で一度に作る行列の最大要素数
+# 意味を変えないつなぎ言葉（まとめ方のキーから除く）
+FILLER_WORDS = {"oh", "uh", "um", "uhm", "ah", "er", "erm", "hmm", "mm", "huh", "eh"}
+
+def dedupe_key(text) -> str:
+    """まとめ方のキー（小文字化・記号除去・つなぎ言葉の除去）"""
+    return " ".join(w for w in default_process(str(text)).split() if w not in FILLER_WORDS)
+
+def ensure_alias_table(conn):
+    """別表記のテーブルを作成（init_db から呼ぶ）"""
+    conn.executescript(f"""
+    CREATE TABLE IF NOT EXISTS {ALIAS_TABLE} (
+        alias TEXT PRIMARY KEY,
+        phrase_id INTEGER NOT NULL,
+        target TEXT,                -- 統合前の訳（参考用）
+        score REAL,
+        created_at TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_{ALIAS_TABLE}_phrase_id ON {ALIAS_TABLE}(phrase_id);
+    """)
+    conn.commit()
+
+def resolve_aliases(conn, sources, targets=None):
+    """別表記になっている原文を、統合先の原文に置き換える対応表 {別表記: 統合先} を返す
+
+    targets（sources と同じ順の訳）を渡すと、訳が統合先の訳と同じものだけを置き換える。
+    訳が違うものは統合先を上書きしないよう、別表記の原文のまま（新しい行として）登録させる。
+    別表記の原文がすでに自分の行を持っている場合も置き換えない。
+    """
+    targets = [None] * len(sources) if targets is None else list(targets)
+    rows = conn.execute(f"""
+        SELECT a.alias, p.source
+        FROM json_each(?) AS j
+        JOIN {ALIAS_TABLE} AS a ON a.alias = json_extract(j.value, '$[0]')
+        JOIN {TABLE} AS p ON p.id = a.phrase_id
+        WHERE (json_extract(j.value, '$[1]') IS NULL OR p.target = json_extract(j.value, '$[1]'))
+          AND NOT EXISTS (SELECT 1 FROM {TABLE} AS q WHERE q.source = a.alias)
+    """, (json.dumps([[s, t] for s, t in zip(sources, targets)], ensure_ascii=False),)).fetchall()
+    return dict(rows)
+
+class _UnionFind:
+    def __init__(self, n):
+        self.parent = list(range(n))
+
+    def find(self, i):
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a != b:
+            self.parent[max(a, b)] = min(a, b)
+
+def find_clusters(sources, threshold=DEFAULT_THRESHOLD):
+    """近い原文のまとまりを探す。位置のリストのリスト（2件以上のものだけ）を返す
+
+    1. まとめ方のキーが完全に同じものをまとめる
+    2. キーごとの代表を、その中で一番珍しい単語（上位 BLOCK_WORDS 個）でブロックに分け、
+       ブロック内だけ process.cdist で比べる（全件どうしは比べない）
+    """
+    keys = [dedupe_key(s) for s in sources]
+    uf = _UnionFind(len(keys))
+    first = {}
+    for i, k in enumerate(keys):
+        if k:
+            uf.union(first.setdefault(k, i), i)
+
+    if threshold < 100:
+        reps = list(first.values())
+        df = Counter(w for i in reps for w in set(keys[i].split()))
+        blocks = defaultdict(list)
+        for i in reps:
+            for w in sorted(set(keys[i].split()), key=lambda w: (df[w], w))[:BLOCK_WORDS]:
+                blocks[w].append(i)
+        for members in blocks.values():
+            if len(members) < 2:
+                continue
+            choices = [keys[i] for i in members]
+            chunk = max(1, MAX_CELLS // len(members))
+            for start in range(0, len(members), chunk):
+                scores = process.cdist(choices[start:start + chunk], choices, scorer=fuzz.ratio,
+                                       processor=None, score_cutoff=threshold, dtype=np.uint8, workers=-1)
+                for r, c in zip(*np.nonzero(scores)):
+                    uf.union(members[start + r], members[c])
+
+    clusters = defaultdict(list)
+    for i in range(len(keys)):
+        if keys[i]:
+            clusters[uf.find(i)].append(i)
+    return [c for c in clusters.values() if len(c) > 1]
+
+def load_clusters(conn, threshold=DEFAULT_THRESHOLD, ids=None):
+    """DB の phrases から統合候補を作る
+
+    [{"canonical": 行, "members": [行, ...]}, ...] を返す（行は id / source / target / usage_count の dict）。
+    統合先は使用回数が一番多いもの（同じなら id の小さい＝先に登録されたもの）。
+    ids を渡すと、その id を含むまとまりだけを返す（取り込んだ分だけ調べる場合）。
+    """
+    rows = [dict(zip(["id", "source", "target", "usage_count"], r)) for r in
+            conn.execute(f"SELECT id, source, target, COALESCE(usage_count, 0) FROM {TABLE}")]
+    out = []
+    for cluster in find_clusters([r["source"] for r in rows], threshold):
+        members = sorted((rows[i] for i in cluster), key=lambda r: (-r["usage_count"], r["id"]))
+        if ids is not None and not any(r["id"] in ids for r in members):
+            continue
+        out.append({"canonical": members[0], "members": members[1:]})
+    return out
+
+def exact_clusters(clusters):
+    """まとまりを、まとめ方のキーが完全に同じものどうしに分け直す（2件以上のものだけ）
+
+    統合先と訳が違うものは入れない（別の訳を別表記にして消さないよう、確認してから --confirm で統合する）。
+    """
+    out = []
+    for c in clusters:
+        groups = defaultdict(list)
+        for r in [c["canonical"]] + c["members"]:
+            groups[dedupe_key(r["source"])].append(r)
+        for rows in groups.values():
+            rows.sort(key=lambda r: (-r["usage_count"], r["id"]))
+            members = [r for r in rows[1:] if r["target"] == rows[0]["target"]]
+            if members:
+                out.append({"canonical": rows[0], "members": members})
+    return out
+
+def load_report(conn, path):
+    """write_report の CSV（確認して不要な行を消したもの）から統合するまとまりを作る
+
+    行は今の DB から読み直す（削除済みの id は無視する）。canonical の行がないまとまりは飛ばす。
+    """
+    roles = defaultdict(dict)
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        for r in csv.DictReader(f):
+            roles[r["cluster"]][int(r["id"])] = r["role"]
+    ids = [i for c in roles.values() for i in c]
+    rows = {r[0]: dict(zip(["id", "source", "target", "usage_count"], r)) for r in conn.execute(
+        f"SELECT id, source, target, COALESCE(usage_count, 0) FROM {TABLE} "
+        f"WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(ids),))}
+    out = []
+    for c in roles.values():
+        canon = [rows[i] for i, role in c.items() if role == "canonical" and i in rows]
+        members = [rows[i] for i, role in c.items() if role == "alias" and i in rows]
+        if len(canon) == 1 and members:
+            out.append({"canonical": canon[0], "members": members})
+    return out
+
+def apply_clusters(conn, clusters, confirmed=False):
+    """統合を実行（1トランザクション）。統合先に使用回数を合算し、残りは別表記にして削除する
+
+    confirmed=False（自動で統合する場合）は、まとめ方のキーが完全に同じで訳も同じものだけを統合する。
+    あいまいな候補は、人が確認したもの（load_report）を confirmed=True で渡したときだけ統合する。
+    別表記にした件数を返す。
+    """
+    if not confirmed:
+        clusters = exact_clusters(clusters)
+    now = datetime.utcnow().isoformat()
+    merged = 0
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        for c in clusters:
+            canon, members = c["canonical"], c["members"]
+            key = dedupe_key(canon["source"])
+            ids = [m["id"] for m in members]
+            conn.executemany(
+                f"INSERT OR REPLACE INTO {ALIAS_TABLE}(alias, phrase_id, target, score, created_at) "
+                f"VALUES (?,?,?,?,?)",
+                [(m["source"], canon["id"], m["target"], fuzz.ratio(dedupe_key(m["source"]), key), now)
+                 for m in members])
+            # 削除する行を指していた別表記も統合先に付け替える
+            conn.executemany(f"UPDATE {ALIAS_TABLE} SET phrase_id = ? WHERE phrase_id = ?",
+                             [(canon["id"], i) for i in ids])
+            conn.execute(f"UPDATE {TABLE} SET usage_count = COALESCE(usage_count, 0) + ? WHERE id = ?",
+                         (sum(m["usage_count"] for m in members), canon["id"]))
+            conn.executemany(f"DELETE FROM {TABLE} WHERE id = ?", [(i,) for i in ids])
+            merged += len(members)
+    return merged
+
+def write_report(clusters, path):
+    """統合候補を CSV に書き出す（Excel対応のためBOM付き）"""
+    with open(path, "w", newline="", encoding="utf-8-sig") as f:
+        w = csv.writer(f)
+        w.writerow(["cluster", "role", "id", "source", "target", "usage_count"])
+        for n, c in enumerate(clusters, 1):
+            w.writerow([n, "canonical"] + [c["canonical"][k] for k in ["id", "source", "target", "usage_count"]])
+            for m in c["members"]:
+                w.writerow([n, "alias"] + [m[k] for k in ["id", "source", "target", "usage_count"]])
+
+def dedupe(db_path=DB_PATH, threshold=DEFAULT_THRESHOLD, apply=False, ids=None):
+    """統合候補を探し、apply=True なら統合する。(候補のリスト, 別表記にした件数) を返す"""
+    with connection(db_path) as conn:
+        clusters = load_clusters(conn, threshold, ids)
+        merged = apply_clusters(conn, clusters) if apply and clusters else 0
+    return clusters, merged
+
+def confirm(db_path, report):
+    """確認済みの候補 CSV のとおりに統合する。(まとまりのリスト, 別表記にした件数) を返す"""
+    with connection(db_path) as conn:
+        clusters = load_report(conn, report)
+        merged = apply_clusters(conn, clusters, confirmed=True) if clusters else 0
+    return clusters, merged
+
+def main(args):
+    threshold = DEFAULT_THRESHOLD
+    report = None
+    apply = "--apply" in args
+    if "--threshold" in args:
+        threshold = float(args[args.index("--threshold") + 1])
+    if "--report" in args:
+        report = args[args.index("--report") + 1]
+
+    print("=" * 60)
+    print("重複フレーズの統合ツール")
+    print("=" * 60)
+
+    if not os.path.exists(DB_PATH):
+        print(f"[ERROR] データベースが見つかりません: {DB_PATH}")
+        sys.exit(1)
+    import phrase_db
+    phrase_db.init_db(DB_PATH)
+
+    if "--confirm" in args:
+        path = args[args.index("--confirm") + 1]
+        if not os.path.exists(path):
+            print(f"[ERROR] ファイルが見つかりません: {path}")
+            sys.exit(1)
+        clusters, merged = confirm(DB_PATH, path)
+        print(f"[OK] 確認済みの候補 {len(clusters)}組を統合しました（別表記 {merged}件）")
+        return
+
+    clusters, merged = dedupe(DB_PATH, threshold, apply)
+    for c in clusters[:20]:
+        print(f"\n統合先: {c['canonical']['source']}  →  {c['canonical']['target']}")
+        for m in c["members"]:
+            print(f"  別表記: {m['source']}  →  {m['target']}")
+    if len(clusters) > 20:
+        print(f"\n... ほか {len(clusters) - 20} 組")
+    if report:
+        write_report(clusters, report)
+
+    print("\n" + "=" * 60)
+    print("[完了しました！]")
+    print("=" * 60)
+    print(f"統合候補: {len(clusters)}組（{sum(len(c['members']) for c in clusters)}件）  しきい値: {threshold}")
+    if report:
+        print(f"候補の一覧: {report}")
+    if apply:
+        print(f"別表記にまとめた件数: {merged}件（まとめ方のキーと訳が同じものだけ）")
+    else:
+        print("キーと訳が同じものを統合するには --apply を付けて実行してください")
+    fuzzy = sum(len(c["members"]) for c in clusters) - sum(len(c["members"]) for c in exact_clusters(clusters))
+    if fuzzy:
+        print(f"[WARN] あいまいな候補・訳が違う候補 {fuzzy}件は統合していません。--report の CSV を確認して、"
+              f"不要な行を消してから --confirm で統合してください")
+    print("=" * 60)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,316 @@
+# delta_sync.py
+# 辞書DBどうしの差分同期（ローカルの phrases.db とデプロイ先のアプリの間など）
+# 使い方: python delta_sync.py export <差分ファイル.jsonl.gz> [--since 番号]
+#         python delta_sync.py apply <差分ファイル.jsonl.gz>
+#         python delta_sync.py status
+#         python delta_sync.py prune <番号>
+#
+# phrases への書き込み（upsert_phrase・使用回数・CSV取り込み・SRT一括処理）はすべてトリガーで
+# phrases_changes に連番つきで記録される。export は指定した番号より後の変更だけを原文ごとにまとめて書き出し、
+# apply は送り元ごとに取り込み済みの番号を覚えておくので、同じファイルを何度取り込んでも結果は変わらない。
+# 使用回数は上書きせず増分を足し合わせる。
+# 取り込んだ変更の原文が dedupe.py で統合済みの別表記なら、upsert_phrase と同じく統合先の行に書き込む。
+#
+# 変更ログの削除: export のヘッダーには「このDBが各送り元の何番まで取り込んだか」を載せる。
+# apply でそれを受け取ると、相手が自分の何番まで取り込んだか（確認済みの番号）を記録し、
+# 差分を取り込んだことのある相手全員の確認済みの番号（まだ届いていない相手は 0）の最小値以下の変更を
+# phrases_changes から消す。差分を送り返してこない相手（一方向の同期）
+# がいる場合は確認が届かないので、相手が取り込み済みの番号を確かめてから prune で手動で消すこと。
+# 消した番号より前からの export はエラーになる。
+#
+# 注意: 変更の記録は phrases_changes を作った時点から始まる。最初は CSV やDBファイルのコピーで
+# 内容をそろえてから、以降の変更を差分で送ること。
+
+import gzip
+import json
+import os
+import sys
+from datetime import datetime
+import dedupe
+from db_connection import connection
+from search_index import normalize_source
+
+DB_PATH = "phrases.db"
+TABLE = "phrases"
+FORMAT = "phrase-delta"
+FORMAT_VERSION = 1
+
+def changes_table(table=TABLE):
+    return f"{table}_changes"
+
+def ensure_change_log(conn, table=TABLE):
+    """変更ログのテーブルとトリガーを作成（init_db から呼ぶ）
+
+    差分の取り込み中（{table}_sync の applying が '1' の間）の書き込みは記録しない。
+    取り込んだ変更を送り返して使用回数が二重に足されるのを防ぐため。
+    """
+    log = changes_table(table)
+    not_applying = f"(SELECT value FROM {table}_sync WHERE key = 'applying') = '0'"
+    conn.executescript(f"""
+    CREATE TABLE IF NOT EXISTS {log} (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        op TEXT NOT NULL,                       -- upsert / usage / delete
+        source TEXT NOT NULL,
+        target TEXT,
+        context TEXT,
+        tags TEXT,
+        created_at TEXT,
+        usage_delta INTEGER NOT NULL DEFAULT 0,
+        changed_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%f', 'now'))
+    );
+    CREATE TABLE IF NOT EXISTS {table}_sync (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+    INSERT OR IGNORE INTO {table}_sync(key, value) VALUES ('instance', lower(hex(randomblob(8))));
+    INSERT OR IGNORE INTO {table}_sync(key, value) VALUES ('applying', '0');
+    INSERT OR IGNORE INTO {table}_sync(key, value) VALUES ('pruned_seq', '0');
+    CREATE TABLE IF NOT EXISTS {table}_sync_peers (
+        peer TEXT PRIMARY KEY,
+        last_seq INTEGER NOT NULL,
+        applied_at TEXT
+    );
+    CREATE TABLE IF NOT EXISTS {table}_sync_acks (
+        peer TEXT PRIMARY KEY,
+        acked_seq INTEGER NOT NULL,             -- 相手がこのDBの何番まで取り込んだか
+        acked_at TEXT
+    );
+    CREATE TRIGGER IF NOT EXISTS {log}_ai AFTER INSERT ON {table} WHEN {not_applying} BEGIN
+        INSERT INTO {log}(op, source, target, context, tags, created_at, usage_delta)
+        VALUES ('upsert', new.source, new.target, new.context, new.tags, new.created_at, new.usage_count);
+    END;
+    CREATE TRIGGER IF NOT EXISTS {log}_au AFTER UPDATE OF source, target, context, tags ON {table}
+    WHEN {not_applying} AND (old.source IS NOT new.source OR old.target IS NOT new.target
+                             OR old.context IS NOT new.context OR old.tags IS NOT new.tags) BEGIN
+        INSERT INTO {log}(op, source) SELECT 'delete', old.source WHERE old.source IS NOT new.source;
+        INSERT INTO {log}(op, source, target, context, tags, created_at)
+        VALUES ('upsert', new.source, new.target, new.context, new.tags, new.created_at);
+    END;
+    CREATE TRIGGER IF NOT EXISTS {log}_usage AFTER UPDATE OF usage_count ON {table}
+    WHEN {not_applying} AND new.usage_count IS NOT old.usage_count BEGIN
+        INSERT INTO {log}(op, source, usage_delta)
+        VALUES ('usage', new.source, COALESCE(new.usage_count, 0) - COALESCE(old.usage_count, 0));
+    END;
+    CREATE TRIGGER IF NOT EXISTS {log}_ad AFTER DELETE ON {table} WHEN {not_applying} BEGIN
+        INSERT INTO {log}(op, source) VALUES ('delete', old.source);
+    END;
+    """)
+    conn.commit()
+
+def instance_id(conn, table=TABLE):
+    return conn.execute(f"SELECT value FROM {table}_sync WHERE key = 'instance'").fetchone()[0]
+
+def last_seq(conn, table=TABLE):
+    # 変更ログを消した後も番号が戻らないよう、AUTOINCREMENT の採番から取る
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (changes_table(table),)).fetchone()
+    return row[0] if row else 0
+
+def pruned_seq(conn, table=TABLE):
+    return int(conn.execute(f"SELECT value FROM {table}_sync WHERE key = 'pruned_seq'").fetchone()[0])
+
+def prune_changes(conn, upto, table=TABLE):
+    """upto 番以下の変更ログを消す。消した件数を返す（トランザクションは呼び出し側）"""
+    cur = conn.execute(f"DELETE FROM {changes_table(table)} WHERE seq <= ?", (upto,))
+    conn.execute(f"UPDATE {table}_sync SET value = CAST(MAX(CAST(value AS INTEGER), ?) AS TEXT) "
+                 f"WHERE key = 'pruned_seq'", (upto,))
+    return cur.rowcount
+
+def compact_changes(rows):
+    """変更ログの行を原文ごとに1件にまとめる（内容は最後の値、使用回数は増分の合計）
+
+    rows は seq 順の (seq, op, source, target, context, tags, created_at, usage_delta)。
+    まとめた変更を seq 順のリストで返す。
+    """
+    merged = {}
+    for seq, op, source, target, context, tags, created_at, usage_delta in rows:
+        entry = merged.pop(source, None)
+        if op == "delete":
+            entry = {"op": "delete", "source": source, "usage": 0}
+        elif op == "upsert":
+            usage = (entry["usage"] if entry and entry["op"] != "delete" else 0) + usage_delta
+            entry = {"op": "upsert", "source": source, "target": target, "context": context,
+                     "tags": tags, "created_at": created_at, "usage": usage}
+        elif entry is None:
+            entry = {"op": "usage", "source": source, "usage": usage_delta}
+        elif entry["op"] != "delete":
+            entry["usage"] += usage_delta
+        entry["seq"] = seq
+        merged[source] = entry     # 入れ直して seq 順を保つ
+    return list(merged.values())
+
+def export_delta(f, since=0, db_path=DB_PATH, table=TABLE):
+    """since より後の変更を gzip した JSON Lines としてバイナリファイル f に書く
+
+    1行目はヘッダー（送り元・番号の範囲・各送り元から取り込み済みの番号）、2行目以降が原文ごとの変更。
+    ヘッダーを返す。since より後の変更ログがすでに消されている場合は ValueError。
+    """
+    with connection(db_path) as conn:
+        conn.execute("BEGIN")
+        try:
+            pruned = pruned_seq(conn, table)
+            if since < pruned:
+                raise ValueError(f"{pruned} 番までの変更ログは削除済みです。--since {pruned} 以降を指定するか、"
+                                 f"DBファイルのコピーで内容をそろえ直してください")
+            acks = dict(conn.execute(f"SELECT peer, last_seq FROM {table}_sync_peers").fetchall())
+            header = {"format": FORMAT, "version": FORMAT_VERSION, "instance": instance_id(conn, table),
+                      "from_seq": since, "to_seq": max(since, last_seq(conn, table)), "acks": acks,
+                      "exported_at": datetime.utcnow().isoformat()}
+            rows = conn.execute(
+                f"SELECT seq, op, source, target, context, tags, created_at, usage_delta "
+                f"FROM {changes_table(table)} WHERE seq > ? ORDER BY seq", (since,)).fetchall()
+        finally:
+            conn.commit()
+    entries = compact_changes(rows)
+    header["changes"] = len(entries)
+    with gzip.GzipFile(fileobj=f, mode="wb") as gz:
+        gz.write((json.dumps(header, ensure_ascii=False) + "\n").encode("utf-8"))
+        for entry in entries:
+            gz.write((json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8"))
+    return header
+
+def read_delta(f):
+    """差分ファイルを (ヘッダー, 変更のリスト) にする"""
+    with gzip.GzipFile(fileobj=f, mode="rb") as gz:
+        lines = gz.read().decode("utf-8").splitlines()
+    if not lines:
+        raise ValueError("差分ファイルが空です")
+    header = json.loads(lines[0])
+    if header.get("format") != FORMAT or header.get("version") != FORMAT_VERSION:
+        raise ValueError("差分ファイルの形式が違います")
+    return header, [json.loads(line) for line in lines[1:] if line]
+
+def apply_delta(f, db_path=DB_PATH, table=TABLE):
+    """差分ファイルを1トランザクションで取り込む。件数の dict を返す
+
+    送り元ごとに取り込み済みの番号を記録し、それ以下の変更は飛ばす（何度取り込んでも同じ結果）。
+    前回の取り込みとの間に抜けがある場合・自分が書き出したファイルの場合は ValueError。
+    ヘッダーに相手がこのDBの何番まで取り込んだかがあれば記録し、全員が取り込み済みの変更ログを消す。
+    """
+    header, entries = read_delta(f)
+    counts = {"upserted": 0, "usage": 0, "deleted": 0, "skipped": 0, "missing": 0, "pruned": 0}
+    with connection(db_path) as conn:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            peer = header["instance"]
+            if peer == instance_id(conn, table):
+                raise ValueError("このDB自身が書き出した差分です")
+            row = conn.execute(f"SELECT last_seq FROM {table}_sync_peers WHERE peer = ?", (peer,)).fetchone()
+            done = row[0] if row else None
+            if done is not None and header["from_seq"] > done:
+                raise ValueError(f"差分に抜けがあります（取り込み済み: {done} まで、このファイル: "
+                                 f"{header['from_seq']} より後）。--since {done} で書き出し直してください")
+            conn.execute(f"UPDATE {table}_sync SET value = '1' WHERE key = 'applying'")
+            pending = [e for e in entries if done is None or e["seq"] > done]
+            counts["skipped"] = len(entries) - len(pending)
+            # 統合済みの別表記は統合先の原文に置き換える（upsert_phrase と同じ。削除は置き換えない）
+            changed = [e for e in pending if e["op"] != "delete"]
+            aliases = dedupe.resolve_aliases(conn, [e["source"] for e in changed],
+                                             [e.get("target") for e in changed])
+            for e in pending:
+                if e["op"] == "delete":
+                    conn.execute(f"DELETE FROM {table} WHERE source = ?", (e["source"],))
+                    counts["deleted"] += 1
+                    continue
+                source = aliases.get(e["source"], e["source"])
+                if e["op"] == "upsert":
+                    conn.execute(f"""
+                        INSERT INTO {table}(source, target, context, tags, created_at, usage_count,
+                                            normalized_source)
+                        VALUES (?,?,?,?,?,?,?)
+                        ON CONFLICT(source) DO UPDATE SET
+                            target=excluded.target, context=excluded.context, tags=excluded.tags,
+                            usage_count=usage_count + excluded.usage_count
+                    """, (source, e["target"], e["context"], e["tags"], e["created_at"], e["usage"],
+                          normalize_source(source)))
+                    counts["upserted"] += 1
+                else:
+                    cur = conn.execute(f"UPDATE {table} SET usage_count = usage_count + ? WHERE source = ?",
+                                       (e["usage"], source))
+                    counts["usage" if cur.rowcount else "missing"] += 1
+            conn.execute(f"UPDATE {table}_sync SET value = '0' WHERE key = 'applying'")
+            conn.execute(f"""
+                INSERT INTO {table}_sync_peers(peer, last_seq, applied_at) VALUES (?,?,?)
+                ON CONFLICT(peer) DO UPDATE SET last_seq=MAX(last_seq, excluded.last_seq),
+                    applied_at=excluded.applied_at
+            """, (peer, header["to_seq"], datetime.utcnow().isoformat()))
+            acked = header.get("acks", {}).get(instance_id(conn, table))
+            if acked is not None:
+                conn.execute(f"""
+                    INSERT INTO {table}_sync_acks(peer, acked_seq, acked_at) VALUES (?,?,?)
+                    ON CONFLICT(peer) DO UPDATE SET acked_seq=MAX(acked_seq, excluded.acked_seq),
+                        acked_at=excluded.acked_at
+                """, (peer, acked, datetime.utcnow().isoformat()))
+                # 取り込み元として知っている相手のうち、まだ確認が届いていない相手は 0 番まで（何も消さない）
+                upto = conn.execute(f"""
+                    SELECT MIN(COALESCE(a.acked_seq, 0)) FROM {table}_sync_peers AS p
+                    LEFT JOIN {table}_sync_acks AS a ON a.peer = p.peer
+                """).fetchone()[0]
+                counts["pruned"] = prune_changes(conn, upto, table)
+    counts["peer"] = peer
+    counts["to_seq"] = header["to_seq"]
+    return counts
+
+def prune(upto, db_path=DB_PATH, table=TABLE):
+    """upto 番以下の変更ログを手動で消す（一方向の同期で確認が届かない相手向け）。消した件数を返す"""
+    with connection(db_path) as conn:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            return prune_changes(conn, min(upto, last_seq(conn, table)), table)
+
+def status(db_path=DB_PATH, table=TABLE):
+    """(このDBの識別子, 最新の番号, [(送り元, 取り込み済みの番号, 日時), ...])"""
+    with connection(db_path) as conn:
+        peers = conn.execute(f"SELECT peer, last_seq, applied_at FROM {table}_sync_peers "
+                             f"ORDER BY applied_at DESC").fetchall()
+        return instance_id(conn, table), last_seq(conn, table), peers
+
+def main(args):
+    if not args or args[0] not in ("export", "apply", "status", "prune") or (args[0] != "status" and len(args) < 2):
+        print("使い方: python delta_sync.py export <差分ファイル.jsonl.gz> [--since 番号]")
+        print("        python delta_sync.py apply <差分ファイル.jsonl.gz>")
+        print("        python delta_sync.py status")
+        print("        python delta_sync.py prune <番号>")
+        sys.exit(1)
+
+    print("=" * 60)
+    print("差分同期ツール")
+    print("=" * 60)
+
+    if not os.path.exists(DB_PATH):
+        print(f"[ERROR] データベースが見つかりません: {DB_PATH}")
+        sys.exit(1)
+    import phrase_db
+    phrase_db.init_db(DB_PATH)
+
+    try:
+        if args[0] == "status":
+            instance, seq, peers = status(DB_PATH)
+            print(f"このDB: {instance}（最新の変更番号: {seq}）")
+            for peer, done, applied_at in peers:
+                print(f"  取り込み済み: {peer} の {done} 番まで（{applied_at}）")
+            return
+        if args[0] == "prune":
+            deleted = prune(int(args[1]), DB_PATH)
+            print(f"[OK] {args[1]} 番以下の変更ログ {deleted}件を削除しました")
+            print(f"以降は --since {args[1]} より前からは書き出せません")
+            return
+        if args[0] == "export":
+            since = int(args[args.index("--since") + 1]) if "--since" in args else 0
+            with open(args[1], "wb") as f:
+                header = export_delta(f, since, DB_PATH)
+            print(f"[OK] {header['from_seq']} 番より後の変更 {header['changes']}件を書き出しました: {args[1]}")
+            print(f"ファイルサイズ: {os.path.getsize(args[1]):,} バイト")
+            print(f"次回は --since {header['to_seq']} を指定してください")
+        else:
+            with open(args[1], "rb") as f:
+                counts = apply_delta(f, DB_PATH)
+            print(f"[OK] {counts['peer']} の {counts['to_seq']} 番までの差分を取り込みました")
+            print(f"追加・更新: {counts['upserted']}件 / 使用回数: {counts['usage']}件 / "
+                  f"削除: {counts['deleted']}件 / 取り込み済みで飛ばした: {counts['skipped']}件")
+            if counts["missing"]:
+                print(f"[WARN] このDBにない原文の使用回数: {counts['missing']}件（無視しました）")
+            if counts["pruned"]:
+                print(f"相手の取り込みが確認できた変更ログ {counts['pruned']}件を削除しました")
+    except Exception as e:
+        print(f"[ERROR] エラーが発生しました: {e}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,53 @@
+# export_from_db.py
+# データベースの辞書をCSV / Parquetに書き出すスクリプト（import_to_db.py の逆）
+# 使い方: python export_from_db.py <出力ファイル(.csv / .parquet)> [タグ] [この日以降に登録]
+
+import os
+import sys
+import time
+import phrase_db
+from phrase_db import DB_PATH
+
+def main():
+    if len(sys.argv) < 2:
+        print("使い方: python export_from_db.py <出力ファイル(.csv / .parquet)> [タグ] [この日以降に登録]")
+        print("例: python export_from_db.py phrases_export.csv")
+        print("例: python export_from_db.py biken.parquet BiKen 2025-01-01")
+        sys.exit(1)
+
+    out_path = sys.argv[1]
+    tags = sys.argv[2] if len(sys.argv) > 2 else ""
+    since = sys.argv[3] if len(sys.argv) > 3 else ""
+    fmt = "parquet" if out_path.lower().endswith(".parquet") else "csv"
+
+    print("=" * 60)
+    print("データベース -> CSV / Parquet 書き出しツール")
+    print("=" * 60)
+
+    if not os.path.exists(DB_PATH):
+        print(f"[ERROR] データベースが見つかりません: {DB_PATH}")
+        sys.exit(1)
+
+    start = time.perf_counter()
+    try:
+        with open(out_path, "wb") as f:
+            rows = phrase_db.export_phrases(f, fmt, tags, since, DB_PATH)
+    except Exception as e:
+        print(f"[ERROR] エラーが発生しました: {e}")
+        sys.exit(1)
+    elapsed = time.perf_counter() - start
+
+    print("\n" + "=" * 60)
+    print("[完了しました！]")
+    print("=" * 60)
+    print(f"出力ファイル: {out_path}（{fmt}）")
+    if tags:
+        print(f"タグ: {tags}")
+    if since:
+        print(f"登録日: {since} 以降")
+    print(f"書き出した件数: {rows}件")
+    print(f"処理時間: {elapsed:.2f}秒")
+    print("=" * 60)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+# import_jobs.py
+# アプリからアップロードされた CSV の取り込みを、バックグラウンドのジョブとして1件ずつ実行する
+# 画面（再実行）は取り込みを待たず、ジョブの進み具合を import_jobs テーブルから読んで表示するだけ。
+#
+# - 同じ内容（SHA-256 が同じ）のファイルは、取り込み中・取り込み済みなら新しいジョブを作らない
+# - チャンクごとにコミットするので、中止しても取り込み済みのチャンクは残る（やり直しても upsert なので重複しない）
+# - 取り込み中は検索インデックスを読み直さず、終わってから1回だけ読み直す（他の人の検索を待たせない）
+
+import hashlib
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+import uuid
+from datetime import datetime
+import perf_trace
+from db_connection import connection
+import phrase_db
+from search_index import get_index
+from activity_writer import append_log
+
+DB_PATH = "phrases.db"
+JOB_TABLE = "import_jobs"
+JOB_CHUNK_SIZE = 2000        # 1トランザクションの行数（書き込みロックを短くするため一括取り込みより小さめ）
+ACTIVE = ("queued", "running")
+JOB_COLUMNS = ["id", "filename", "user", "tags", "status", "total_rows", "done_rows",
+               "inserted", "updated", "skipped", "error", "created_at", "started_at", "finished_at"]
+
+class ImportCancelled(Exception):
+    """取り込みの中止"""
+
+def ensure_job_table(conn):
+    """import_jobs テーブルを作成
+
+    content_hash は取り込み中・取り込み済みのジョブの間で一意（中止・失敗したものは取り込み直せる）。
+    """
+    conn.executescript(f"""
+    CREATE TABLE IF NOT EXISTS {JOB_TABLE} (
+        id TEXT PRIMARY KEY,
+        content_hash TEXT NOT NULL,
+        filename TEXT,
+        user TEXT,
+        tags TEXT,
+        status TEXT NOT NULL,        -- queued / running / done / cancelled / failed
+        total_rows INTEGER,          -- 改行の数から見積もった行数
+        done_rows INTEGER DEFAULT 0,
+        inserted INTEGER DEFAULT 0,
+        updated INTEGER DEFAULT 0,
+        skipped INTEGER DEFAULT 0,
+        error TEXT,
+        created_at TEXT,
+        started_at TEXT,
+        finished_at TEXT
+    );
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_{JOB_TABLE}_content_hash ON {JOB_TABLE}(content_hash)
+        WHERE status IN ('queued', 'running', 'done');
+    CREATE INDEX IF NOT EXISTS idx_{JOB_TABLE}_created_at ON {JOB_TABLE}(created_at);
+    """)
+    conn.commit()
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def spool_path(job_id):
+    """取り込むまでアップロードされた内容を置いておく一時ファイル"""
+    return os.path.join(tempfile.gettempdir(), f"phrase_import_{job_id}.csv")
+
+def estimate_rows(data):
+    """ヘッダーを除いた行数の見積もり（セル内の改行も1行と数える）"""
+    lines = data.count(b"\n") + (0 if not data or data.endswith(b"\n") else 1)
+    return max(0, lines - 1)
+
+def eta_seconds(job, now=None):
+    """残り時間の見積もり（秒）。まだ見積もれなければ None"""
+    if job["status"] != "running" or not job["started_at"] or not job["done_rows"] or not job["total_rows"]:
+        return None
+    now = now or datetime.utcnow()
+    elapsed = (now - datetime.fromisoformat(job["started_at"])).total_seconds()
+    return max(0.0, elapsed / job["done_rows"] * (job["total_rows"] - job["done_rows"]))
+
+class ImportJobRunner:
+    """取り込みジョブのキューと、それを1件ずつ実行するスレッド
+
+    SQLite の書き込みは1つずつなので、ジョブも同時には1件しか実行しない。
+    """
+
+    def __init__(self, db_path=DB_PATH, chunk_size=JOB_CHUNK_SIZE):
+        self.db_path = db_path
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._cancel = {}            # ジョブ id → 中止の Event
+        with connection(db_path) as conn:
+            ensure_job_table(conn)
+            # 前のプロセスで実行中・待ち状態のまま終わったジョブ（残っている一時ファイルは消す）
+            for (job_id,) in conn.execute(f"SELECT id FROM {JOB_TABLE} WHERE status IN ('queued', 'running')"):
+                if os.path.exists(spool_path(job_id)):
+                    os.remove(spool_path(job_id))
+            conn.execute(f"UPDATE {JOB_TABLE} SET status = 'failed', error = ?, finished_at = ? "
+                         f"WHERE status IN ('queued', 'running')",
+                         ("アプリの再起動で中断しました", datetime.utcnow().isoformat()))
+            conn.commit()
+        self._thread = threading.Thread(target=self._run, name="import-jobs", daemon=True)
+        self._thread.start()
+
+    def submit(self, data, filename="", user="", tags=""):
+        """CSV のバイト列を取り込みジョブにする。(ジョブ id, 新しく作ったか) を返す
+
+        同じ内容のファイルが取り込み中・取り込み済みなら、そのジョブの id を返す（False）。
+        """
+        digest = content_hash(data)
+        job_id = uuid.uuid4().hex[:12]
+        path = spool_path(job_id)
+        with self._lock, connection(self.db_path) as conn:
+            existing = self._active_or_done(conn, digest)
+            if existing:
+                return existing, False
+            with open(path, "wb") as f:
+                f.write(data)
+            try:
+                with conn:
+                    conn.execute(
+                        f"INSERT INTO {JOB_TABLE}(id, content_hash, filename, user, tags, status, total_rows, "
+                        f"created_at) VALUES (?,?,?,?,?,'queued',?,?)",
+                        (job_id, digest, filename, user, tags, estimate_rows(data), datetime.utcnow().isoformat()))
+            except sqlite3.IntegrityError:
+                # 別のプロセスが同じファイルを先に登録した
+                os.remove(path)
+                return self._active_or_done(conn, digest), False
+            self._cancel[job_id] = threading.Event()
+        self._queue.put((job_id, path))
+        return job_id, True
+
+    def _active_or_done(self, conn, digest):
+        row = conn.execute(f"SELECT id FROM {JOB_TABLE} WHERE content_hash = ? "
+                           f"AND status IN ('queued', 'running', 'done')", (digest,)).fetchone()
+        return row[0] if row else None
+
+    def cancel(self, job_id):
+        """ジョブを中止する（実行中なら今のチャンクのコミット後に止まる）"""
+        with self._lock:
+            event = self._cancel.get(job_id)
+            if event is not None:
+                event.set()
+        with connection(self.db_path) as conn:
+            conn.execute(f"UPDATE {JOB_TABLE} SET status = 'cancelled', finished_at = ? "
+                         f"WHERE id = ? AND status = 'queued'", (datetime.utcnow().isoformat(), job_id))
+            conn.commit()
+
+    def job(self, job_id):
+        """ジョブ1件（dict）。なければ None"""
+        with connection(self.db_path) as conn:
+            row = conn.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM {JOB_TABLE} WHERE id = ?",
+                               (job_id,)).fetchone()
+        return dict(zip(JOB_COLUMNS, row)) if row else None
+
+    def recent(self, limit=20):
+        """新しい順のジョブ（dict のリスト）"""
+        with connection(self.db_path) as conn:
+            rows = conn.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM {JOB_TABLE} "
+                                f"ORDER BY created_at DESC LIMIT ?", (limit,)).fetchall()
+        return [dict(zip(JOB_COLUMNS, r)) for r in rows]
+
+    def _update(self, job_id, **values):
+        with connection(self.db_path) as conn:
+            conn.execute(f"UPDATE {JOB_TABLE} SET {', '.join(f'{k} = ?' for k in values)} WHERE id = ?",
+                         (*values.values(), job_id))
+            conn.commit()
+
+    def _run(self):
+        while True:
+            job_id, path = self._queue.get()
+            # 取り込みにかかった時間も記録する（管理 > パフォーマンス・負荷試験で見られる）
+            trace = perf_trace.start("import_job")
+            try:
+                trace.error = self._execute(job_id, path)
+            except Exception as e:
+                trace.error = f"{type(e).__name__}: {e}"
+                print(f"[ERROR] 取り込みジョブ {job_id} の実行に失敗: {e}")
+            finally:
+                perf_trace.finish(trace)
+                with self._lock:
+                    self._cancel.pop(job_id, None)
+                if os.path.exists(path):
+                    os.remove(path)
+            # 検索する人を待たせないよう、取り込んだ分をここで読み直しておく
+            try:
+                get_index(self.db_path).refresh()
+            except Exception as e:
+                print(f"[ERROR] 検索インデックスの読み直しに失敗: {e}")
+
+    def _execute(self, job_id, path):
+        """ジョブを1件実行する。失敗したときはエラーの文字列を返す"""
+        job = self.job(job_id)
+        if job is None or job["status"] != "queued":
+            return
+        cancel = self._cancel[job_id]
+        self._update(job_id, status="running", started_at=datetime.utcnow().isoformat())
+
+        def progress(done, counts):
+            self._update(job_id, done_rows=done, inserted=counts["inserted"],
+                         updated=counts["updated"], skipped=counts["skipped"])
+            if cancel.is_set():
+                raise ImportCancelled()
+
+        status, error = "done", None
+        try:
+            # チャンクごとのコミットで検索インデックスを何度も読み直さないよう、終わるまで止めておく
+            with get_index(self.db_path).defer_refresh():
+                phrase_db.import_csv(path, self.db_path, chunksize=self.chunk_size,
+                                     progress=progress, tags=job["tags"] or "")
+        except ImportCancelled:
+            status = "cancelled"
+        except Exception as e:
+            status, error = "failed", str(e)
+        self._update(job_id, status=status, error=error, finished_at=datetime.utcnow().isoformat())
+        job = self.job(job_id)
+        append_log(job["user"], "import_job",
+                   f"job={job_id},status={status},rows={job['inserted'] + job['updated']}", self.db_path)
+        return error
+
+# プロセス内で共有するジョブの実行スレッド
+_runners = {}
+_runners_lock = threading.Lock()
+
+def get_runner(db_path=DB_PATH):
+    """db_path ごとに1つの ImportJobRunner を返す"""
+    key = os.path.abspath(db_path)
+    with _runners_lock:
+        runner = _runners.get(key)
+        if runner is None:
+            runner = _runners[key] = ImportJobRunner(db_path)
+    return runner
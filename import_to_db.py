@@ -1,122 +1,82 @@
 # import_to_db.py
 # CSVファイルを直接データベースに取り込むスクリプト
 
-import sqlite3
-import pandas as pd
-from datetime import datetime
+import os
 import sys
+import phrase_db
+from phrase_db import DB_PATH
+from search_index import write_index_snapshot
 
-DB_PATH = "phrases.db"
-TABLE = "phrases"
+# --dedupe の既定のしきい値（100 = 句読点・大文字小文字・つなぎ言葉を除いて完全に同じものだけ）
+IMPORT_DEDUPE_THRESHOLD = 100
 
-def init_db():
+def init_db(db_path=DB_PATH):
     """データベースを初期化"""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute(f"""
-    CREATE TABLE IF NOT EXISTS {TABLE} (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        source TEXT NOT NULL,
-        target TEXT NOT NULL,
-        context TEXT,
-        tags TEXT,
-        created_at TEXT,
-        usage_count INTEGER DEFAULT 0
-    )
-    """)
-    conn.commit()
-    conn.close()
+    phrase_db.init_db(db_path)
     print("[OK] データベースを初期化しました")
 
-def import_csv(csv_path):
-    """CSVファイルをデータベースに取り込む"""
+def import_csv(csv_path, dedupe_threshold=None, tags="", db_path=DB_PATH):
+    """CSVファイルをデータベースに取り込む（チャンクごとに一括 upsert）
+
+    dedupe_threshold を渡すと、取り込んだ行と、句読点・大文字小文字・つなぎ言葉だけが違い訳が同じ原文を統合する（dedupe.py）。
+    tags を渡すと、全行の tags に追加する。
+    """
+    def progress(done, counts):
+        print(f"処理中... {done}行")
+
     try:
-        # CSVを読み込み
-        df = pd.read_csv(csv_path, encoding='utf-8-sig')
-        print(f"[OK] {csv_path} を読み込みました（{len(df)}行）")
-        
-        # 必要な列があるか確認
-        if "source" not in df.columns or "target" not in df.columns:
-            print("[ERROR] CSVに source と target 列が必要です")
-            return False
-        
-        # データベースに接続
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        now = datetime.utcnow().isoformat()
-        
-        imported = 0
-        updated = 0
-        skipped = 0
-        
-        for idx, row in df.iterrows():
-            source = str(row["source"]).strip()
-            target = str(row["target"]).strip()
-            
-            # [要確認]の行はスキップ
-            if target == "[要確認]" or target == "":
-                skipped += 1
-                continue
-            
-            context = str(row.get("context", "")).strip()
-            tags = str(row.get("tags", "")).strip()
-            
-            # 既存のレコードを確認
-            cur.execute(f"SELECT id FROM {TABLE} WHERE source = ?", (source,))
-            existing = cur.fetchone()
-            
-            if existing:
-                # 更新
-                cur.execute(f"""
-                    UPDATE {TABLE} 
-                    SET target=?, context=?, tags=? 
-                    WHERE id=?
-                """, (target, context, tags, existing[0]))
-                updated += 1
-            else:
-                # 新規挿入
-                cur.execute(f"""
-                    INSERT INTO {TABLE}(source, target, context, tags, created_at) 
-                    VALUES (?,?,?,?,?)
-                """, (source, target, context, tags, now))
-                imported += 1
-            
-            # 進捗表示（100件ごと）
-            if (idx + 1) % 100 == 0:
-                print(f"処理中... {idx + 1}/{len(df)}")
-        
-        conn.commit()
-        conn.close()
-        
-        print("\n" + "=" * 60)
-        print("[完了しました！]")
-        print("=" * 60)
-        print(f"新規追加: {imported}件")
-        print(f"更新: {updated}件")
-        print(f"スキップ: {skipped}件")
-        print(f"合計: {imported + updated}件のフレーズが辞書に登録されました")
-        print("=" * 60)
-        
-        return True
-        
+        counts = phrase_db.import_csv(csv_path, db_path, progress=progress, dedupe_threshold=dedupe_threshold,
+                                      tags=tags)
     except Exception as e:
         print(f"[ERROR] エラーが発生しました: {e}")
         return False
 
+    print("\n" + "=" * 60)
+    print("[完了しました！]")
+    print("=" * 60)
+    print(f"新規追加: {counts['inserted']}件")
+    print(f"更新: {counts['updated']}件")
+    print(f"スキップ: {counts['skipped']}件")
+    if dedupe_threshold is not None:
+        print(f"別表記として統合: {counts['merged']}件")
+    print(f"合計: {counts['inserted'] + counts['updated']}件のフレーズが辞書に登録されました")
+    print("=" * 60)
+
+    # アプリの起動時にDBから読み直さずに済むよう、検索インデックスのスナップショットを作る
+    try:
+        path = write_index_snapshot(db_path)
+        print(f"[OK] 検索インデックスのスナップショットを作成しました: {path}")
+    except Exception as e:
+        print(f"[ERROR] スナップショットの作成に失敗: {e}")
+
+    return True
+
 def main():
     if len(sys.argv) < 2:
-        print("使い方: python import_to_db.py <CSVファイル>")
+        print("使い方: python import_to_db.py <CSVファイル> [--dedupe [しきい値]] [--tag タグ | --tag-file]")
         print("例: python import_to_db.py BiKenS6E6_dictionary.csv")
+        print("例: python import_to_db.py BiKenS6E6_dictionary.csv --dedupe  （句読点・大文字小文字だけ違う原文を統合）")
+        print("例: python import_to_db.py BiKenS6E6_dictionary.csv --tag-file  （ファイル名 BiKenS6E6_dictionary をタグにする）")
         sys.exit(1)
     
     csv_path = sys.argv[1]
+    dedupe_threshold = None
+    if "--dedupe" in sys.argv:
+        i = sys.argv.index("--dedupe")
+        value = sys.argv[i + 1] if i + 1 < len(sys.argv) else "--"
+        dedupe_threshold = IMPORT_DEDUPE_THRESHOLD if value.startswith("--") else float(value)
+    tags = ""
+    if "--tag" in sys.argv:
+        tags = sys.argv[sys.argv.index("--tag") + 1]
+    elif "--tag-file" in sys.argv:
+        tags = os.path.splitext(os.path.basename(csv_path))[0]
     
     print("=" * 60)
     print("CSV -> データベース 直接取り込みツール")
     print("=" * 60)
     
     init_db()
-    success = import_csv(csv_path)
+    success = import_csv(csv_path, dedupe_threshold, tags)
     
     if success:
         print("\n次のステップ:")
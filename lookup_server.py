@@ -0,0 +1,286 @@
+# lookup_server.py
+# 字幕エディタなどのツールから辞書を引くための HTTP/JSON サーバー（app.py と同じ phrases.db を使う）
+# 使い方: python lookup_server.py [--host 127.0.0.1] [--port 8765] [--workers 4] [--db phrases.db]
+#
+# 検索インデックスはプロセス内に1つだけ持ち続け（起動時に読み込む）、スコアリングはスレッドプールで行う。
+# Streamlit の再実行がないので、1回の検索はインデックスの検索時間だけで返る。
+#
+#   GET  /health                              動作確認
+#   GET  /lookup?q=...&limit=5                あいまい検索
+#   POST /lookup  {"query", "limit", "tags", "context", "reverse"}   reverse=true なら日本語から逆引き
+#   POST /batch   {"queries": [...], "score_cutoff": 60}             クエリごとの最良の1件
+#   GET  /exact?q=...  / POST /exact {"query", "tags", "context"}    完全一致（大文字小文字・記号・空白は無視）だけ
+#   POST /usage   {"id", "delta": 1, "user"}                         使用回数を増やす（採用したとき）
+#   GET  /stats                               エンドポイントごとの処理時間（p50 / p95 / p99）など
+#
+# 外部に公開するものではないので、既定では 127.0.0.1 だけで待ち受ける（認証はない）。
+
+import asyncio
+import contextvars
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+import perf_trace
+from phrase_db import DB_PATH, TABLE, init_db
+from search_index import get_index
+from activity_writer import append_log, get_writer
+
+HOST = "127.0.0.1"
+PORT = 8765
+WORKERS = 4                      # スコアリング用のスレッド数（process.cdist は中でさらに全コアを使う）
+MAX_BODY = 16 * 1024 * 1024      # リクエスト本文の上限
+MAX_LIMIT = 50
+MAX_BATCH = 10_000
+REFRESH_INTERVAL = 2.0           # 他の接続（app.py など）の変更を確認する間隔（秒）
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 500: "Internal Server Error"}
+
+class RequestError(Exception):
+    """クライアントの間違い（status と一緒に返す）"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def _result(row, score):
+    return {"id": row["id"], "source": row["source"], "target": row["target"], "context": row["context"],
+            "tags": row["tags"], "usage_count": row["usage_count"], "score": round(float(score), 1)}
+
+def _int(params, name, default, low, high):
+    value = params.get(name, default)
+    # 1.9 や true を黙って 1 にしない（JSON の数値は整数だけ受け付ける）
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        raise RequestError(400, f"{name} は整数で指定してください")
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise RequestError(400, f"{name} は整数で指定してください")
+    return max(low, min(high, value))
+
+def _text(params, name):
+    value = params.get(name)
+    if not isinstance(value, str) or not value.strip():
+        raise RequestError(400, f"{name} を指定してください")
+    return value
+
+def _tags(params):
+    tags = params.get("tags") or []
+    if isinstance(tags, str):
+        tags = [t.strip() for t in tags.split(",") if t.strip()]
+    # 5 や {"a": 1} を list() に通すと 500 になるので、文字列かその配列だけを受け付ける
+    if not isinstance(tags, list) or not all(isinstance(t, str) for t in tags):
+        raise RequestError(400, "tags はカンマ区切りの文字列か、文字列の配列で指定してください")
+    return tags
+
+class LookupServer:
+    """エンドポイントの処理と、処理時間の記録"""
+
+    def __init__(self, db_path=DB_PATH, workers=WORKERS):
+        self.db_path = db_path
+        self.index = get_index(db_path, TABLE)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="lookup")
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.routes = {
+            ("GET", "/health"): self.health,
+            ("GET", "/lookup"): self.lookup,
+            ("POST", "/lookup"): self.lookup,
+            ("POST", "/batch"): self.batch,
+            ("GET", "/exact"): self.exact,
+            ("POST", "/exact"): self.exact,
+            ("POST", "/usage"): self.usage,
+            ("GET", "/stats"): self.stats,
+        }
+
+    async def run_in_pool(self, fn, *args):
+        # 計測中の区間（perf_trace）がスレッド側でも記録されるよう、コンテキストごと渡す
+        ctx = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self.pool, ctx.run, fn, *args)
+
+    async def refresh_loop(self):
+        """他の接続による変更を定期的に読み込んでおく（検索のたびに読み直しを待たせないように）"""
+        while True:
+            await asyncio.sleep(REFRESH_INTERVAL)
+            try:
+                await self.run_in_pool(self.index.refresh)
+            except Exception as e:
+                print(f"[ERROR] 検索インデックスの読み直しに失敗: {e}")
+
+    async def handle(self, method, path, params):
+        """(status, JSON にする値) を返す"""
+        route = self.routes.get((method, path))
+        if route is None:
+            if any(p == path for _, p in self.routes):
+                return 405, {"error": f"{method} は使えません: {path}"}
+            return 404, {"error": f"見つかりません: {path}"}
+        trace = perf_trace.start(f"{method} {path}")
+        try:
+            return 200, await route(params)
+        finally:
+            perf_trace.finish(trace)
+
+    async def health(self, params):
+        return {"status": "ok", "phrases": len(self.index)}
+
+    async def lookup(self, params):
+        query = _text(params, "query" if "query" in params else "q")
+        limit = _int(params, "limit", 5, 1, MAX_LIMIT)
+        tags, context = _tags(params), str(params.get("context") or "")
+        if str(params.get("reverse", "")).lower() in ("1", "true"):
+            results = await self.run_in_pool(
+                lambda: self.index.reverse_search(query, limit=limit, tags=tags, context=context))
+        else:
+            results = await self.run_in_pool(
+                lambda: self.index.search(query, limit=limit, tags=tags, context=context))
+        return {"query": query, "results": [_result(row, score) for row, score in results]}
+
+    async def batch(self, params):
+        queries = params.get("queries")
+        if not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
+            raise RequestError(400, "queries は文字列のリストで指定してください")
+        if len(queries) > MAX_BATCH:
+            raise RequestError(413, f"queries は {MAX_BATCH} 件までです")
+        cutoff = _int(params, "score_cutoff", 0, 0, 100)
+        results = await self.run_in_pool(self.index.batch_search, queries, cutoff)
+        return {"results": [_result(row, score) if row else None for row, score in results]}
+
+    async def exact(self, params):
+        query = _text(params, "query" if "query" in params else "q")
+        results = await self.run_in_pool(
+            lambda: self.index.exact(query, tags=_tags(params), context=str(params.get("context") or "")))
+        return {"query": query, "results": [_result(row, score) for row, score in results]}
+
+    async def usage(self, params):
+        if "id" not in params:
+            raise RequestError(400, "id を指定してください")
+        pid = _int(params, "id", 0, 1, 2 ** 63 - 1)
+        delta = _int(params, "delta", 1, 1, 1000)
+        user = str(params.get("user") or "api")
+        # app.py の採用ボタンと同じく、DB への書き込みはバックグラウンドでまとめて行う
+        get_writer(self.db_path).add_usage(pid, delta)
+        self.index.apply_usage(pid, delta)
+        append_log(user, "api_usage", f"id={pid},delta={delta}", self.db_path)
+        return {"id": pid, "delta": delta}
+
+    async def stats(self, params):
+        # 同じプロセスのバックグラウンドの書き込み（activity.flush など）の記録は除く
+        names = sorted({t.name for t in perf_trace.recent()} & {f"{m} {p}" for m, p in self.routes})
+        endpoints = {name: perf_trace.percentiles(perf_trace.recent(name)) for name in names}
+        return {"uptime": round(time.time() - self.started, 1), "requests": self.requests,
+                "errors": self.errors, "phrases": len(self.index), "endpoints": endpoints}
+
+    async def client(self, reader, writer):
+        """1つの接続を処理する（HTTP/1.1 の keep-alive に対応）"""
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    method, target, version = line.decode("latin-1").split()
+                except ValueError:
+                    await self._respond(writer, 400, {"error": "リクエスト行が読めません"}, close=True)
+                    break
+                headers = {}
+                while True:
+                    h = await reader.readline()
+                    if h in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = h.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                close = headers.get("connection", "").lower() == "close" or version == "HTTP/1.0"
+                try:
+                    length = int(headers.get("content-length") or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    await self._respond(writer, 400, {"error": "Content-Length が正しくありません"}, close=True)
+                    break
+                if length > MAX_BODY:
+                    await self._respond(writer, 413, {"error": "本文が大きすぎます"}, close=True)
+                    break
+                body = await reader.readexactly(length) if length else b""
+                status, payload = await self._dispatch(method, target, body)
+                await self._respond(writer, status, payload, close)
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method, target, body):
+        self.requests += 1
+        url = urlsplit(target)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        try:
+            if body:
+                try:
+                    data = json.loads(body)
+                except ValueError:
+                    raise RequestError(400, "本文が JSON ではありません")
+                if not isinstance(data, dict):
+                    raise RequestError(400, "本文は JSON のオブジェクトで送ってください")
+                params.update(data)
+            status, payload = await self.handle(method, url.path, params)
+        except RequestError as e:
+            status, payload = e.status, {"error": str(e)}
+        except Exception as e:
+            print(f"[ERROR] {method} {url.path}: {e}")
+            status, payload = 500, {"error": str(e)}
+        if status != 200:
+            self.errors += 1
+        return status, payload
+
+    async def _respond(self, writer, status, payload, close=False):
+        data = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+        head = (f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+                f"Content-Type: application/json; charset=utf-8\r\n"
+                f"Content-Length: {len(data)}\r\n")
+        if close:
+            head += "Connection: close\r\n"
+        writer.write(head.encode("latin-1") + b"\r\n" + data)
+        await writer.drain()
+
+async def serve(host=HOST, port=PORT, db_path=DB_PATH, workers=WORKERS, ready=None):
+    """サーバーを起動して止まるまで待つ。ready を渡すと、待ち受けを始めたときに ready.set() する"""
+    server = LookupServer(db_path, workers)
+    # 最初のリクエストを待たせないよう、起動時にインデックスを読み込んでおく
+    await server.run_in_pool(server.index.refresh)
+    refresher = asyncio.create_task(server.refresh_loop())
+    tcp = await asyncio.start_server(server.client, host, port)
+    print(f"[OK] http://{host}:{port} で待ち受けています（フレーズ {len(server.index)}件、Ctrl+C で終了）")
+    if ready is not None:
+        ready.set()
+    try:
+        async with tcp:
+            await tcp.serve_forever()
+    finally:
+        refresher.cancel()
+        server.pool.shutdown(wait=False)
+
+def main(args):
+    host, port, workers, db_path = HOST, PORT, WORKERS, DB_PATH
+    if "--host" in args:
+        host = args[args.index("--host") + 1]
+    if "--port" in args:
+        port = int(args[args.index("--port") + 1])
+    if "--workers" in args:
+        workers = int(args[args.index("--workers") + 1])
+    if "--db" in args:
+        db_path = args[args.index("--db") + 1]
+
+    print("=" * 60)
+    print("辞書検索サーバー（HTTP/JSON）")
+    print("=" * 60)
+    init_db(db_path)
+    try:
+        asyncio.run(serve(host, port, db_path, workers))
+    except KeyboardInterrupt:
+        print("\n[OK] 終了しました")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,78 +1,214 @@
 # merge_dictionaries.py
 # 複数の辞書CSVを統合して重複を削除
+# 使い方: python merge_dictionaries.py [-o 出力CSV] [--policy first|last|most-used|all]
+#                                      [--db phrases.db] [--report 競合レポートCSV] <入力CSV または glob>...
+#
+# 入力はチャンクごとに一時的な SQLite（ステージング用テーブル）に書き込み、重複の判定も SQL で行うので、
+# ファイル数が増えてもメモリ使用量は変わらない。
 
-import pandas as pd
+import csv
+import glob
+import os
+import sqlite3
 import sys
+import tempfile
+import pandas as pd
+
+POLICIES = ["first", "last", "most-used", "all"]
+COLUMNS = ["source", "target", "context", "tags"]
+CHUNK_SIZE = 20000
+DEFAULT_INPUTS = [
+    "BiKenS6E6_dictionary.csv",
+    "BiKen5_3_Mech_dictionary.csv",
+    "BiKenS1E4_Beach_dictionary.csv"
+]
+DEFAULT_OUTPUT = "complete_dictionary.csv"
+
+def expand_inputs(patterns):
+    """glob を展開して入力ファイルのリストにする（指定順、重複なし）"""
+    files = []
+    for pattern in patterns:
+        matched = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        for f in matched:
+            if f not in files:
+                files.append(f)
+    return files
+
+def stage_inputs(conn, input_files):
+    """入力CSVをチャンクごとに staging テーブルへ書き込む。読み込んだ行数を返す"""
+    conn.execute("""
+        CREATE TABLE staging (
+            seq INTEGER PRIMARY KEY,
+            source TEXT NOT NULL,
+            target TEXT,
+            context TEXT,
+            tags TEXT,
+            file TEXT
+        )
+    """)
+    conn.commit()
+    total = 0
+    for file in input_files:
+        # ファイルごとに SAVEPOINT で囲み、途中で失敗したら読み込んだ分も取り消す（一部だけ統合されないように）
+        conn.execute("SAVEPOINT stage_file")
+        try:
+            rows = 0
+            for chunk in pd.read_csv(file, encoding='utf-8-sig', dtype=str, chunksize=CHUNK_SIZE):
+                if "source" not in chunk.columns or "target" not in chunk.columns:
+                    raise ValueError("source と target 列が必要です")
+                chunk = chunk.reindex(columns=COLUMNS).fillna("")
+                chunk = chunk[chunk["source"] != ""]
+                conn.executemany(
+                    "INSERT INTO staging(source, target, context, tags, file) VALUES (?,?,?,?,?)",
+                    zip(chunk["source"], chunk["target"], chunk["context"], chunk["tags"],
+                        [file] * len(chunk)))
+                rows += len(chunk)
+            conn.execute("RELEASE stage_file")
+            print(f"[OK] {file} を読み込みました（{rows}行）")
+            total += rows
+        except Exception as e:
+            conn.execute("ROLLBACK TO stage_file")
+            conn.execute("RELEASE stage_file")
+            print(f"[ERROR] {file} の読み込みに失敗（このファイルの行は統合しません）: {e}")
+    conn.execute("CREATE INDEX idx_staging_source ON staging(source, seq)")
+    return total
+
+def select_sql(policy, has_db):
+    """方針ごとに、残す行を seq 順に返す SELECT 文"""
+    cols = ", ".join(COLUMNS)
+    if policy == "first":
+        return f"SELECT {cols} FROM staging WHERE seq IN (SELECT MIN(seq) FROM staging GROUP BY source) ORDER BY seq"
+    if policy == "last":
+        return f"SELECT {cols} FROM staging WHERE seq IN (SELECT MAX(seq) FROM staging GROUP BY source) ORDER BY seq"
+    if policy == "all":
+        # 同じ source・target の組は1つにまとめ、訳の違うものはすべて残す
+        return (f"SELECT {cols} FROM staging WHERE seq IN "
+                f"(SELECT MIN(seq) FROM staging GROUP BY source, target) ORDER BY seq")
+    # most-used: DB で使用回数の多い訳を優先（DB にない訳・同点は先に出てきたもの）
+    usage = "COALESCE(p.usage_count, -1)" if has_db else "-1"
+    join = "LEFT JOIN db.phrases AS p ON p.source = s.source AND p.target = s.target" if has_db else ""
+    return f"""
+        SELECT {cols} FROM (
+            SELECT s.*, ROW_NUMBER() OVER (PARTITION BY s.source ORDER BY {usage} DESC, s.seq) AS rn
+            FROM staging AS s {join}
+        ) WHERE rn = 1 ORDER BY seq
+    """
 
-def merge_csv_files(input_files, output_file):
+def write_conflicts(conn, report_file):
+    """同じ source に異なる訳がある行をレポートに書き出す。競合した source の数を返す"""
+    cur = conn.execute("""
+        SELECT source, target, context, tags, file FROM staging
+        WHERE source IN (SELECT source FROM staging GROUP BY source HAVING COUNT(DISTINCT target) > 1)
+        ORDER BY source, seq
+    """)
+    sources = set()
+    with open(report_file, "w", newline="", encoding="utf-8-sig") as f:
+        w = csv.writer(f)
+        w.writerow(COLUMNS + ["file"])
+        while True:
+            rows = cur.fetchmany(CHUNK_SIZE)
+            if not rows:
+                break
+            w.writerows(rows)
+            sources.update(r[0] for r in rows)
+    return len(sources)
+
+def merge_csv_files(input_files, output_file, policy="first", db_path=None, report_file=None):
     """複数のCSVファイルを統合"""
-    all_data = []
-    
+    if policy not in POLICIES:
+        print(f"[ERROR] 不明な方針です: {policy}（{' / '.join(POLICIES)}）")
+        return False
+
     print("=" * 60)
     print("辞書統合ツール")
     print("=" * 60)
     print()
-    
-    # 各ファイルを読み込む
-    for file in input_files:
-        try:
-            df = pd.read_csv(file, encoding='utf-8-sig')
-            print(f"[OK] {file} を読み込みました（{len(df)}行）")
-            all_data.append(df)
-        except Exception as e:
-            print(f"[ERROR] {file} の読み込みに失敗: {e}")
-    
-    if not all_data:
-        print("[ERROR] 読み込めるファイルがありませんでした")
-        return False
-    
-    # 統合
-    merged = pd.concat(all_data, ignore_index=True)
-    print(f"\n統合前の総フレーズ数: {len(merged)}")
-    
-    # source列で重複を削除（最初に出現したものを保持）
-    before_count = len(merged)
-    merged_unique = merged.drop_duplicates(subset=['source'], keep='first')
-    after_count = len(merged_unique)
-    duplicates = before_count - after_count
-    
-    print(f"重複削除後: {after_count}")
-    print(f"削除された重複: {duplicates}")
-    
-    # 必要な列のみを保持
-    if 'source' in merged_unique.columns and 'target' in merged_unique.columns:
-        # context と tags 列も保持（存在する場合）
-        columns_to_keep = ['source', 'target']
-        if 'context' in merged_unique.columns:
-            columns_to_keep.append('context')
-        if 'tags' in merged_unique.columns:
-            columns_to_keep.append('tags')
-        
-        final_df = merged_unique[columns_to_keep].copy()
-    else:
-        final_df = merged_unique
-    
-    # 保存
-    final_df.to_csv(output_file, index=False, encoding='utf-8-sig')
-    
+
+    fd, staging_path = tempfile.mkstemp(suffix=".db", prefix="merge_staging_")
+    os.close(fd)
+    conn = sqlite3.connect(staging_path)
+    try:
+        # 一時ファイルなので耐障害性は不要（ファイルごとの取り消しに使うのでジャーナルはメモリに置く）
+        conn.execute("PRAGMA journal_mode=MEMORY")
+        conn.execute("PRAGMA synchronous=OFF")
+        before_count = stage_inputs(conn, input_files)
+        if before_count == 0:
+            print("[ERROR] 読み込めるファイルがありませんでした")
+            return False
+        print(f"\n統合前の総フレーズ数: {before_count}")
+
+        has_db = False
+        if policy == "most-used":
+            if db_path and os.path.exists(db_path):
+                conn.execute("ATTACH DATABASE ? AS db", (db_path,))
+                has_db = True
+            else:
+                print(f"[WARN] DB が見つからないため、先に出てきた訳を優先します: {db_path}")
+
+        # 保存（チャンクごとに書き出す）
+        after_count = 0
+        cur = conn.execute(select_sql(policy, has_db))
+        with open(output_file, "w", newline="", encoding="utf-8-sig") as f:
+            w = csv.writer(f)
+            w.writerow(COLUMNS)
+            while True:
+                rows = cur.fetchmany(CHUNK_SIZE)
+                if not rows:
+                    break
+                w.writerows(rows)
+                after_count += len(rows)
+
+        print(f"重複削除後: {after_count}（方針: {policy}）")
+        print(f"削除された重複: {before_count - after_count}")
+
+        conflicts = None
+        if report_file:
+            conflicts = write_conflicts(conn, report_file)
+    finally:
+        conn.close()
+        os.remove(staging_path)
+
     print("\n" + "=" * 60)
     print("[完成しました！]")
     print("=" * 60)
     print(f"出力ファイル: {output_file}")
-    print(f"最終フレーズ数: {len(final_df)}")
+    print(f"最終フレーズ数: {after_count}")
+    if conflicts is not None:
+        print(f"訳が食い違う原文: {conflicts}件（レポート: {report_file}）")
     print("=" * 60)
-    
+
     return True
 
-if __name__ == "__main__":
-    # 統合するファイルのリスト
-    input_files = [
-        "BiKenS6E6_dictionary.csv",
-        "BiKen5_3_Mech_dictionary.csv",
-        "BiKenS1E4_Beach_dictionary.csv"
-    ]
-    
-    output_file = "complete_dictionary.csv"
-    
-    merge_csv_files(input_files, output_file)
+def main(args):
+    output_file = DEFAULT_OUTPUT
+    policy = "first"
+    db_path = "phrases.db"
+    report_file = None
+    patterns = []
+    i = 0
+    while i < len(args):
+        if args[i] in ("-o", "--output", "--policy", "--db", "--report") and i + 1 < len(args):
+            value = args[i + 1]
+            if args[i] in ("-o", "--output"):
+                output_file = value
+            elif args[i] == "--policy":
+                policy = value
+            elif args[i] == "--db":
+                db_path = value
+            else:
+                report_file = value
+            i += 2
+        else:
+            patterns.append(args[i])
+            i += 1
 
+    # 入力の指定がなければ従来どおりの3ファイルを統合
+    input_files = expand_inputs(patterns) if patterns else DEFAULT_INPUTS
+    if policy == "all" and report_file is None:
+        report_file = os.path.splitext(output_file)[0] + "_conflicts.csv"
+
+    if not merge_csv_files(input_files, output_file, policy, db_path, report_file):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
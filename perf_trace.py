@@ -0,0 +1,219 @@
+# perf_trace.py
+# 処理時間の計測（区間ごとの時間を Streamlit の再実行単位でまとめ、直近の分をプロセス内に残す）
+# 計測中でないスレッド（バックグラウンドの書き込みなど）では span() は何もしないので、本番でも有効のままでよい
+
+import contextvars
+import cProfile
+import io
+import json
+import math
+import pstats
+import threading
+import time
+from collections import defaultdict, deque
+
+RECENT_REQUESTS = 500     # 百分位の計算に使う直近の再実行数
+PERCENTILES = [50, 95, 99]
+SQL_LABEL_LENGTH = 80     # トレースに残す SQL の長さ
+PROFILE_LINES = 40        # cProfile の結果として残す関数の数
+TOTAL = "(合計)"
+
+_current = contextvars.ContextVar("perf_trace", default=None)
+_profile_lock = threading.Lock()
+
+class Trace:
+    """1回の再実行で記録した区間のリスト"""
+
+    def __init__(self, name, profile=False):
+        self.name = name
+        self.wall = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.spans = []     # (区間名, 開始からの秒, 秒, 詳細)
+        self.error = None   # 失敗したときの例外（"型: メッセージ"）
+        self.profile = None
+        self._profiler = None
+        # cProfile はプロセス内で同時に1つしか動かせないので、他のセッションが取っている間は取らない
+        if profile and _profile_lock.acquire(blocking=False):
+            try:
+                self._profiler = cProfile.Profile()
+                self._profiler.enable()
+            except ValueError:          # 別のプロファイラーが動いている
+                self._profiler = None
+                _profile_lock.release()
+
+    def add(self, name, start, elapsed, detail=""):
+        self.spans.append((name, start - self.start, elapsed, detail))
+
+    def totals(self):
+        """区間名ごとの合計秒数（入れ子の区間はそれぞれに数える）"""
+        out = defaultdict(float)
+        for name, _, elapsed, _ in self.spans:
+            out[name] += elapsed
+        if self.duration is not None:
+            out[TOTAL] = self.duration
+        return dict(out)
+
+    def _stop_profiler(self):
+        if self._profiler is None:
+            return
+        self._profiler.disable()
+        _profile_lock.release()
+        buf = io.StringIO()
+        pstats.Stats(self._profiler, stream=buf).sort_stats("cumulative").print_stats(PROFILE_LINES)
+        self.profile = buf.getvalue()
+        self._profiler = None
+
+class _Span:
+    __slots__ = ("trace", "name", "detail", "start")
+
+    def __init__(self, trace, name, detail):
+        self.trace = trace
+        self.name = name
+        self.detail = detail
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.add(self.name, self.start, time.perf_counter() - self.start, self.detail)
+        return False
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NO_SPAN = _NoSpan()
+
+def span(name, detail=""):
+    """with span("search"): ... で区間の時間を記録する（計測中でなければ何もしない）"""
+    trace = _current.get()
+    if trace is None:
+        return _NO_SPAN
+    return _Span(trace, name, detail)
+
+class TracedLock:
+    """with で使うロック（RLock・Semaphore など）。すぐに取れず待たされたときだけ、待った時間を区間 name に記録する"""
+
+    __slots__ = ("_lock", "name")
+
+    def __init__(self, lock, name):
+        self._lock = lock
+        self.name = name
+
+    def __enter__(self):
+        if not self._lock.acquire(blocking=False):
+            with span(self.name):
+                self._lock.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self._lock.release()
+        return False
+
+def sql_span(sql):
+    """SQL 文1つ分の区間（詳細には文の先頭を残す）"""
+    trace = _current.get()
+    if trace is None:
+        return _NO_SPAN
+    return _Span(trace, "sql", " ".join(sql.split())[:SQL_LABEL_LENGTH])
+
+class Recorder:
+    """終わった再実行を直近 size 件だけ残す"""
+
+    def __init__(self, size=RECENT_REQUESTS):
+        self._lock = threading.Lock()
+        self._traces = deque(maxlen=size)
+
+    def add(self, trace):
+        with self._lock:
+            self._traces.append(trace)
+
+    def recent(self):
+        with self._lock:
+            return list(self._traces)
+
+_recorder = Recorder()
+_listeners = []
+
+def add_listener(fn):
+    """終わった記録を fn(trace) で受け取る（直近の分だけでなくすべて集めたいとき。負荷試験など）"""
+    _listeners.append(fn)
+
+def remove_listener(fn):
+    if fn in _listeners:
+        _listeners.remove(fn)
+
+def start(name="rerun", profile=False):
+    """このスレッドで計測を始める。profile=True なら cProfile も取る
+
+    前の再実行が st.stop() / st.rerun() で途中終了していた場合は、その分は捨てる。
+    """
+    previous = _current.get()
+    if previous is not None:
+        previous._stop_profiler()
+    trace = Trace(name, profile)
+    _current.set(trace)
+    return trace
+
+def finish(trace):
+    """計測を終えて記録に加える"""
+    trace._stop_profiler()
+    trace.duration = time.perf_counter() - trace.start
+    if _current.get() is trace:
+        _current.set(None)
+    _recorder.add(trace)
+    for fn in list(_listeners):
+        fn(trace)
+    return trace
+
+def recent(name=None):
+    """直近の記録（name を渡すとその名前の記録だけ）"""
+    traces = _recorder.recent()
+    return traces if name is None else [t for t in traces if t.name == name]
+
+def _percentile(sorted_values, p):
+    # 最近傍順位法
+    k = max(0, math.ceil(p / 100 * len(sorted_values)) - 1)
+    return sorted_values[k]
+
+def percentiles(traces=None):
+    """区間ごとの回数と p50 / p95 / p99（ミリ秒）。[{区間, 回数, p50, ...}, ...] を返す
+
+    値は再実行ごとの合計（1回の再実行で同じ区間が何度あっても1つにまとめる）。
+    """
+    traces = _recorder.recent() if traces is None else traces
+    values = defaultdict(list)
+    for trace in traces:
+        for name, seconds in trace.totals().items():
+            values[name].append(seconds * 1000)
+    rows = []
+    for name in sorted(values, key=lambda n: (n != TOTAL, n)):
+        v = sorted(values[name])
+        row = {"区間": name, "回数": len(v)}
+        for p in PERCENTILES:
+            row[f"p{p} (ms)"] = round(_percentile(v, p), 2)
+        rows.append(row)
+    return rows
+
+def chrome_trace(traces=None):
+    """直近の記録を Chrome のトレース形式（chrome://tracing / Perfetto で開ける JSON）にする"""
+    traces = _recorder.recent() if traces is None else traces
+    events = []
+    for n, trace in enumerate(traces):
+        base = trace.wall * 1e6
+        events.append({"name": trace.name, "ph": "X", "pid": 1, "tid": n,
+                       "ts": base, "dur": (trace.duration or 0) * 1e6})
+        for name, offset, elapsed, detail in trace.spans:
+            event = {"name": name, "ph": "X", "pid": 1, "tid": n,
+                     "ts": base + offset * 1e6, "dur": elapsed * 1e6}
+            if detail:
+                event["args"] = {"detail": detail}
+            events.append(event)
+    return json.dumps({"traceEvents": events}, ensure_ascii=False).encode("utf-8")
@@ -0,0 +1,295 @@
+# phrase_db.py
+# phrases テーブルの共通処理（app.py と import_to_db.py から使う）
+
+import csv
+import io
+import sqlite3
+import pandas as pd
+from datetime import datetime
+from search_index import (ensure_fts, ensure_tags, ensure_version, like_pattern, merge_tags, normalize_source,
+                          split_tags, tag_filter_sql)
+from db_connection import connection
+from delta_sync import ensure_change_log
+import dedupe
+
+DB_PATH = "phrases.db"
+TABLE = "phrases"
+CHUNK_SIZE = 5000  # 一括取り込みで1トランザクションにまとめる行数
+SKIP_TARGETS = ["", "[要確認]"]  # 取り込まない訳
+PAGE_SORTS = ["usage_count", "created_at"]  # 一覧の並び順（どちらも降順・インデックスあり）
+EXPORT_COLUMNS = ["id", "source", "target", "context", "tags", "created_at", "usage_count"]
+EXPORT_FETCH_SIZE = 5000   # エクスポートで一度に読む行数
+EXPORT_FORMATS = ["csv", "parquet"]
+
+def init_db(db_path=DB_PATH):
+    """テーブル・インデックスを作成"""
+    with connection(db_path) as conn:
+        conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {TABLE} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            source TEXT NOT NULL,
+            target TEXT NOT NULL,
+            context TEXT,
+            tags TEXT,
+            created_at TEXT,
+            usage_count INTEGER DEFAULT 0
+        )
+        """)
+        conn.commit()
+        ensure_unique_source(conn)
+        ensure_normalized_source(conn)
+        # 一覧のページ送り（キーセット方式）用
+        for col in PAGE_SORTS:
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{TABLE}_{col} ON {TABLE}({col}, id)")
+        conn.commit()
+        # 検索インデックスの更新検知用
+        ensure_version(conn, TABLE)
+        # 検索候補の絞り込み用（trigram 全文検索）
+        ensure_fts(conn, TABLE)
+        # タグでの絞り込み用（tags を1タグ1行に分けたもの）
+        ensure_tags(conn, TABLE)
+        # 差分同期用の変更ログ（delta_sync.py）
+        ensure_change_log(conn, TABLE)
+        # 統合した原文の別表記（dedupe.py）
+        dedupe.ensure_alias_table(conn)
+
+def ensure_unique_source(conn):
+    """source に UNIQUE インデックスを作成（ON CONFLICT(source) で使う）
+
+    古いDBに同じ source の行が残っている場合は、最初の行（id が最小）に
+    usage_count を合算して残りを削除してから作成する。
+    """
+    sql = f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{TABLE}_source ON {TABLE}(source)"
+    try:
+        conn.execute(sql)
+    except sqlite3.IntegrityError:
+        with conn:
+            conn.execute(f"""
+                UPDATE {TABLE} SET usage_count = (
+                    SELECT SUM(usage_count) FROM {TABLE} AS d WHERE d.source = {TABLE}.source)
+                WHERE id IN (SELECT MIN(id) FROM {TABLE} GROUP BY source HAVING COUNT(*) > 1)
+            """)
+            conn.execute(f"DELETE FROM {TABLE} WHERE id NOT IN (SELECT MIN(id) FROM {TABLE} GROUP BY source)")
+        conn.execute(sql)
+    conn.commit()
+
+def ensure_normalized_source(conn):
+    """完全一致の検索用に normalized_source 列（search_index.normalize_source）とインデックスを用意する
+
+    古いDBでは列を追加する。値が入っていない行（列を追加する前の行や、
+    この列を知らない書き込みで入った行）はここで埋める。
+    """
+    columns = [r[1] for r in conn.execute(f"PRAGMA table_info({TABLE})")]
+    if "normalized_source" not in columns:
+        conn.execute(f"ALTER TABLE {TABLE} ADD COLUMN normalized_source TEXT")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{TABLE}_normalized_source ON {TABLE}(normalized_source)")
+    rows = conn.execute(f"SELECT id, source FROM {TABLE} WHERE normalized_source IS NULL").fetchall()
+    if rows:
+        with conn:
+            conn.executemany(f"UPDATE {TABLE} SET normalized_source = ? WHERE id = ?",
+                             [(normalize_source(source), pid) for pid, source in rows])
+    conn.commit()
+
+# source は変わらないので、normalized_source は挿入のときだけ入れる
+UPSERT_SQL = f"""
+    INSERT INTO {TABLE}(source, target, context, tags, created_at, normalized_source) VALUES (?,?,?,?,?,?)
+    ON CONFLICT(source) DO UPDATE SET
+        target=excluded.target, context=excluded.context, tags=excluded.tags
+"""
+
+def load_all_phrases(db_path=DB_PATH):
+    with connection(db_path) as conn:
+        return pd.read_sql_query(f"SELECT {', '.join(EXPORT_COLUMNS)} FROM {TABLE} "
+                                 f"ORDER BY usage_count DESC, created_at DESC", conn)
+
+def fetch_page(sort="usage_count", page_size=50, after=None,
+               source="", target="", tags="", db_path=DB_PATH):
+    """一覧の1ページ分だけを取得。(DataFrame, 次ページのカーソル or None) を返す
+
+    (sort 列, id) の降順でキーセット方式のページ送りを行うので、何ページ目でも
+    インデックスをたどるだけで済む。after には前のページが返したカーソルを渡す。
+    source・target は部分一致（source は3文字以上なら trigram 全文検索を使う）。
+    tags はカンマ区切りのタグをすべて持つ行（phrase_tags で完全一致。"Ep1" で "Ep10" は出ない）。
+    """
+    if sort not in PAGE_SORTS:
+        raise ValueError(f"sort は {PAGE_SORTS} のいずれか: {sort}")
+    where, params = [], []
+    if source:
+        if len(source) >= 3:
+            where.append(f"id IN (SELECT rowid FROM {TABLE}_fts WHERE {TABLE}_fts MATCH ?)")
+            params.append('"' + source.replace('"', '""') + '"')
+        else:
+            where.append("source LIKE ? ESCAPE '\\'")
+            params.append(like_pattern(source))
+    if target:
+        where.append("target LIKE ? ESCAPE '\\'")
+        params.append(like_pattern(target))
+    if split_tags(tags):
+        tag_sql, tag_params = tag_filter_sql(split_tags(tags))
+        where.append(f"id IN ({tag_sql})")
+        params.extend(tag_params)
+    if after is not None:
+        where.append(f"({sort}, id) < (?, ?)")
+        params.extend(after)
+    sql = f"SELECT {', '.join(EXPORT_COLUMNS)} FROM {TABLE}"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY {sort} DESC, id DESC LIMIT ?"
+    params.append(page_size + 1)
+    with connection(db_path) as conn:
+        cur = conn.execute(sql, params)
+        rows = cur.fetchall()
+        columns = [d[0] for d in cur.description]
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last = dict(zip(columns, rows[-1]))
+        next_cursor = (last[sort], last["id"])
+    return pd.DataFrame(rows, columns=columns), next_cursor
+
+def iter_export_chunks(tags="", since="", db_path=DB_PATH, fetch_size=EXPORT_FETCH_SIZE):
+    """エクスポート対象をカーソルで少しずつ読む（行タプルのリストを返すジェネレータ）
+
+    tags はカンマ区切りのタグをすべて持つ行（fetch_page と同じ）、since は created_at の下限（例: 2025-01-01）。
+    並び順は一覧と同じ使用回数の多い順（インデックスをたどるので全件ソートしない）。
+    """
+    where, params = [], []
+    if split_tags(tags):
+        tag_sql, tag_params = tag_filter_sql(split_tags(tags))
+        where.append(f"id IN ({tag_sql})")
+        params.extend(tag_params)
+    if since:
+        where.append("created_at >= ?")
+        params.append(since)
+    sql = f"SELECT {', '.join(EXPORT_COLUMNS)} FROM {TABLE}"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY usage_count DESC, id DESC"
+    with connection(db_path) as conn:
+        cur = conn.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(fetch_size)
+            if not rows:
+                break
+            yield rows
+
+def export_phrases(f, fmt="csv", tags="", since="", db_path=DB_PATH):
+    """辞書をバイナリファイル f に書き出す。書き出した行数を返す
+
+    csv は Excel 対応の BOM 付き UTF-8、parquet は列指向（pyarrow が必要）。
+    チャンクごとに書くので、辞書全体をメモリに載せない。
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"形式は {EXPORT_FORMATS} のいずれか: {fmt}")
+    chunks = iter_export_chunks(tags, since, db_path)
+    total = 0
+    if fmt == "csv":
+        f.write("\ufeff".encode("utf-8"))  # Excel対応のためBOM付き
+        f.write(_csv_bytes([EXPORT_COLUMNS]))
+        for rows in chunks:
+            f.write(_csv_bytes(rows))
+            total += len(rows)
+        return total
+
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Parquet で出力するには pyarrow が必要です（pip install pyarrow）")
+    schema = pa.schema([("id", pa.int64()), ("source", pa.string()), ("target", pa.string()),
+                        ("context", pa.string()), ("tags", pa.string()),
+                        ("created_at", pa.string()), ("usage_count", pa.int64())])
+    with pq.ParquetWriter(f, schema) as writer:
+        for rows in chunks:
+            writer.write_table(pa.Table.from_pylist([dict(zip(EXPORT_COLUMNS, r)) for r in rows], schema=schema))
+            total += len(rows)
+    return total
+
+def _csv_bytes(rows):
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    return buf.getvalue().encode("utf-8")
+
+def upsert_phrase(source, target, context="", tags="", db_path=DB_PATH):
+    """同一 source があれば更新、なければ挿入。(id, created_at) を返す
+
+    source が統合済みの別表記で訳が統合先と同じなら、統合先の行を更新する
+    （訳が違うときは統合先を上書きせず、別表記の原文のまま登録する）。
+    """
+    now = datetime.utcnow().isoformat()
+    with connection(db_path) as conn:
+        source = dedupe.resolve_aliases(conn, [source], [target]).get(source, source)
+        with conn:
+            # 書き込みロックは最初に取る（ロック待ちが BEGIN IMMEDIATE の区間として記録される）
+            conn.execute("BEGIN IMMEDIATE")
+            cur = conn.execute(UPSERT_SQL + " RETURNING id, created_at",
+                               (source, target, context, tags, now, normalize_source(source)))
+            pid, created_at = cur.fetchone()
+    return pid, created_at
+
+def increment_usage(pid, db_path=DB_PATH):
+    with connection(db_path) as conn:
+        conn.execute(f"UPDATE {TABLE} SET usage_count = usage_count + 1 WHERE id = ?", (pid,))
+        conn.commit()
+
+def clean_chunk(chunk):
+    """CSVのチャンクを (source, target, context, tags) の DataFrame に整える。
+    [要確認] や空の訳・原文の行は除く。(DataFrame, スキップ件数) を返す
+    """
+    if "source" not in chunk.columns or "target" not in chunk.columns:
+        raise ValueError("CSVに source と target 列が必要です")
+    out = pd.DataFrame({"source": chunk["source"].fillna("").astype(str).str.strip(),
+                        "target": chunk["target"].fillna("").astype(str).str.strip()})
+    for col in ["context", "tags"]:
+        out[col] = chunk[col].fillna("").astype(str).str.strip() if col in chunk.columns else ""
+    keep = ~out["target"].isin(SKIP_TARGETS) & (out["source"] != "")
+    return out[keep], int((~keep).sum())
+
+def bulk_upsert(conn, df, now=None):
+    """整形済みの DataFrame を1トランザクションで upsert。(新規, 更新) 件数を返す"""
+    now = now or datetime.utcnow().isoformat()
+    # 統合済みの別表記は統合先の原文に置き換える（重複を作り直さないように）
+    aliases = dedupe.resolve_aliases(conn, df["source"], df["target"])
+    if aliases:
+        df = df.assign(source=df["source"].map(lambda s: aliases.get(s, s)))
+    rows = zip(df["source"], df["target"], df["context"], df["tags"], [now] * len(df),
+               [normalize_source(s) for s in df["source"]])
+    with conn:
+        # 件数を正しく数えるため、最初に書き込みロックを取る
+        conn.execute("BEGIN IMMEDIATE")
+        max_id = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {TABLE}").fetchone()[0]
+        conn.executemany(UPSERT_SQL, rows)
+        # AUTOINCREMENT なので、取り込み前の最大 id より大きいものが新規分
+        inserted = conn.execute(f"SELECT COUNT(*) FROM {TABLE} WHERE id > ?", (max_id,)).fetchone()[0]
+    return inserted, len(df) - inserted
+
+def import_csv(path_or_buffer, db_path=DB_PATH, chunksize=CHUNK_SIZE, progress=None, dedupe_threshold=None,
+               tags=""):
+    """CSVをチャンクごとに読み込んで一括 upsert する
+
+    progress を渡すと、チャンクごとに progress(処理済み行数, counts) を呼ぶ。
+    dedupe_threshold を渡すと、取り込み後に新しく入った行と、まとめ方のキーと訳が同じ原文を統合する（dedupe.py）。
+    tags を渡すと、全行の tags に追加する（取り込むファイル名・エピソード名など）。
+    counts（inserted / updated / skipped / merged）を返す。
+    """
+    counts = {"inserted": 0, "updated": 0, "skipped": 0, "merged": 0}
+    with connection(db_path) as conn:
+        max_id = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {TABLE}").fetchone()[0]
+        done = 0
+        for chunk in pd.read_csv(path_or_buffer, encoding='utf-8-sig', dtype=str, chunksize=chunksize):
+            df, skipped = clean_chunk(chunk)
+            if tags:
+                df = df.assign(tags=[merge_tags(t, tags) for t in df["tags"]])
+            inserted, updated = bulk_upsert(conn, df)
+            counts["inserted"] += inserted
+            counts["updated"] += updated
+            counts["skipped"] += skipped
+            done += len(chunk)
+            if progress:
+                progress(done, counts)
+        if dedupe_threshold is not None and counts["inserted"]:
+            new_ids = {r[0] for r in conn.execute(f"SELECT id FROM {TABLE} WHERE id > ?", (max_id,))}
+            clusters = dedupe.load_clusters(conn, dedupe_threshold, new_ids)
+            if clusters:
+                counts["merged"] = dedupe.apply_clusters(conn, clusters)
+    return counts
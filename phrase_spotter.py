@@ -0,0 +1,227 @@
+# phrase_spotter.py
+# 長い文・台本全体の中から、辞書にあるフレーズ（キャラクター名・決めゼリフなど）をすべて探す
+# 使い方: python phrase_spotter.py <台本（.txt / .srt）> [出力CSV] [--min-words 2] [--all]
+#
+# 辞書の原文を単語列にして Aho–Corasick オートマトンを作り、入力を先頭から1回なぞるだけで
+# 含まれるフレーズを（重なっているものも含めて）全部見つける。辞書の件数には依存しない。
+# 単語単位で照合するので、"Kid" が "Kids" の中に見つかるようなことはない。
+
+import bisect
+import os
+import re
+import sys
+from array import array
+import pandas as pd
+
+PENDING_LIMIT = 2000   # 追加分をオートマトンに入れずに持つ上限（超えたら作り直す）
+_TOKEN = re.compile(r"[^\W_]+")
+_SHIFT = 24            # 遷移表のキー: (状態 << _SHIFT) | 単語番号
+
+def tokenize(text):
+    """小文字の単語のリスト（記号・空白で区切る。default_process と同じ区切り方）"""
+    return _TOKEN.findall(str(text).lower())
+
+class PhraseAutomaton:
+    """単語列の Aho–Corasick オートマトン
+
+    フレーズは呼び出し側の番号（PhraseIndex の位置）で登録する。同じ単語列のフレーズが
+    複数あってもよい（"Yes!" と "Yes." など）。状態ごとの dict は持たず、遷移は1つの dict、
+    失敗リンクなどは array にまとめてメモリを抑える。
+
+    作った後に追加されたフレーズは pending に持ち、照合時に先頭の単語から直接比べる。
+    pending が PENDING_LIMIT を超えたら needs_rebuild が True になる。
+    """
+
+    def __init__(self, phrases=()):
+        self._vocab = {}              # 単語 → 単語番号
+        self._goto = {}
+        self._parent = array("i", [0])
+        self._word = array("i", [0])
+        self._depth = array("i", [0])
+        self._fail = array("i", [0])
+        self._link = array("i", [0])  # 失敗リンクをたどって最初に出力を持つ状態（なければ 0）
+        self._out = {}                # 状態 → そこで終わるフレーズの番号のリスト
+        self._pending = {}            # 先頭の単語 → [(番号, 単語列), ...]
+        self.pending = 0
+        self.size = 0
+        for n, words in phrases:
+            self._insert(n, words)
+        self._build_links()
+
+    def _insert(self, n, words):
+        if not words:
+            return
+        vocab, goto, parent, word, depth = self._vocab, self._goto, self._parent, self._word, self._depth
+        state = 0
+        for w in words:
+            t = vocab.get(w)
+            if t is None:
+                t = vocab[w] = len(vocab) + 1
+            key = (state << _SHIFT) | t
+            nxt = goto.get(key)
+            if nxt is None:
+                nxt = goto[key] = len(parent)
+                parent.append(state)
+                word.append(t)
+                depth.append(depth[state] + 1)
+            state = nxt
+        self._out.setdefault(state, []).append(n)
+        self.size += 1
+
+    def _build_links(self):
+        # 状態は親より後に作られるので、深さ順に並べれば幅優先の順になる
+        count = len(self._parent)
+        self._fail = array("i", bytes(4 * count))
+        self._link = array("i", bytes(4 * count))
+        goto, fail, link, out, parent, word = (self._goto, self._fail, self._link, self._out,
+                                               self._parent, self._word)
+        levels = [[] for _ in range(max(self._depth, default=0) + 1)]
+        for s, d in enumerate(self._depth):
+            levels[d].append(s)
+        for level in levels[2:]:      # 深さ 1 の失敗リンクはすべて根（0）
+            for s in level:
+                t = word[s]
+                f = fail[parent[s]]
+                while f and ((f << _SHIFT) | t) not in goto:
+                    f = fail[f]
+                f = goto.get((f << _SHIFT) | t, 0)
+                fail[s] = f
+                link[s] = f if f in out else link[f]
+
+    def add(self, n, words):
+        """作った後に追加されたフレーズ"""
+        if words:
+            self._pending.setdefault(words[0], []).append((n, tuple(words)))
+            self.pending += 1
+            self.size += 1
+
+    @property
+    def needs_rebuild(self):
+        return self.pending > PENDING_LIMIT
+
+    def find(self, words):
+        """単語列の中のフレーズをすべて探す。[(開始の単語位置, 終了の単語位置（含まない）, 番号), ...] を返す"""
+        goto, fail, link, depth, out, vocab = (self._goto, self._fail, self._link, self._depth,
+                                               self._out, self._vocab)
+        found = []
+        state = 0
+        for i, w in enumerate(words):
+            t = vocab.get(w)
+            if t is None:
+                state = 0
+            else:
+                while state and ((state << _SHIFT) | t) not in goto:
+                    state = fail[state]
+                state = goto.get((state << _SHIFT) | t, 0)
+                s = state if state in out else link[state]
+                while s:
+                    for n in out[s]:
+                        found.append((i + 1 - depth[s], i + 1, n))
+                    s = link[s]
+            for n, phrase in self._pending.get(w, ()):
+                if tuple(words[i:i + len(phrase)]) == phrase:
+                    found.append((i, i + len(phrase), n))
+        return found
+
+def drop_contained(matches):
+    """他の一致に完全に含まれる一致を除く（同じ範囲の一致どうしは残す）
+
+    matches は start / end を持つ dict のリスト。開始位置・長い順に並べ替えて返す。
+    """
+    matches = sorted(matches, key=lambda m: (m["start"], -m["end"]))
+    out, reach, last = [], -1, None
+    for m in matches:
+        span_ = (m["start"], m["end"])
+        if m["end"] <= reach and span_ != last:
+            continue
+        out.append(m)
+        if m["end"] > reach:
+            reach, last = m["end"], span_
+    return out
+
+def spot_matches(automaton, text, min_words=1, key=None, rank=None):
+    """text の中の一致を [{start, end, line, text, n}, ...]（start / end は文字位置）で返す
+
+    key を渡すと、同じ範囲で key(n) が同じ一致（表記だけ違う辞書の行）は1件にまとめる。
+    残すのは rank(n) が一番小さいもの（rank がなければ最初に見つかったもの）。
+    """
+    tokens = list(_TOKEN.finditer(str(text)))
+    words = [m.group().lower() for m in tokens]
+    line_starts = [0] + [m.end() for m in re.finditer("\n", str(text))]
+    best = {}
+    for a, b, n in automaton.find(words):
+        if b - a < min_words:
+            continue
+        k = (a, b, key(n) if key else n)
+        if k not in best or (rank and rank(n) < rank(best[k])):
+            best[k] = n
+    out = []
+    for (a, b, _), n in best.items():
+        start, end = tokens[a].start(), tokens[b - 1].end()
+        out.append({"start": start, "end": end, "line": bisect.bisect_right(line_starts, start),
+                    "text": text[start:end], "n": n})
+    return out
+
+def frame_from_matches(matches):
+    """PhraseIndex.spot の結果を表示・CSV 用の DataFrame にする"""
+    return pd.DataFrame({
+        "line": [m["line"] for m in matches],
+        "start": [m["start"] for m in matches],
+        "end": [m["end"] for m in matches],
+        "text": [m["text"] for m in matches],
+        "source": [m["row"]["source"] for m in matches],
+        "target": [m["row"]["target"] for m in matches],
+        "id": pd.array([m["row"]["id"] for m in matches], dtype="Int64"),
+    }, columns=["line", "start", "end", "text", "source", "target", "id"])
+
+def main(args):
+    from create_dictionary import iter_subs, normalize_text
+    from search_index import get_index
+    from phrase_db import DB_PATH, TABLE, init_db
+
+    min_words = 1
+    if "--min-words" in args:
+        i = args.index("--min-words")
+        min_words = int(args[i + 1])
+        del args[i:i + 2]
+    longest_only = "--all" not in args
+    args = [a for a in args if a != "--all"]
+    if not args:
+        print("使い方: python phrase_spotter.py <台本（.txt / .srt）> [出力CSV] [--min-words 2] [--all]")
+        print("  --all を付けると、長いフレーズに含まれる短いフレーズも出力します")
+        sys.exit(1)
+    in_path = args[0]
+    out_csv = args[1] if len(args) > 1 else os.path.splitext(os.path.basename(in_path))[0] + "_phrases.csv"
+
+    print("=" * 60)
+    print("フレーズ検出ツール（台本に含まれる辞書のフレーズを探す）")
+    print("=" * 60)
+
+    if not os.path.exists(in_path):
+        print(f"[ERROR] ファイルが見つかりません: {in_path}")
+        sys.exit(1)
+    if not os.path.exists(DB_PATH):
+        print(f"[ERROR] データベースが見つかりません: {DB_PATH}")
+        sys.exit(1)
+    init_db(DB_PATH)
+    index = get_index(DB_PATH, TABLE)
+
+    # SRT は字幕ごとに1行にする（出力の line が字幕の番号になる）
+    if in_path.lower().endswith(".srt"):
+        text = "\n".join(normalize_text(s.content) for s in iter_subs(in_path))
+    else:
+        with open(in_path, encoding="utf-8-sig") as f:
+            text = f.read()
+    matches = index.spot(text, min_words=min_words, longest_only=longest_only)
+    df = frame_from_matches(matches)
+    df.to_csv(out_csv, index=False, encoding="utf-8-sig")
+
+    print("\n" + "=" * 60)
+    print("[完了しました！]")
+    print("=" * 60)
+    print(f"見つかったフレーズ: {len(df)}件（異なるフレーズ {df['id'].nunique()}件）")
+    print(f"出力ファイル: {out_csv}")
+    print("=" * 60)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,773 @@
+# search_index.py
+# あいまい検索用のプロセス共有インデックス
+# Streamlit の再実行ごとに全件を読み直さず、書き込みがあった分だけ更新する
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from array import array
+from contextlib import contextmanager
+import numpy as np
+import rapidfuzz
+from rapidfuzz import process, fuzz
+from rapidfuzz.utils import default_process
+from db_connection import connect, connection
+from perf_trace import TracedLock, span
+from dedupe import dedupe_key
+from phrase_spotter import PhraseAutomaton, drop_contained, spot_matches, tokenize
+from snapshot import open_snapshot, remove_old_snapshots, snapshot_path, write_snapshot
+
+DB_PATH = "phrases.db"
+TABLE = "phrases"
+COLUMNS = ["id", "source", "target", "context", "tags", "created_at", "usage_count"]
+
+# FTS5（trigram）による候補の絞り込み
+# クエリの trigram のうち、含む行の少ないもの（fts5vocab の文書数）から順に OR でつなぎ、
+# 含む行数の合計が FTS_CANDIDATE_CAP を超えない分だけ使う（bm25 の並べ替えはしない）。
+# 辞書が FTS_MIN_ROWS 行未満のときは全件検索の方が速いので使わない
+# （python -m benchmarks run --cases index_search_fts,index_search_full_scan で測った分かれ目）。
+FTS_MIN_ROWS = 30_000
+FTS_CANDIDATE_CAP = 5000   # 再スコアリングする候補の上限（使う trigram の文書数の合計）
+FTS_MAX_TRIGRAMS = 8       # 1クエリで使う trigram の上限
+FTS_MIN_SCORE = 50         # 候補内の最高スコアがこれ未満なら全件検索に戻す
+
+# 日本語 → 英語の逆引き（target の文字 n-gram による候補の絞り込み）
+NGRAM_SIZES = (2, 3)
+REVERSE_CANDIDATE_CAP = 2000
+
+# 表記だけ違う候補（dedupe.dedupe_key が同じもの）は1件にまとめて表示するので、多めに取っておく
+COLLAPSE_FACTOR = 3
+
+# スナップショット（snapshot.py）を書き出すまでの待ち時間（連続した書き込みは1回にまとめる）
+SNAPSHOT_DELAY = 10.0
+
+# タグ（カンマ区切りの tags 列を正規化したもの）
+TAG_TABLE = "phrase_tags"
+
+# 一括検索（process.cdist）で一度に作るスコア行列の最大要素数
+BATCH_MAX_CELLS = 20_000_000
+
+def fts_table(table=TABLE):
+    return f"{table}_fts"
+
+def fts_vocab_table(table=TABLE):
+    return f"{table}_fts_vocab"
+
+def ensure_fts(conn, table=TABLE):
+    """source の trigram 全文検索テーブルとトリガーを作成（init_db から呼ぶ）
+
+    phrases への INSERT/UPDATE/DELETE はトリガーで自動的に反映される。
+    trigram トークナイザが使えない SQLite（3.34 未満）の場合は False を返す。
+    """
+    fts = fts_table(table)
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (fts,)).fetchone()
+    try:
+        conn.executescript(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS {fts}
+            USING fts5(source, content='{table}', content_rowid='id', tokenize='trigram');
+        CREATE VIRTUAL TABLE IF NOT EXISTS {fts_vocab_table(table)} USING fts5vocab({fts}, 'row');
+        CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN
+            INSERT INTO {fts}(rowid, source) VALUES (new.id, new.source);
+        END;
+        CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN
+            INSERT INTO {fts}({fts}, rowid, source) VALUES ('delete', old.id, old.source);
+        END;
+        CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF source ON {table} BEGIN
+            INSERT INTO {fts}({fts}, rowid, source) VALUES ('delete', old.id, old.source);
+            INSERT INTO {fts}(rowid, source) VALUES (new.id, new.source);
+        END;
+        """)
+    except sqlite3.OperationalError:
+        return False
+    if not exists:
+        # 既存データを取り込む
+        conn.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+    conn.commit()
+    return True
+
+def ensure_version(conn, table=TABLE):
+    """検索対象の列が変わるたびに増える版数を {table}_meta に用意する（init_db から呼ぶ）
+
+    usage_count だけの更新では増えないので、採用クリックでインデックスが読み直されることはない。
+    """
+    conn.executescript(f"""
+    CREATE TABLE IF NOT EXISTS {table}_meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+    INSERT OR IGNORE INTO {table}_meta(key, value) VALUES ('version', 0);
+    CREATE TRIGGER IF NOT EXISTS {table}_version_ai AFTER INSERT ON {table} BEGIN
+        UPDATE {table}_meta SET value = value + 1 WHERE key = 'version';
+    END;
+    CREATE TRIGGER IF NOT EXISTS {table}_version_ad AFTER DELETE ON {table} BEGIN
+        UPDATE {table}_meta SET value = value + 1 WHERE key = 'version';
+    END;
+    CREATE TRIGGER IF NOT EXISTS {table}_version_au AFTER UPDATE OF source, target, context, tags ON {table} BEGIN
+        UPDATE {table}_meta SET value = value + 1 WHERE key = 'version';
+    END;
+    """)
+    conn.commit()
+
+def ensure_tags(conn, table=TABLE):
+    """tags（カンマ区切り）を1タグ1行に分けた {TAG_TABLE} とトリガーを作成（init_db から呼ぶ）
+
+    phrases への INSERT/UPDATE/DELETE はトリガーで自動的に反映されるので、
+    upsert_phrase・一括取り込み・差分同期・統合のどの書き込みでも同じように保たれる。
+    タグの比較は大文字小文字を区別しない。
+    """
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (TAG_TABLE,)).fetchone()
+    # json_quote でエスケープしてからカンマを区切りに置き換え、json_each で1行ずつにする
+    split = "json_each('[' || replace(json_quote(COALESCE({}.tags, '')), ',', '\",\"') || ']')"
+    conn.executescript(f"""
+    CREATE TABLE IF NOT EXISTS {TAG_TABLE} (
+        tag TEXT NOT NULL COLLATE NOCASE,
+        phrase_id INTEGER NOT NULL,
+        PRIMARY KEY (tag, phrase_id)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_{TAG_TABLE}_phrase_id ON {TAG_TABLE}(phrase_id);
+    CREATE TRIGGER IF NOT EXISTS {TAG_TABLE}_ai AFTER INSERT ON {table} BEGIN
+        INSERT OR IGNORE INTO {TAG_TABLE}(tag, phrase_id)
+            SELECT trim(value), new.id FROM {split.format("new")} WHERE trim(value) <> '';
+    END;
+    CREATE TRIGGER IF NOT EXISTS {TAG_TABLE}_ad AFTER DELETE ON {table} BEGIN
+        DELETE FROM {TAG_TABLE} WHERE phrase_id = old.id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS {TAG_TABLE}_au AFTER UPDATE OF tags ON {table}
+        WHEN old.tags IS NOT new.tags BEGIN
+        DELETE FROM {TAG_TABLE} WHERE phrase_id = old.id;
+        INSERT OR IGNORE INTO {TAG_TABLE}(tag, phrase_id)
+            SELECT trim(value), new.id FROM {split.format("new")} WHERE trim(value) <> '';
+    END;
+    """)
+    if not exists:
+        # 既存データを取り込む
+        conn.execute(f"""
+            INSERT OR IGNORE INTO {TAG_TABLE}(tag, phrase_id)
+            SELECT trim(j.value), p.id FROM {table} AS p, {split.format("p")} AS j WHERE trim(j.value) <> ''
+        """)
+    conn.commit()
+
+def split_tags(text):
+    """カンマ区切りのタグをリストにする（前後の空白を除き、空のものは除く）"""
+    return [t.strip() for t in str(text or "").split(",") if t.strip()]
+
+def merge_tags(*texts):
+    """カンマ区切りのタグをつなげる（重複は除く）"""
+    return ",".join(dict.fromkeys(t for text in texts for t in split_tags(text)))
+
+def tag_counts(db_path=DB_PATH, table=TABLE):
+    """タグごとの件数。[(タグ, 件数), ...] を件数の多い順に返す
+
+    Streamlit の再実行ごとに全件を数え直さないよう、DB の版数（{table}_meta）が変わるまで結果を使い回す。
+    """
+    with connection(db_path) as conn:
+        version = conn.execute(f"SELECT value FROM {table}_meta WHERE key = 'version'").fetchone()[0]
+        with _tag_counts_lock:
+            cached = _tag_counts.get(db_path)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        counts = conn.execute(f"SELECT tag, COUNT(*) FROM {TAG_TABLE} GROUP BY tag "
+                              f"ORDER BY COUNT(*) DESC, tag").fetchall()
+    with _tag_counts_lock:
+        _tag_counts[db_path] = (version, counts)
+    return counts
+
+_tag_counts = {}    # db_path -> (版数, 件数)
+_tag_counts_lock = threading.Lock()
+
+def tag_filter_sql(tags):
+    """すべてのタグを持つ行（AND、大文字小文字は区別しない）の id を返すサブクエリと引数"""
+    tags = list({t.lower(): t for t in tags}.values())
+    return (f"SELECT phrase_id FROM {TAG_TABLE} WHERE tag IN ({', '.join('?' * len(tags))}) "
+            f"GROUP BY phrase_id HAVING COUNT(*) = ?", tags + [len(tags)])
+
+def like_pattern(text):
+    """LIKE の部分一致パターン（% と _ はそのまま検索する）"""
+    return "%" + text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+def filter_sql(table=TABLE, tags=(), context=""):
+    """タグ・コンテキストで絞り込んだ id を返す SQL と引数。絞り込みがなければ (None, [])
+
+    tags はすべてのタグを持つ行（AND）、context は部分一致。
+    """
+    where, params = [], []
+    if tags:
+        sql, tag_params = tag_filter_sql(tags)
+        where.append(f"id IN ({sql})")
+        params.extend(tag_params)
+    if context:
+        where.append("context LIKE ? ESCAPE '\\'")
+        params.append(like_pattern(context))
+    if not where:
+        return None, []
+    return f"SELECT id FROM {table} WHERE " + " AND ".join(where), params
+
+def query_trigrams(query):
+    """クエリの単語ごとの trigram（重複なし、出てきた順）"""
+    grams = []
+    for word in default_process(str(query)).split():
+        for i in range(len(word) - 2):
+            g = word[i:i + 3]
+            if g not in grams:
+                grams.append(g)
+    return grams
+
+def fts_query(grams, doc_freq, cap=FTS_CANDIDATE_CAP, max_trigrams=FTS_MAX_TRIGRAMS):
+    """含む行の少ない trigram から順に OR でつないだ FTS5 クエリを作る（語順に依存しない）
+
+    doc_freq は trigram → 含む行数。行数の合計が cap を超える手前で止める。
+    一番少ないものでも cap を超える（よくある単語だけの）クエリは None（全件検索の方がよい）。
+    """
+    picked, total = [], 0
+    for g in sorted(grams, key=lambda g: doc_freq.get(g, 0))[:max_trigrams]:
+        if total + doc_freq.get(g, 0) > cap:
+            break
+        picked.append(g)
+        total += doc_freq.get(g, 0)
+    if not picked:
+        return None
+    return " OR ".join('"' + g.replace('"', '""') + '"' for g in picked)
+
+def normalize_choice(text) -> str:
+    """検索用の正規化（小文字化・記号除去・単語の並べ替え）
+
+    token_sort_ratio と同じ前処理を事前に済ませておくことで、
+    検索時は fuzz.ratio で比較するだけになる。
+    """
+    return " ".join(sorted(default_process(str(text)).split()))
+
+# 正規化の指紋を取るときに通す文字列（大文字・記号・全角・アクセント・日本語・語順）
+NORMALIZER_PROBES = ["Hello, World!", "  Don't STOP me now  ", "Ça va? Überraschung", "ｆｕｌｌ　ｗｉｄｔｈ",
+                     "x_y-z 123", "b a c", "日本語のテキスト。"]
+
+def normalizer_fingerprint() -> int:
+    """normalize_choice の指紋（コードと rapidfuzz の版・見本の正規化結果のハッシュ）
+
+    スナップショットに正規化済みの検索対象を保存しているので、正規化が変わったら読み込まないために使う。
+    """
+    global _normalizer_fingerprint
+    if _normalizer_fingerprint is None:
+        code = normalize_choice.__code__
+        h = hashlib.blake2b(digest_size=8)
+        h.update(code.co_code + repr(code.co_consts).encode("utf-8") + rapidfuzz.__version__.encode())
+        for text in NORMALIZER_PROBES:
+            h.update(normalize_choice(text).encode("utf-8") + b"\0")
+        _normalizer_fingerprint = int.from_bytes(h.digest(), "little")
+    return _normalizer_fingerprint
+
+_normalizer_fingerprint = None
+
+def normalize_source(text) -> str:
+    """完全一致の判定用の正規化（phrases.normalized_source に保存する）
+
+    create_dictionary.normalize_text と同じ空白の畳み込みに加えて、小文字化と記号の除去をする。
+    単語の並べ替えはしないので、語順が違うものは一致しない。
+    """
+    return " ".join(default_process(str(text)).split())
+
+_NON_WORD = re.compile(r"[\W_]+")
+
+def normalize_target(text) -> str:
+    """逆引き用の正規化（全角・半角の統一、小文字化、空白と記号の除去）
+
+    日本語は単語に分かれていないので、文字単位で比べられる形にする。
+    """
+    return _NON_WORD.sub("", unicodedata.normalize("NFKC", str(text)).lower())
+
+def char_ngrams(text, sizes=NGRAM_SIZES):
+    """文字 n-gram の集合（短い文字列はそれ自体を1つの n-gram とする）"""
+    grams = {text[i:i + n] for n in sizes for i in range(len(text) - n + 1)}
+    if not grams and text:
+        grams.add(text)
+    return grams
+
+class NgramIndex:
+    """文字 n-gram → 位置 の転置インデックス
+
+    位置のリストは array('I') で持つ。訳が変わったときの古い n-gram は消さずに残すが、
+    候補は必ず今の文字列で再スコアリングするので結果には影響しない（rebuild で消える）。
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.size = 0
+
+    def add(self, pos, text):
+        for g in char_ngrams(text):
+            p = self.postings.get(g)
+            if p is None:
+                p = self.postings[g] = array("I")
+            p.append(pos)
+        self.size = max(self.size, pos + 1)
+
+    def candidates(self, text, cap):
+        """共有する n-gram の多い順（珍しい n-gram ほど重く数える）に最大 cap 個の位置を返す"""
+        lists = [self.postings[g] for g in char_ngrams(text) if g in self.postings]
+        if not lists:
+            return []
+        positions = np.concatenate([np.frombuffer(p, dtype=np.uint32) for p in lists])
+        weights = np.repeat([np.log1p(self.size / len(p)) for p in lists], [len(p) for p in lists])
+        scores = np.bincount(positions, weights=weights, minlength=self.size)
+        hit = np.flatnonzero(scores)
+        if len(hit) > cap:
+            hit = hit[np.argpartition(scores[hit], -cap)[-cap:]]
+        return hit.tolist()
+
+def write_index_snapshot(db_path=DB_PATH, table=TABLE):
+    """DB の今の内容から検索インデックスのスナップショットを書き出す。書いたパスを返す
+
+    1つの読み取りトランザクションで版数と全行を読むので、版数と中身が必ず一致する。
+    """
+    with connection(db_path) as conn:
+        conn.execute("BEGIN")
+        try:
+            version = conn.execute(f"SELECT value FROM {table}_meta WHERE key = 'version'").fetchone()[0]
+            rows = conn.execute(f"SELECT {', '.join(COLUMNS)} FROM {table} "
+                                f"ORDER BY usage_count DESC, created_at DESC").fetchall()
+        finally:
+            conn.commit()
+    data = dict(zip(COLUMNS, map(list, zip(*rows)))) if rows else {c: [] for c in COLUMNS}
+    data["normalized"] = [normalize_choice(s) for s in data["source"]]
+    path = write_snapshot(snapshot_path(db_path, version), version, max(data["id"], default=0),
+                          data, data, normalizer_fingerprint())
+    remove_old_snapshots(db_path, keep=path)
+    return path
+
+class PhraseIndex:
+    """phrases テーブルの検索用インデックス
+
+    列ごとのリストと正規化済みの検索対象を持ち、
+    process.extract の戻り値の位置からそのまま行を取り出せる。
+    """
+
+    def __init__(self, db_path=DB_PATH, table=TABLE, use_snapshot=True):
+        self.db_path = db_path
+        self.table = table
+        self.use_snapshot = use_snapshot
+        self._snapshot_timer = None
+        self._lock = TracedLock(threading.RLock(), "index.wait")   # 待たされた時間を記録する
+        self._conn = None     # 版数の確認と FTS 検索用の接続
+        self._version = None
+        self._has_fts = False
+        self._deferred = 0    # defer_refresh の入れ子の数
+        self._reset()
+
+    def _reset(self):
+        self.columns = {c: [] for c in COLUMNS}
+        self.choices = []
+        self._pos_by_id = {}
+        # 逆引き用（最初の逆引き検索のときに作り、その後は差分だけ更新する）
+        self.target_choices = None
+        self._target_ngrams = None
+        # 文中のフレーズ検出用（最初の spot のときに作り、追加分は pending として持つ）
+        self._automaton = None
+        # trigram → 含む行数（FTS の絞り込みで使うものを選ぶため。必要になった分だけ読む）
+        # 追加・更新では直さない（使う trigram の選び方が少し変わるだけで、候補は必ず再スコアリングする）
+        self._doc_freq = {}
+
+    def __len__(self):
+        return len(self.choices)
+
+    def _content_version(self):
+        if self._conn is None:
+            self._conn = connect(self.db_path)
+        return self._conn.execute(
+            f"SELECT value FROM {self.table}_meta WHERE key = 'version'").fetchone()[0]
+
+    def _append(self, values):
+        pos = len(self.choices)
+        for c in COLUMNS:
+            self.columns[c].append(values[c])
+        self._pos_by_id[values["id"]] = pos
+        if self._target_ngrams is not None:
+            self._add_target(pos, values["target"])
+        if self._automaton is not None:
+            self._automaton.add(pos, tokenize(values["source"]))
+        # 検索対象は最後に追加する（検索中のスレッドが未完成の行を参照しないように）
+        self.choices.append(normalize_choice(values["source"]))
+
+    def rebuild(self):
+        """全件を読み直す
+
+        DB の版数に合うスナップショットがあれば mmap して使い（文字列は必要になるまでデコードしない）、
+        使用回数だけは DB から読み直す。なければ DB から読んで、スナップショットをバックグラウンドで書き出す。
+        """
+        with self._lock, span("index.rebuild"):
+            version = self._content_version()
+            snap = None
+            if self.use_snapshot:
+                max_id = self._conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {self.table}").fetchone()[0]
+                snap = open_snapshot(self.db_path, version, max_id, normalizer_fingerprint())
+            if snap is not None:
+                self._load_snapshot(snap)
+            else:
+                with connection(self.db_path) as conn:
+                    cur = conn.execute(
+                        f"SELECT {', '.join(COLUMNS)} FROM {self.table} "
+                        f"ORDER BY usage_count DESC, created_at DESC")
+                    self._reset()
+                    for values in cur:
+                        self._append(dict(zip(COLUMNS, values)))
+                if self.use_snapshot:
+                    self.schedule_snapshot(0)
+            self._has_fts = self._conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = ?", (fts_table(self.table),)).fetchone() is not None
+            self._version = version
+
+    def _load_snapshot(self, snap):
+        with span("index.load_snapshot"):
+            self._reset()
+            self.columns = {c: snap.column(c) for c in COLUMNS}
+            self._pos_by_id = dict(zip(snap.ints["id"].tolist(), range(snap.rows)))
+            self.choices = snap.texts("normalized")
+            # 使用回数だけの更新では版数が増えないので、スナップショットの値ではなく DB の今の値を使う
+            usage = snap.ints["usage_count"].tolist()
+            for pid, count in self._conn.execute(f"SELECT id, usage_count FROM {self.table}"):
+                pos = self._pos_by_id.get(pid)
+                if pos is not None:
+                    usage[pos] = count
+            self.columns["usage_count"] = usage
+
+    def schedule_snapshot(self, delay=SNAPSHOT_DELAY):
+        """delay 秒後にスナップショットを書き出す（それまでに呼ばれたら待ち直す）"""
+        with self._lock:
+            if self._snapshot_timer is not None:
+                self._snapshot_timer.cancel()
+            self._snapshot_timer = threading.Timer(delay, self._write_snapshot)
+            self._snapshot_timer.daemon = True
+            self._snapshot_timer.start()
+
+    def _write_snapshot(self):
+        try:
+            write_index_snapshot(self.db_path, self.table)
+        except Exception as e:
+            print(f"[ERROR] スナップショットの書き出しに失敗: {e}")
+
+    def refresh(self):
+        """他の接続（別プロセスの取り込みなど）による変更があれば読み直す
+
+        defer_refresh の間は、すでに読み込み済みなら読み直さない（少し古い内容で検索する）。
+        """
+        with self._lock:
+            if self._version is None:
+                self.rebuild()
+            elif not self._deferred and self._content_version() != self._version:
+                self.rebuild()
+
+    @contextmanager
+    def defer_refresh(self):
+        """with の間は refresh で読み直さない（大きな取り込みのチャンクごとに読み直さないように）"""
+        with self._lock:
+            self._deferred += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._deferred -= 1
+
+    def _mark_synced(self):
+        # 版数が自分の書き込みの1つ分だけ進んでいれば反映済みとして扱う。
+        # 間に他の書き込みがあった場合は次の refresh で読み直す。
+        version = self._content_version()
+        if version == self._version + 1:
+            self._version = version
+
+    def apply_upsert(self, pid, source, target, context="", tags="", created_at=None):
+        """upsert_phrase の結果をインデックスに反映"""
+        with self._lock:
+            if self._version is None:
+                self.rebuild()
+                return
+            pos = self._pos_by_id.get(pid)
+            if pos is None:
+                self._append({"id": pid, "source": source, "target": target, "context": context,
+                              "tags": tags, "created_at": created_at, "usage_count": 0})
+            else:
+                self.columns["target"][pos] = target
+                self.columns["context"][pos] = context
+                self.columns["tags"][pos] = tags
+                if self._target_ngrams is not None:
+                    self._add_target(pos, target)
+            self._mark_synced()
+            if self.use_snapshot:
+                self.schedule_snapshot()
+
+    def apply_usage(self, pid, delta=1):
+        """increment_usage の結果をインデックスに反映"""
+        with self._lock:
+            pos = self._pos_by_id.get(pid)
+            if pos is not None:
+                self.columns["usage_count"][pos] += delta
+
+    def row(self, pos, columns=None):
+        """位置から行を取り出す（dict）"""
+        columns = columns or self.columns
+        return {c: columns[c][pos] for c in COLUMNS}
+
+    def _snapshot(self):
+        # rebuild は新しいリストに差し替えるので、検索中は同じ世代の列・検索対象・id 対応表を使う
+        with self._lock:
+            return self.choices, self.columns, self._pos_by_id
+
+    def _fts_candidates(self, query, cap, pos_by_id):
+        """FTS5 で候補の位置を取得。使えない場合・絞り込めないクエリの場合は None"""
+        grams = query_trigrams(query)
+        if not self._has_fts or not grams:
+            return None
+        with self._lock:
+            try:
+                missing = [g for g in grams if g not in self._doc_freq]
+                if missing:
+                    found = dict(self._conn.execute(
+                        f"SELECT term, doc FROM {fts_vocab_table(self.table)} "
+                        f"WHERE term IN ({', '.join('?' * len(missing))})", missing).fetchall())
+                    self._doc_freq.update((g, found.get(g, 0)) for g in missing)
+                match = fts_query(grams, self._doc_freq, cap)
+                if match is None:
+                    return None
+                rowids = self._conn.execute(
+                    f"SELECT rowid FROM {fts_table(self.table)} WHERE {fts_table(self.table)} MATCH ?",
+                    (match,)).fetchall()
+            except sqlite3.OperationalError:
+                # fts5vocab がない古いDB（init_db 前）
+                return None
+        return [pos_by_id[r[0]] for r in rowids if r[0] in pos_by_id]
+
+    def _filter_positions(self, tags, context, pos_by_id):
+        """タグ・コンテキストで絞り込んだ位置のリスト。絞り込みがなければ None"""
+        sql, params = filter_sql(self.table, tags, context)
+        if sql is None:
+            return None
+        with self._lock, span("search.filter"):
+            if self._conn is None:
+                self._content_version()
+            ids = self._conn.execute(sql, params).fetchall()
+        return [pos_by_id[r[0]] for r in ids if r[0] in pos_by_id]
+
+    def _exact_positions(self, query, pos_by_id, tags=(), context=""):
+        """normalized_source が完全に一致する行の位置（使用回数の多い順）。該当なしは []"""
+        key = normalize_source(query)
+        if not key:
+            return []
+        sql = f"SELECT id FROM {self.table} WHERE normalized_source = ?"
+        params = [key]
+        scope, scope_params = filter_sql(self.table, tags, context)
+        if scope is not None:
+            sql += f" AND id IN ({scope})"
+            params += scope_params
+        with self._lock, span("search.exact"):
+            if self._conn is None:
+                self._content_version()
+            try:
+                ids = self._conn.execute(sql + " ORDER BY usage_count DESC, id", params).fetchall()
+            except sqlite3.OperationalError:
+                # normalized_source 列がない古いDB（init_db 前）
+                return []
+        return [pos_by_id[r[0]] for r in ids if r[0] in pos_by_id]
+
+    def exact(self, query, tags=(), context=""):
+        """normalized_source が完全に一致する行だけを引く。[(row, 100.0), ...] を使用回数の多い順に返す"""
+        self.refresh()
+        _, columns, pos_by_id = self._snapshot()
+        return [(self.row(pos, columns), 100.0) for pos in self._exact_positions(query, pos_by_id, tags, context)]
+
+    def search(self, query, limit=5, candidate_cap=FTS_CANDIDATE_CAP, min_score=FTS_MIN_SCORE,
+               tags=(), context="", exact=True, fts_min_rows=FTS_MIN_ROWS):
+        """token_sort_ratio 相当のスコアで検索。[(row, score), ...] を返す
+
+        exact=True なら、まず normalized_source のインデックスで完全一致（大文字小文字・記号・空白の違いは無視）を
+        引き、見つかればその行だけをスコア 100 で返す（あいまい検索はしない）。
+        tags / context を渡すと、phrase_tags と context の SQL で絞り込んだ行だけをスコアリングする
+        （tags はすべてのタグを持つ行、context は部分一致）。
+        辞書が fts_min_rows 行以上の場合は、FTS5 で珍しい trigram を含む行（最大 candidate_cap 行）に
+        絞ってから再スコアリングし、候補が少なすぎる・最高スコアが min_score 未満のときは全件検索に戻す。
+        句読点・大文字小文字・つなぎ言葉だけが違う候補は、上位の1件だけを返す。
+        """
+        self.refresh()
+        choices, columns, pos_by_id = self._snapshot()
+        if not choices:
+            return []
+        if exact:
+            hits = self._exact_positions(query, pos_by_id, tags, context)
+            if hits:
+                return self._collapse([(None, 100.0, pos) for pos in hits], columns, limit)
+        q = normalize_choice(query)
+        scoped = self._filter_positions(tags, context, pos_by_id)
+        if scoped is not None:
+            with span("search.score", f"candidates={len(scoped)}"):
+                results = process.extract(q, {pos: choices[pos] for pos in scoped},
+                                          scorer=fuzz.ratio, processor=None, limit=limit * COLLAPSE_FACTOR)
+            return self._collapse(results, columns, limit)
+        if len(choices) >= fts_min_rows:
+            with span("search.fts"):
+                positions = self._fts_candidates(query, candidate_cap, pos_by_id)
+            if positions and len(positions) >= limit:
+                with span("search.score", f"candidates={len(positions)}"):
+                    results = process.extract(q, {pos: choices[pos] for pos in positions},
+                                              scorer=fuzz.ratio, processor=None, limit=limit * COLLAPSE_FACTOR)
+                if results and results[0][1] >= min_score:
+                    return self._collapse(results, columns, limit)
+        with span("search.score", f"candidates={len(choices)}"):
+            results = process.extract(q, choices, scorer=fuzz.ratio, processor=None,
+                                      limit=limit * COLLAPSE_FACTOR)
+        return self._collapse(results, columns, limit)
+
+    def _collapse(self, results, columns, limit):
+        """dedupe_key が同じ候補は最初（スコアが高い方）の1件だけ残す"""
+        seen, out = set(), []
+        for _, score, pos in results:
+            key = dedupe_key(columns["source"][pos])
+            if key in seen:
+                continue
+            seen.add(key)
+            out.append((self.row(pos, columns), score))
+            if len(out) == limit:
+                break
+        return out
+
+    def _add_target(self, pos, target):
+        text = normalize_target(target)
+        if pos < len(self.target_choices):
+            self.target_choices[pos] = text
+        else:
+            self.target_choices.append(text)
+        self._target_ngrams.add(pos, text)
+
+    def _ensure_target_ngrams(self):
+        if self._target_ngrams is not None:
+            return
+        with span("index.target_ngrams"):
+            self.target_choices = []
+            self._target_ngrams = NgramIndex()
+            for pos, target in enumerate(self.columns["target"]):
+                self._add_target(pos, target)
+
+    def reverse_search(self, query, limit=5, candidate_cap=REVERSE_CANDIDATE_CAP, tags=(), context=""):
+        """日本語（target）から引く逆引き検索。[(row, score), ...] を返す
+
+        文字 n-gram の転置インデックスで候補を絞り、文字単位の WRatio で再スコアリングする
+        （部分一致も partial_ratio として評価される）。n-gram が1つも当たらないときは全件を比べる。
+        tags / context を渡すと、SQL で絞り込んだ行だけを比べる。
+        """
+        self.refresh()
+        q = normalize_target(query)
+        with self._lock:
+            self._ensure_target_ngrams()
+            targets, columns = self.target_choices, self.columns
+            if not targets or not q:
+                return []
+            positions = self._filter_positions(tags, context, self._pos_by_id)
+            if positions is None:
+                with span("search.reverse_ngrams"):
+                    positions = self._target_ngrams.candidates(q, candidate_cap)
+            elif not positions:
+                return []
+        with span("search.reverse_score", f"candidates={len(positions) or len(targets)}"):
+            if positions:
+                results = process.extract(q, {pos: targets[pos] for pos in positions},
+                                          scorer=fuzz.WRatio, processor=None, limit=limit)
+            else:
+                results = process.extract(q, targets, scorer=fuzz.WRatio, processor=None, limit=limit)
+        return [(self.row(pos, columns), score) for _, score, pos in results]
+
+    def _ensure_automaton(self):
+        if self._automaton is not None and not self._automaton.needs_rebuild:
+            return self._automaton
+        with span("index.automaton"):
+            sources = self.columns["source"]
+            self._automaton = PhraseAutomaton((pos, tokenize(sources[pos])) for pos in range(len(sources)))
+        return self._automaton
+
+    def spot(self, text, min_words=1, longest_only=False):
+        """text（長い文・台本全体でもよい）に含まれる辞書のフレーズをすべて返す
+
+        [{start, end, line, text, row}, ...] を開始位置の順に返す（start / end は text 内の文字位置、
+        line は1始まりの行番号）。単語単位・大文字小文字と記号を無視して照合する。
+        longest_only=True なら、長いフレーズに含まれる短いフレーズの一致は除く。
+        同じ範囲に表記だけ違う行が複数あるときは、search と同じく1件にまとめる。
+        """
+        self.refresh()
+        with self._lock:
+            automaton = self._ensure_automaton()
+            columns = self.columns
+        # 表記だけ違う行（dedupe_key が同じもの）は、search と同じく1件にまとめる（使用回数の多いものを残す）
+        sources, usage, ids = columns["source"], columns["usage_count"], columns["id"]
+        with span("search.spot", f"chars={len(text)}"):
+            matches = spot_matches(automaton, text, min_words, key=lambda n: dedupe_key(sources[n]),
+                                   rank=lambda n: (-(usage[n] or 0), ids[n]))
+        for m in matches:
+            m["row"] = self.row(m.pop("n"), columns)
+        if longest_only:
+            return drop_contained(matches)
+        return sorted(matches, key=lambda m: (m["start"], -m["end"]))
+
+    def _exact_map(self, queries, pos_by_id):
+        """normalize_source の値 → 完全一致する行の位置（使用回数が一番多いもの）を1回の SQL で引く"""
+        keys = sorted({normalize_source(q) for q in queries} - {""})
+        if not keys:
+            return {}
+        with self._lock, span("batch.exact"):
+            if self._conn is None:
+                self._content_version()
+            try:
+                rows = self._conn.execute(
+                    f"SELECT p.normalized_source, p.id FROM json_each(?) AS k "
+                    f"JOIN {self.table} AS p ON p.normalized_source = k.value "
+                    f"ORDER BY p.usage_count DESC, p.id", (json.dumps(keys, ensure_ascii=False),)).fetchall()
+            except sqlite3.OperationalError:
+                return {}
+        out = {}
+        for key, pid in rows:
+            if key not in out and pid in pos_by_id:
+                out[key] = pos_by_id[pid]
+        return out
+
+    def batch_search(self, queries, score_cutoff=0, chunk_size=None, exact=True):
+        """複数クエリをまとめて検索。クエリごとに最良の (row, score) を返す（該当なしは row=None）
+
+        exact=True なら、normalized_source が完全に一致するクエリはスコア 100 でそのまま返し、
+        残りだけを process.cdist で全コアを使ってスコアリングする。
+        メモリを抑えるため、行列が BATCH_MAX_CELLS を超えないようクエリを分割する。
+        """
+        self.refresh()
+        choices, columns, pos_by_id = self._snapshot()
+        if not choices:
+            return [(None, 0) for _ in queries]
+        results = [None] * len(queries)
+        misses = []
+        hits = self._exact_map(queries, pos_by_id) if exact else {}
+        for i, q in enumerate(queries):
+            pos = hits.get(normalize_source(q))
+            if pos is None:
+                misses.append(i)
+            else:
+                results[i] = (self.row(pos, columns), 100.0)
+        qs = [normalize_choice(queries[i]) for i in misses]
+        if chunk_size is None:
+            chunk_size = max(1, BATCH_MAX_CELLS // len(choices))
+        for start in range(0, len(qs), chunk_size):
+            with span("batch.cdist"):
+                scores = process.cdist(qs[start:start + chunk_size], choices, scorer=fuzz.ratio,
+                                       processor=None, score_cutoff=score_cutoff, workers=-1)
+            best = scores.argmax(axis=1)
+            for i, pos in enumerate(best):
+                score = float(scores[i, pos])
+                if score > 0 and score >= score_cutoff:
+                    results[misses[start + i]] = (self.row(int(pos), columns), score)
+                else:
+                    results[misses[start + i]] = (None, score)
+        return results
+
+# プロセス内で共有するインデックス（Streamlit のセッション間でも共有される）
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get_index(db_path=DB_PATH, table=TABLE):
+    """db_path ごとに1つの PhraseIndex を返す"""
+    key = (os.path.abspath(db_path), table)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = _indexes[key] = PhraseIndex(db_path, table)
+    return index
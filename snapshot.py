@@ -0,0 +1,174 @@
+# snapshot.py
+# 検索インデックスの読み込み専用スナップショット（コールドスタートを速くするため）
+#
+# 形式（リトルエンディアン）:
+#   ヘッダー: マジック, 形式の版, 行数, DBの版数, 最大 id, 正規化の指紋
+#   整数列（id, usage_count）: int64 × 行数
+#   文字列列（source, target, context, tags, created_at, normalized）:
+#       オフセット int64 × (行数 + 1) と UTF-8 の本体（各値の後ろに区切りの \0）、
+#       NULL の行のビット列（1行1ビット、下位ビットから）
+# ファイルは mmap で開き、1行ずつの取り出しはオフセットから直接デコードする。
+# normalized は書き出した時点の正規化関数の結果なので、正規化の指紋（search_index.normalizer_fingerprint）
+# が今のものと違うスナップショットは使わない。
+
+import glob
+import mmap
+import os
+import struct
+import numpy as np
+
+MAGIC = b"PHRSNAP1"
+FORMAT_VERSION = 2
+HEADER = struct.Struct("<8sIqqqQ")   # マジック, 形式の版, 行数, DBの版数, 最大 id, 正規化の指紋
+INT_COLUMNS = ["id", "usage_count"]
+TEXT_COLUMNS = ["source", "target", "context", "tags", "created_at", "normalized"]
+SEP = "\x00"
+
+def snapshot_path(db_path, version):
+    """DB の版数ごとのファイル名（古い版を開いたままでも新しい版を書ける）"""
+    return f"{db_path}.v{version}.snapshot"
+
+def _align(f):
+    pad = -f.tell() % 8
+    if pad:
+        f.write(b"\0" * pad)
+
+def write_snapshot(path, version, max_id, ints, texts, normalizer=0):
+    """ints（列名 → 整数の列）と texts（列名 → 文字列の列）をスナップショットに書く
+
+    None は "" と区別して NULL のビット列に記録する。normalizer は正規化の指紋（読み込み時に照合する）。
+    一時ファイルに書いてから置き換えるので、途中のファイルが読まれることはない。
+    """
+    n = len(ints["id"])
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, n, version, max_id, normalizer))
+        for name in INT_COLUMNS:
+            f.write(np.asarray(ints[name], dtype="<i8").tobytes())
+        for name in TEXT_COLUMNS:
+            parts = [("" if v is None else str(v)).replace(SEP, "").encode("utf-8") for v in texts[name]]
+            offsets = np.zeros(n + 1, dtype="<i8")
+            np.cumsum(np.fromiter((len(p) + 1 for p in parts), dtype=np.int64, count=n), out=offsets[1:])
+            f.write(offsets.tobytes())
+            if parts:
+                f.write(SEP.encode().join(parts) + SEP.encode())
+            nulls = np.fromiter((v is None for v in texts[name]), dtype=bool, count=n)
+            f.write(np.packbits(nulls, bitorder="little").tobytes())
+            _align(f)
+    os.replace(tmp, path)
+    return path
+
+def remove_old_snapshots(db_path, keep=None):
+    """keep 以外のスナップショットを削除（他のプロセスが開いていて消せないものは残す）"""
+    for path in glob.glob(glob.escape(db_path) + ".v*.snapshot"):
+        if path != keep:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+class Snapshot:
+    """mmap したスナップショット"""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, fmt, self.rows, self.version, self.max_id, self.normalizer = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or fmt != FORMAT_VERSION:
+            raise ValueError(f"スナップショットの形式が違います: {path}")
+        self._view = memoryview(self._mm)
+        n = self.rows
+        pos = HEADER.size
+        self.ints = {}
+        for name in INT_COLUMNS:
+            self.ints[name] = np.frombuffer(self._mm, dtype="<i8", count=n, offset=pos)
+            pos += 8 * n
+        self._texts = {}
+        for name in TEXT_COLUMNS:
+            offsets = np.frombuffer(self._mm, dtype="<i8", count=n + 1, offset=pos)
+            start = pos + 8 * (n + 1)
+            pos = start + int(offsets[-1])
+            nulls = np.frombuffer(self._mm, dtype=np.uint8, count=(n + 7) // 8, offset=pos)
+            self._texts[name] = (offsets, start, nulls if nulls.any() else None)
+            pos += len(nulls)
+            pos += -pos % 8
+        if pos > len(self._mm):
+            raise ValueError(f"スナップショットが途中で切れています: {path}")
+
+    def text(self, name, i):
+        """i 行目の文字列（mmap から直接デコード）。NULL なら None"""
+        offsets, start, nulls = self._texts[name]
+        if nulls is not None and nulls[i >> 3] >> (i & 7) & 1:
+            return None
+        return str(self._view[start + int(offsets[i]):start + int(offsets[i + 1]) - 1], "utf-8")
+
+    def texts(self, name):
+        """列全体を文字列のリストにする（区切りで一度に split する。NULL は None）"""
+        offsets, start, nulls = self._texts[name]
+        if self.rows == 0:
+            return []
+        values = str(self._view[start:start + int(offsets[-1]) - 1], "utf-8").split(SEP)
+        if nulls is not None:
+            for i in np.flatnonzero(np.unpackbits(nulls, count=self.rows, bitorder="little")).tolist():
+                values[i] = None
+        return values
+
+    def column(self, name):
+        if name in self.ints:
+            arr = self.ints[name]
+            return SnapshotColumn(lambda i: int(arr[i]), self.rows)
+        return SnapshotColumn(lambda i: self.text(name, i), self.rows)
+
+def open_snapshot(db_path, version, max_id, normalizer=0):
+    """DB の今の版数・最大 id・正規化の指紋に合うスナップショットを開く。なければ（壊れていれば）None"""
+    path = snapshot_path(db_path, version)
+    if not os.path.exists(path):
+        return None
+    try:
+        snap = Snapshot(path)
+    except (OSError, ValueError, struct.error):
+        return None
+    if snap.version != version or snap.max_id != max_id or snap.normalizer != normalizer:
+        return None
+    return snap
+
+class SnapshotColumn:
+    """スナップショットの1列を list のように扱う
+
+    読み込みは mmap から行ごとに取り出し、変更・追加した分だけメモリに持つ。
+    """
+
+    __slots__ = ("_get", "_rows", "_changed", "_added")
+
+    def __init__(self, get, rows):
+        self._get = get
+        self._rows = rows
+        self._changed = {}
+        self._added = []
+
+    def __len__(self):
+        return self._rows + len(self._added)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i >= self._rows:
+            return self._added[i - self._rows]
+        if i in self._changed:
+            return self._changed[i]
+        return self._get(i)
+
+    def __setitem__(self, i, value):
+        if i < 0:
+            i += len(self)
+        if i >= self._rows:
+            self._added[i - self._rows] = value
+        else:
+            self._changed[i] = value
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def append(self, value):
+        self._added.append(value)